@@ -2,569 +2,2970 @@
 """
 Análisis de sucursales con gráficos en navegador (Matplotlib -> HTML/PNG; Plotly -> browser)
 Autor: tú :)
+
+También se puede importar como librería; Matplotlib/Plotly sólo se cargan al graficar:
+
+    import analisis_sucurales as an
+    df, _ = an.apply_schema(an.load("archivo.xlsx"))
+    df_limpio, info = an.clean(df)
+    df_final = an.add_calculated_columns(an.map_hierarchy(df_limpio))
+    df_sucursal = an.compute_icv(an.aggregate(df_final))
+
+o todo el cálculo de una vez con `an.analyze("archivo.xlsx")`.
 """
+from __future__ import annotations
 
 # ========================== CONFIG ==========================
 EXCEL_FILE   = "Limpia_250811_master_reto_sucursales (version 1).xlsx"
 EXPORT_EXCEL = "resultadoS.xlsx"
+FIGURAS_DIR  = "figuras_dimex"       # PNG/HTML de las gráficas
+DASHBOARD_SUFIJO = ".dashboard.html" # reporte único junto a EXPORT_EXCEL: <stem>.dashboard.html
+CACHE_DIR    = ".cache_sucursales"   # copia columnar del Excel (se invalida sola si cambia)
+ESTADO_DIR   = ".estado_sucursales"  # sumas por sucursal del mes anterior para --incremental
+SCATTER_MAX_PUNTOS = 50_000          # puntos por scatter 3D (0 = todos), atípicos incluidos
+SCATTER_CUOTA_ATIPICOS = 0.2         # parte del presupuesto garantizada a los atípicos > p99
+SERVICIO_PUERTO = 8765               # --servir: http://127.0.0.1:<puerto>/
+TASA_INTERES_ANUAL = 0.65            # InteresGenerado = SaldoInsolutoVigente · tasa / 12
+TASA_FONDEO_ANUAL  = 0.11            # ServiciodeDeuda = Saldo Insoluto Actual · tasa / 12
 
 # ======================== IMPORTS ===========================
+import argparse
+import base64
+import cProfile
+import glob
+import hashlib
+import html
+import importlib.util
+import io
+import json
 import os
-import tempfile
+import re
+import sys
+import time
+import threading
+import tracemalloc
 import webbrowser
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from datetime import datetime
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
 
 import numpy as np
 import pandas as pd
 
-# Matplotlib
-import matplotlib
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 (activa proyección 3D)
+# resource (pico de RSS) no existe en Windows
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Opcionales: se detectan sin importarlos; Matplotlib, Plotly, pyarrow y
+# xlsxwriter se importan dentro de las funciones que los usan (arranque rápido).
+_HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None        # caché Parquet (si no, pickle)
+_HAS_XLSXWRITER = importlib.util.find_spec("xlsxwriter") is not None  # xlsx constant_memory (si no, openpyxl)
+_HAS_POLARS = importlib.util.find_spec("polars") is not None          # --motor polars
 
-# Plotly
-import plotly.express as px
-import plotly.io as pio
-pio.renderers.default = "browser"  # abre gráficos interactivos en el navegador
+# API pública (la CLI es `main`)
+__all__ = [
+    "load", "check_columns", "apply_schema", "iter_chunks", "clean", "quality_checks", "drop_mask",
+    "write_audit", "zero_saldo_mask",
+    "apply_rules", "apply_capital_fpd_rules",
+    "HierarchyIndex", "default_hierarchy", "map_hierarchy", "add_calculated_columns",
+    "sum_by", "aggregate", "aggregate_streaming", "aggregate_polars", "check_engines",
+    "aggregate_incremental", "AggregationCube",
+    "ratio_block", "ratio_columns", "safe_div", "compute_icv", "top_n", "rank_sucursales",
+    "period_matrix", "rolling_mean", "trend_slope", "compute_trends", "fpd_by_sucursal", "trend_table",
+    "parse_rates", "scenario_sweep",
+    "SummaryStats", "analyze", "export", "batch_files", "run_batch", "AnalysisService", "serve",
+    "StageProfiler",
+    "plot_top15", "plot_icv_boxplot", "plot_icv_trends", "sample_scatter", "plot_scatter3d", "plot_density3d",
+    "plot_scatter3d_plotly", "build_dashboard", "main",
+]
 
-# Intentar mpld3 (interactivo HTML para Matplotlib); si falla, haremos fallback a PNG
-try:
-    import mpld3
-    _HAS_MPLD3 = True
-except Exception:
-    _HAS_MPLD3 = False
+
+# ======================== COLUMNAS ==========================
+# Filtro inicial: se descartan filas con todas estas columnas en 0 o NaN
+SALDO_COLS = [
+    "Saldo Insoluto Actual",
+    "Saldo Insoluto T-01",
+    "Saldo Insoluto T-02",
+    "Saldo Insoluto T-03",
+    "Saldo Insoluto T-04",
+    "Saldo Insoluto T-05",
+    "Saldo Insoluto T-06",
+    "Saldo Insoluto T-12",
+]
+
+CAPITAL_COLS = [
+    "Capital Dispersado Actual", "Capital Dispersado T-01", "Capital Dispersado T-02",
+    "Capital Dispersado T-03", "Capital Dispersado T-04", "Capital Dispersado T-05",
+    "Capital Dispersado T-06", "Capital Dispersado T-07", "Capital Dispersado T-08",
+    "Capital Dispersado T-09", "Capital Dispersado T-10", "Capital Dispersado T-11",
+    "Capital Dispersado T-12"
+]
+FPD_COLS = [
+    "% FPD Actual", "% FPD T-01", "% FPD T-02",
+    "% FPD T-03", "% FPD T-04", "% FPD T-05",
+    "% FPD T-06", "% FPD T-07", "% FPD T-08",
+    "% FPD T-09", "% FPD T-10", "% FPD T-11",
+    "% FPD T-12"
+]
+
+# Columnas que se suman por Región/Zona/Sucursal
+SUMA_COLS = (
+    ["Saldo Insoluto Actual", "Saldo Insoluto Vencido Actual"]
+    + [f"Saldo Insoluto T-{i:02d}" for i in range(1,13)]
+    + [f"Saldo Insoluto Vencido T-{i:02d}" for i in range(1,13)]
+)
+
+# Bloques por periodo (Actual, T-01..T-12) para el ICV = Vencido / Saldo
+PERIODOS = ["Actual"] + [f"T-{i:02d}" for i in range(1, 13)]
+SALDO_PERIODO_COLS   = [f"Saldo Insoluto {p}" for p in PERIODOS]
+VENCIDO_PERIODO_COLS = [f"Saldo Insoluto Vencido {p}" for p in PERIODOS]
+ICV_COLS             = ["ICV"] + [f"ICV {p}" for p in PERIODOS[1:]]
+
+# Todo lo que usa el cálculo (para cargar sólo estas columnas desde la caché)
+PIPELINE_COLS = list(dict.fromkeys(
+    ["Sucursal", "Vendedor"] + SALDO_COLS + SUMA_COLS + CAPITAL_COLS + FPD_COLS + ["%FPD Actual"]
+))
+
+
+# ========================= ESQUEMA ==========================
+# Columnas sin las que no hay cálculo (se validan todas juntas al cargar)
+COLUMNAS_REQUERIDAS = ["Sucursal"] + SALDO_COLS
+
+# Tipo lógico de cada columna conocida:
+# - "monto": float64; float32 sólo si se pide una tolerancia (montos con centavos no son
+#   exactos en float32, así que con la tolerancia 0 por defecto casi nunca aplica)
+# - "porcentaje": igual, con su propia tolerancia (un % como 0.1 no es exacto en float32)
+# - "category": texto repetido (jerarquía, vendedores), si tiene pocos valores distintos
+ESQUEMA = {
+    **{c: "monto" for c in SALDO_COLS + SUMA_COLS + CAPITAL_COLS},
+    **{c: "porcentaje" for c in FPD_COLS + ["%FPD Actual"]},
+    **{c: "category" for c in ("Región", "Zona", "Sucursal", "Vendedor")},
+}
+CATEGORIA_MAX_UNICOS = 0.5  # "category" sólo si valores distintos / filas < esto (si no, ocupa más)
+
+
+def check_columns(columnas, requeridas=COLUMNAS_REQUERIDAS) -> None:
+    """KeyError con TODAS las columnas requeridas que falten."""
+    faltan = [c for c in requeridas if c not in set(columnas)]
+    if faltan:
+        raise KeyError(f"Faltan columnas requeridas en el Excel: {', '.join(repr(c) for c in faltan)}")
+
+
+def _entero_nullable(v: np.ndarray) -> str | None:
+    """Entero nullable más chico que guarda `v` sin pérdida (None si hay decimales)."""
+    finitos = v[~np.isnan(v)]
+    if not len(finitos) or not np.all(np.isfinite(finitos)) or np.any(finitos != np.round(finitos)):
+        return None
+    lo, hi = finitos.min(), finitos.max()
+    for tipo in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(tipo).min <= lo and hi <= np.iinfo(tipo).max:
+            return np.dtype(tipo).name.capitalize()  # "Int8", ..., dtypes nullable de pandas
+    return None
+
+
+def apply_schema(df: pd.DataFrame, esquema=ESQUEMA, requeridas=COLUMNAS_REQUERIDAS,
+                 tolerancia_monto: float = 0.0, tolerancia_porcentaje: float = 0.0) -> tuple[pd.DataFrame, dict]:
+    """
+    Valida y tipa el frame recién cargado (modifica `df`):
+    - Columnas requeridas faltantes → KeyError con todas.
+    - Columnas de `esquema` a su tipo (ver ESQUEMA); lo no numérico en
+      montos/porcentajes pasa a NaN y se cuenta. Montos y porcentajes quedan en
+      float64 salvo que float32 no cambie ningún valor más de `tolerancia_monto` /
+      `tolerancia_porcentaje` (0 = exacto, lo normal es que no lo sea; float32 es
+      opcional: 0.005 conserva centavos y reduce esas columnas a la mitad).
+    - Texto a "category" sólo con menos de CATEGORIA_MAX_UNICOS valores distintos por fila.
+    - Numéricas no declaradas con sólo enteros → entero nullable más chico (Int8…Int64).
+    Devuelve (df, info) con MB antes/después, columnas por tipo y celdas no numéricas.
+    """
+    check_columns(df.columns, requeridas)
+    antes = df.memory_usage(deep=True).sum()
+    tipos, no_numericos = {}, 0
+
+    for col in df.columns:
+        tipo = esquema.get(col)
+        serie = df[col]
+        if tipo == "category":
+            if not isinstance(serie.dtype, pd.CategoricalDtype):
+                if serie.nunique() >= CATEGORIA_MAX_UNICOS * len(serie):
+                    continue  # casi únicos (p. ej. Vendedor): como category ocuparían más
+                df[col] = serie.astype("category")
+        elif tipo in ("monto", "porcentaje"):
+            v = pd.to_numeric(serie, errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)
+            no_numericos += int(np.isnan(v).sum() - serie.isna().sum())
+            v32 = v.astype(np.float32)
+            with np.errstate(invalid="ignore"):
+                error = np.nanmax(np.abs(v32.astype(np.float64) - v), initial=0.0)
+            tolerancia = tolerancia_monto if tipo == "monto" else tolerancia_porcentaje
+            cabe = error <= tolerancia and np.array_equal(np.isinf(v32), np.isinf(v))  # sin desbordes
+            tipo = "float32" if cabe else "float64"
+            df[col] = v32 if tipo == "float32" else v
+        elif tipo is None and pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+            tipo = _entero_nullable(serie.to_numpy(dtype=np.float64, na_value=np.nan))
+            if tipo is None or tipo == serie.dtype.name:
+                continue
+            df[col] = serie.astype(tipo)
+        else:
+            continue
+        tipos[tipo] = tipos.get(tipo, 0) + 1
+
+    despues = df.memory_usage(deep=True).sum()
+    return df, {"mb_antes": antes / 1e6, "mb_despues": despues / 1e6, "tipos": tipos, "no_numericos": no_numericos}
+
+
+# ================ JERARQUÍA REGIÓN–ZONA–SUCURSAL =============
+JERARQUIA = [
+    # Brokers
+    ("Brokers", "Centro Metrópolis", "Centro Metrópolis"),
+    ("Brokers", "Conexión Magna", "Conexión Magna"),
+    ("Brokers", "Enlace Regio", "Enlace Regio"),
+    ("Brokers", "Puerto Magna", "Puerto Magna"),
+    ("Brokers", "Brokers", "Brokers"),
+
+    # Núcleo Uno
+    ("Núcleo Uno", "División. Red Mexiquense", "Ciudad Pirámide"),
+    ("Núcleo Uno", "División. Red Mexiquense", "Valle Verde"),
+    ("Núcleo Uno", "División. Red Mexiquense", "Río Blanco"),
+    ("Núcleo Uno", "División. Red Mexiquense", "Colina del Sol"),
+    ("Núcleo Uno", "División. Red Mexiquense", "Colina del Sol BIS"),
+    ("Núcleo Uno", "División. Red Mexiquense", "Parque Jurica"),
+    ("Núcleo Uno", "División. Red Mexiquense", "Colina Plateada"),
+    ("Núcleo Uno", "División. Red Mexiquense", "Altos de Querétaro"),
+    ("Núcleo Uno", "División. Red Mexiquense", "Sol y Campo"),
+    ("Núcleo Uno", "Conexión Naucalpan", "Satélite 1"),
+    ("Núcleo Uno", "Conexión Naucalpan", "Satélite 2"),
+    ("Núcleo Uno", "Conexión Naucalpan", "Satélite 3"),
+    ("Núcleo Uno", "Zona Sur Central", "Bahía Dorada"),
+    ("Núcleo Uno", "Zona Sur Central", "Costa Marquesa"),
+    ("Núcleo Uno", "Zona Sur Central", "Bahía Dorada BIS"),
+    ("Núcleo Uno", "Zona Sur Central", "Alto de Chilpan"),
+    ("Núcleo Uno", "Zona Sur Central", "Cuautla Vista"),
+    ("Núcleo Uno", "Zona Sur Central", "Jardines del Valle"),
+    ("Núcleo Uno", "Zona Sur Central", "Llanos de Igualdad"),
+    ("Núcleo Uno", "Zona Sur Central", "Parque Jojutla"),
+    ("Núcleo Uno", "Zona Oriente Valle", "Valle Chalco"),
+    ("Núcleo Uno", "Zona Oriente Valle", "Montaña Azul"),
+    ("Núcleo Uno", "Zona Oriente Valle", "Reyes Paz A"),
+    ("Núcleo Uno", "Zona Oriente Valle", "Reyes Paz B"),
+    ("Núcleo Uno", "Zona Oriente Valle", "Bosques Neza"),
+    ("Núcleo Uno", "Zona Oriente Valle", "Cumbre Neza"),
+    ("Núcleo Uno", "Zona Oriente Valle", "Cumbre Neza BIS"),
+    ("Núcleo Uno", "Zona Oriente Valle", "Riberas Texcoco"),
+    ("Núcleo Uno", "Zona Norte Valle", "Pinar del Valle"),
+    ("Núcleo Uno", "Zona Norte Valle", "Cielos de Metepec"),
+    ("Núcleo Uno", "Zona Norte Valle", "Lomas de Naucalpan"),
+    ("Núcleo Uno", "Zona Norte Valle", "Puente de Tlalne"),
+    ("Núcleo Uno", "Zona Norte Valle", "Puente de Tlalne II"),
+    ("Núcleo Uno", "Zona Norte Valle", "Valles Toluca"),
+    ("Núcleo Uno", "Zona Norte Valle", "Cumbre Toluca"),
+    ("Núcleo Uno", "Zona Norte Valle", "Bosques Tultitlán"),
+
+    # Núcleo Dos
+    ("Núcleo Dos", "División. Distrito Central", "Jardín Aragón A"),
+    ("Núcleo Dos", "División. Distrito Central", "Pilares del Norte"),
+    ("Núcleo Dos", "División. Distrito Central", "Pilares del Norte BIS"),
+    ("Núcleo Dos", "División. Distrito Central", "Residencia A"),
+    ("Núcleo Dos", "División. Distrito Central", "Residencia B"),
+    ("Núcleo Dos", "División. Distrito Central", "Colinas GAM"),
+    ("Núcleo Dos", "División. Distrito Central", "Plaza Central"),
+    ("Núcleo Dos", "División. Distrito Central", "Los Arcos"),
+    ("Núcleo Dos", "División. Distrito Central", "Los Arcos BIS"),
+    ("Núcleo Dos", "División. Distrito Central", "Campo Zaragoza"),
+    ("Núcleo Dos", "División. Distrito Central", "Lomas Zaragoza"),
+    ("Núcleo Dos", "División. Distrito Central", "Campo Zaragoza BIS"),
+    ("Núcleo Dos", "Núcleo Avance", "Avance 1"),
+    ("Núcleo Dos", "Núcleo Avance", "Avance 2"),
+    ("Núcleo Dos", "Núcleo Avance", "Avance 3"),
+    ("Núcleo Dos", "Núcleo Avance", "Avance 4"),
+    ("Núcleo Dos", "Zona Núcleo CDMX", "Parque Obregón"),
+    ("Núcleo Dos", "Zona Núcleo CDMX", "Centro Viejo"),
+    ("Núcleo Dos", "Zona Núcleo CDMX", "Mirador Tlalpan A"),
+    ("Núcleo Dos", "Zona Núcleo CDMX", "Mirador Tlalpan A BIS"),
+    ("Núcleo Dos", "Zona Núcleo CDMX", "Mirador Tlalpan B"),
+    ("Núcleo Dos", "Zona Núcleo CDMX", "Lagunas de Xochimilco"),
+    ("Núcleo Dos", "Zona Núcleo CDMX", "Plaza Zapata"),
+    ("Núcleo Dos", "Zona Oriente Conexión", "Robledal A"),
+    ("Núcleo Dos", "Zona Oriente Conexión", "Robledal B"),
+    ("Núcleo Dos", "Zona Oriente Conexión", "Campo Florido A"),
+    ("Núcleo Dos", "Zona Oriente Conexión", "Campo Florido B"),
+    ("Núcleo Dos", "Zona Oriente Conexión", "Campo Florido C"),
+    ("Núcleo Dos", "Zona Oriente Conexión", "Campo Florido D"),
+    ("Núcleo Dos", "Zona Oriente Conexión", "Riberas del Sur"),
+    ("Núcleo Dos", "Zona Cordillera Puebla", "Sierra Cordobesa"),
+    ("Núcleo Dos", "Zona Cordillera Puebla", "Valles de Orizaba"),
+    ("Núcleo Dos", "Zona Cordillera Puebla", "Alturas de Puebla"),
+    ("Núcleo Dos", "Zona Cordillera Puebla", "Jardines Manuel"),
+    ("Núcleo Dos", "Zona Cordillera Puebla", "Lomas Santiago"),
+    ("Núcleo Dos", "Zona Cordillera Puebla", "Alturas de Puebla BIS"),
+    ("Núcleo Dos", "Zona Cordillera Puebla", "Llanos Tehuacán"),
+    ("Núcleo Dos", "Zona Cordillera Puebla", "Bosques Tlaxcala"),
+    ("Núcleo Dos", "Zona Bahía Veracruz", "Colinas Mirón"),
+    ("Núcleo Dos", "Zona Bahía Veracruz", "Valle Rica"),
+    ("Núcleo Dos", "Zona Bahía Veracruz", "Puerto Bravo"),
+    ("Núcleo Dos", "Zona Bahía Veracruz", "Puerta Cuauhtémoc"),
+    ("Núcleo Dos", "Zona Bahía Veracruz", "Puerto Bravo BIS"),
+    ("Núcleo Dos", "Zona Bahía Veracruz", "Cumbres Xalapa"),
+    ("Núcleo Dos", "Zona Bahía Veracruz", "Lomas Xalapa"),
+
+    # Red Norteña
+    ("Red Norteña","División Red Norteña","Paso del Norte"),
+    ("Red Norteña","División Red Norteña","Río Bravo"),
+    ("Red Norteña","División Red Norteña","Aceros del Norte"),
+    ("Red Norteña","División Red Norteña","Aceros del Norte BIS"),
+    ("Red Norteña","División Red Norteña","Paso Nuevo"),
+    ("Red Norteña","División Red Norteña","Paso Nuevo BIS"),
+    ("Red Norteña","División Red Norteña","Piedras Altas"),
+    ("Red Norteña","División Red Norteña","Piedras Altas BIS"),
+    ("Red Norteña","División Red Norteña","Valles del Norte"),
+    ("Red Norteña","División Red Norteña","Laguna Norte"),
+    ("Red Norteña","División Red Norteña","Sabinas Sierra"),
+    ("Red Norteña","División Red Norteña","Campos Saltillo"),
+    ("Red Norteña","División Red Norteña","Centro Saltillo"),
+    ("Red Norteña","División Red Norteña","Centro Saltillo BIS"),
+    ("Red Norteña","División Red Norteña","Campos Saltillo BIS"),
+
+    ("Red Norteña", "Zona Sierra Norte", "Lomas de Álamos"),
+    ("Red Norteña", "Zona Sierra Norte", "Lomas de Álamos BIS"),
+    ("Red Norteña", "Zona Sierra Norte", "Valle Apodaca"),
+    ("Red Norteña", "Zona Sierra Norte", "Valle Apodaca BIS"),
+    ("Red Norteña", "Zona Sierra Norte", "Puente Lincoln"),
+    ("Red Norteña", "Zona Sierra Norte", "Cumbres Regias"),
+    ("Red Norteña", "Zona Sierra Norte", "Centro Regio"),
+    ("Red Norteña", "Zona Sierra Norte", "Bulevar Regio"),
+    ("Red Norteña", "Zona Sierra Norte", "San Nicolás Valle"),
+    ("Red Norteña", "Zona Sierra Norte", "San Nicolás Valle BIS"),
+    ("Red Norteña", "Zona Sierra Norte", "Sierra Santa"),
+
+    ("Red Norteña", "Zona Red frontera este", "Bosque Verde"),
+    ("Red Norteña", "Zona Red frontera este", "Palacio del Norte"),
+    ("Red Norteña", "Zona Red frontera este", "Palacio del Norte BIS"),
+    ("Red Norteña", "Zona Red frontera este", "Valle de Guadalupe"),
+    ("Red Norteña", "Zona Red frontera este", "Parque Madero"),
+    ("Red Norteña", "Zona Red frontera este", "Parque Madero BIS"),
+    ("Red Norteña", "Zona Red frontera este", "Expo Regia"),
+    ("Red Norteña", "Zona Red frontera este", "Desierto Norte"),
+    ("Red Norteña", "Zona Red frontera este", "Desierto Bravo"),
+    ("Red Norteña", "Zona Red frontera este", "Río Revolución"),
+    ("Red Norteña", "Zona Red frontera este", "Desierto Norte BIS"),
+
+    ("Red Norteña", "Zona Bahía del Sol", "Valle Real"),
+    ("Red Norteña", "Zona Bahía del Sol", "Victoria Alta"),
+    ("Red Norteña", "Zona Bahía del Sol", "Victoria Alta BIS"),
+    ("Red Norteña", "Zona Bahía del Sol", "Bahía Aeropuerto"),
+    ("Red Norteña", "Zona Bahía del Sol", "Plaza Tampico"),
+    ("Red Norteña", "Zona Bahía del Sol", "Colinas Tampico"),
+    ("Red Norteña", "Zona Bahía del Sol", "Colinas Tampico BIS"),
+    ("Red Norteña", "Zona Bahía del Sol", "Río Madero"),
+
+    # Red Noroeste
+    ("Red Noroeste","División Sierra del Desierto","Sierra Chihuahua"),
+    ("Red Noroeste","División Sierra del Desierto","Campus Sierra"),
+    ("Red Noroeste","División Sierra del Desierto","Victoria Sierra"),
+    ("Red Noroeste","División Sierra del Desierto","Victoria Sierra BIS"),
+    ("Red Noroeste","División Sierra del Desierto","Plaza Cuauhtémoc"),
+    ("Red Noroeste","División Sierra del Desierto","Juárez Norte"),
+    ("Red Noroeste","División Sierra del Desierto","Jardines del Norte"),
+    ("Red Noroeste","División Sierra del Desierto","Americas Plaza"),
+    ("Red Noroeste","División Sierra del Desierto","Americas Plaza BIS"),
+    ("Red Noroeste","División Sierra del Desierto","Patio Grande"),
+    ("Red Noroeste","División Sierra del Desierto","Colinas Jilotepec"),
+    ("Red Noroeste","División Sierra del Desierto","Parral Viejo"),
+    ("Red Noroeste","División Sierra del Desierto","División Sierra del Desierto"),
+    ("Red Noroeste","Zona Costa del Pacífico","Bahía Azul"),
+    ("Red Noroeste","Zona Costa del Pacífico","Bahía Azul BIS"),
+    ("Red Noroeste","Zona Costa del Pacífico","Plaza Pacifico"),
+    ("Red Noroeste","Zona Costa del Pacífico","Plaza Pacifico BIS"),
+    ("Red Noroeste","Zona Costa del Pacífico","Cabo Fuerte"),
+    ("Red Noroeste","Zona Costa del Pacífico","Valle Mexicali"),
+    ("Red Noroeste","Zona Costa del Pacífico","Norte Mexicali"),
+    ("Red Noroeste","Zona Costa del Pacífico","Valle Mexicali BIS"),
+    ("Red Noroeste","Zona Costa del Pacífico","Frontera Oeste"),
+    ("Red Noroeste","Zona Costa del Pacífico","Frontera Bravo"),
+    ("Red Noroeste","Zona Costa del Pacífico","Frontera Bravo BIS"),
+    ("Red Noroeste","Zona Costa del Pacífico","Zona Costa del Pacífico"),
+    ("Red Noroeste","Zona Valle Dorado","Valles de Culiacán"),
+    ("Red Noroeste","Zona Valle Dorado","Culiacán Norte"),
+    ("Red Noroeste","Zona Valle Dorado","Valles de Culiacán BIS"),
+    ("Red Noroeste","Zona Valle Dorado","Sierra Durango"),
+    ("Red Noroeste","Zona Valle Dorado","Durango Norte"),
+    ("Red Noroeste","Zona Valle Dorado","Valle del Río"),
+    ("Red Noroeste","Zona Valle Dorado","Plaza Mochis"),
+    ("Red Noroeste","Zona Valle Dorado","Plaza Mochis BIS"),
+    ("Red Noroeste","Zona Valle Dorado","Bahía Dorada"),
+    ("Red Noroeste","Zona Valle Dorado","Norte Dorado"),
+    ("Red Noroeste","Zona Valle Dorado","Zona Valle Dorado"),
+    ("Red Noroeste","Zona Desierto del Sol","Obregón Central"),
+    ("Red Noroeste","Zona Desierto del Sol","Obregón Norte"),
+    ("Red Noroeste","Zona Desierto del Sol","Obregón Central BIS"),
+    ("Red Noroeste","Zona Desierto del Sol","Sierra Hermosillo"),
+    ("Red Noroeste","Zona Desierto del Sol","Hermosillo Norte"),
+    ("Red Noroeste","Zona Desierto del Sol","Sierra Hermosillo BIS"),
+    ("Red Noroeste","Zona Desierto del Sol","Valle de Navojoa"),
+    ("Red Noroeste","Zona Desierto del Sol","Frontera Nogales"),
+    ("Red Noroeste","Zona Desierto del Sol","Zona Desierto del Sol"),
+
+    # Occidente Conexión
+    ("Occidente Conexión","Conexión GDL","Guadalajara Uno"),
+    ("Occidente Conexión","Conexión GDL","Guadalajara Dos"),
+    ("Occidente Conexión","Conexión GDL","Guadalajara Tres"),
+    ("Occidente Conexión","Conexión GDL","Conexión GDL"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","Aguas Central"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","Aguas Norte"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","Aguas Central BIS"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","Sierra Colima"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","Río Fresnillo"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","Bahía Manzanillo"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","San Luis Norte"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","San Luis Alturas"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","Cumbres Zacatecas"),
+    ("Occidente Conexión","Zona Corazón de la Sierra","Zona Corazón de la Sierra"),
+    ("Occidente Conexión","Zona Valles Centrales","Plaza Celaya"),
+    ("Occidente Conexión","Zona Valles Centrales","Hidalgo Valle"),
+    ("Occidente Conexión","Zona Valles Centrales","Jardines Irapuato"),
+    ("Occidente Conexión","Zona Valles Centrales","Jardines Irapuato BIS"),
+    ("Occidente Conexión","Zona Valles Centrales","Cañadas León"),
+    ("Occidente Conexión","Zona Valles Centrales","Norte León"),
+    ("Occidente Conexión","Zona Valles Centrales","Cañadas León BIS"),
+    ("Occidente Conexión","Zona Valles Centrales","Zona Valles Centrales"),
+    ("Occidente Conexión","Zona Tierra de lagos","Valle Piedad"),
+    ("Occidente Conexión","Zona Tierra de lagos","Bahía Lázaro"),
+    ("Occidente Conexión","Zona Tierra de lagos","Colinas Morelia"),
+    ("Occidente Conexión","Zona Tierra de lagos","Morelia Norte"),
+    ("Occidente Conexión","Zona Tierra de lagos","Morelia Norte BIS"),
+    ("Occidente Conexión","Zona Tierra de lagos","Camelinas Plaza"),
+    ("Occidente Conexión","Zona Tierra de lagos","Jardines Uruapan"),
+    ("Occidente Conexión","Zona Tierra de lagos","Valle Zamora"),
+    ("Occidente Conexión","Zona Tierra de lagos","Valle Zamora BIS"),
+    ("Occidente Conexión","Zona Tierra de lagos","Riviera Zihua"),
+    ("Occidente Conexión","Zona Tierra de lagos","Montes Zitácuaro"),
+    ("Occidente Conexión","Zona Tierra de lagos","Zona Tierra de lagos"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","GDL Central"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","Norte GDL"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","Riviera Vallarta"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","Riviera Vallarta BIS"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","Valle Tepic"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","Norte Tepic"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","Jardines Tlaque"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","Montes Tonalá"),
+    ("Occidente Conexión","Zona Cumbres del Pacífico","Zona Cumbres del Pacífico"),
+    ("Occidente Conexión","Zona Valles del Pacífico","Guzmán Valle"),
+    ("Occidente Conexión","Zona Valles del Pacífico","IMSS GDL"),
+    ("Occidente Conexión","Zona Valles del Pacífico","Oblatos Plaza"),
+    ("Occidente Conexión","Zona Valles del Pacífico","Las Águilas"),
+    ("Occidente Conexión","Zona Valles del Pacífico","Zapopan Plaza"),
+    ("Occidente Conexión","Zona Valles del Pacífico","Zona Valles del Pacífico"),
+
+    # Red Sureste
+    ("Red Sureste","Zona Selva Alta","Río Coatzacoalcos"),
+    ("Red Sureste","Zona Selva Alta","Valle Comitán"),
+    ("Red Sureste","Zona Selva Alta","Selva Tapachula"),
+    ("Red Sureste","Zona Selva Alta","Tuxtla Norte"),
+    ("Red Sureste","Zona Selva Alta","Tuxtla Central"),
+    ("Red Sureste","Zona Selva Alta","Villa Central"),
+    ("Red Sureste","Zona Selva Alta","Villa Norte"),
+    ("Red Sureste","Zona Selva Alta","Villa Norte BIS"),
+    ("Red Sureste","Zona Selva Alta","Villa Alturas"),
+    ("Red Sureste","Zona Selva Alta","Zona Selva Alta"),
+    ("Red Sureste","Zona Sierra Escondida","Sierra Oaxaca"),
+    ("Red Sureste","Zona Sierra Escondida","Riviera Escondida"),
+    ("Red Sureste","Zona Sierra Escondida","Bahía Cruz"),
+    ("Red Sureste","Zona Sierra Escondida","Bahía Cruz BIS"),
+    ("Red Sureste","Zona Sierra Escondida","Río Tuxtepec"),
+    ("Red Sureste","Zona Sierra Escondida","Zona Sierra Escondida"),
+    ("Red Sureste","Zona Riviera del Caribe","Bahía Campeche"),
+    ("Red Sureste","Zona Riviera del Caribe","Riviera Cancún"),
+    ("Red Sureste","Zona Riviera del Caribe","Bahía Chetumal"),
+    ("Red Sureste","Zona Riviera del Caribe","Isla del Carmen"),
+    ("Red Sureste","Zona Riviera del Caribe","Sierra Mérida"),
+    ("Red Sureste","Zona Riviera del Caribe","Mérida Norte"),
+    ("Red Sureste","Zona Riviera del Caribe","Alturas Mérida"),
+    ("Red Sureste","Zona Riviera del Caribe","Sierra Mérida BIS"),
+    ("Red Sureste","Zona Riviera del Caribe","Riviera Playa"),
+    ("Red Sureste","Zona Riviera del Caribe","Zona Riviera del Caribe"),
+]
+
+
+class HierarchyIndex:
+    """
+    Jerarquía Región–Zona–Sucursal precompilada a códigos enteros.
+    Cada sucursal tiene una posición; Región y Zona son Categoricals alineados a
+    esas posiciones, así el mapeo de un DataFrame es un `np.take` de códigos
+    en lugar de un merge por texto.
+    Si una sucursal aparece más de una vez se usa la primera y queda en `duplicates`.
+    """
+
+    def __init__(self, tuplas):
+        mapa = pd.DataFrame(list(tuplas), columns=["Región", "Zona", "Sucursal"])
+        repetida = mapa["Sucursal"].duplicated(keep="first")
+        self.duplicates = mapa.loc[mapa["Sucursal"].isin(mapa.loc[repetida, "Sucursal"])]
+        mapa = mapa.loc[~repetida]
+
+        self.sucursales = pd.Index(mapa["Sucursal"])
+        self.region = pd.Categorical(mapa["Región"])
+        self.zona = pd.Categorical(mapa["Zona"])
+
+    @classmethod
+    def from_csv(cls, path):
+        """Carga la jerarquía de un CSV con columnas Región, Zona, Sucursal."""
+        mapa = pd.read_csv(path, usecols=["Región", "Zona", "Sucursal"], dtype=str)
+        return cls(mapa[["Región", "Zona", "Sucursal"]].itertuples(index=False, name=None))
+
+    def codes(self, sucursales) -> np.ndarray:
+        """Posición de cada sucursal en la jerarquía (-1 si no está mapeada)."""
+        sucursales = pd.Series(sucursales)
+        if isinstance(sucursales.dtype, pd.CategoricalDtype):
+            por_categoria = np.append(self.sucursales.get_indexer(sucursales.cat.categories), -1)
+            return np.take(por_categoria, sucursales.cat.codes.to_numpy())
+        return self.sucursales.get_indexer(sucursales)
+
+    def lookup(self, sucursales) -> tuple[pd.Categorical, pd.Categorical]:
+        """(Región, Zona) de cada sucursal como Categoricals; NaN si no está mapeada."""
+        codes = self.codes(sucursales)
+        # El código -1 cae en el último elemento (-1 = NaN en Categorical)
+        region = np.take(np.append(self.region.codes, -1), codes)
+        zona = np.take(np.append(self.zona.codes, -1), codes)
+        return (pd.Categorical.from_codes(region, dtype=self.region.dtype),
+                pd.Categorical.from_codes(zona, dtype=self.zona.dtype))
+
+    def unmapped(self, sucursales) -> list[str]:
+        """Sucursales (no nulas) del archivo que no están en la jerarquía."""
+        unicas = pd.Series(pd.unique(pd.Series(sucursales).dropna()))
+        return sorted(unicas[self.sucursales.get_indexer(unicas) < 0].astype(str))
+
+    def report(self, sin_mapeo=()) -> None:
+        """Imprime avisos de sucursales duplicadas en la jerarquía y sin mapeo en los datos."""
+        if len(self.duplicates):
+            for suc, grupo in self.duplicates.groupby("Sucursal", sort=True):
+                zonas = " | ".join(f"{r} / {z}" for r, z in zip(grupo["Región"], grupo["Zona"]))
+                print(f"[Aviso] Sucursal duplicada en la jerarquía: '{suc}' ({zonas}). Se usa la primera.")
+        if len(sin_mapeo):
+            muestra = ", ".join(list(sin_mapeo)[:20])
+            extra = f" (+{len(sin_mapeo) - 20} más)" if len(sin_mapeo) > 20 else ""
+            print(f"[Aviso] {len(sin_mapeo)} sucursales sin Región/Zona: {muestra}{extra}")
+
+
+@lru_cache(maxsize=1)
+def default_hierarchy() -> HierarchyIndex:
+    """Índice de JERARQUIA (se compila una sola vez por proceso)."""
+    return HierarchyIndex(JERARQUIA)
+
+
+# ================ ESTADÍSTICAS DE RESUMEN ====================
+def _interp_quantiles(ordenados: np.ndarray, qs) -> np.ndarray:
+    """Cuantiles con interpolación lineal (como Series.quantile) de un arreglo YA ordenado."""
+    qs = np.asarray(qs, dtype=float)
+    if not len(ordenados):
+        return np.full(qs.shape, np.nan)
+    pos = qs * (len(ordenados) - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, len(ordenados) - 1)
+    return ordenados[lo] + (ordenados[hi] - ordenados[lo]) * (pos - lo)
+
+
+class SummaryStats:
+    """
+    Cuantiles, máscaras de recorte y estadísticas de caja de un DataFrame,
+    calculados una sola vez y compartidos por gráficas y reportes.
+    - Cada columna se convierte y ordena una sola vez (NaN y ±inf fuera);
+      todos sus cuantiles salen de ese arreglo ordenado.
+    - Las cajas por grupo salen de un solo ordenamiento (grupo, valor).
+    """
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._valores = {}
+        self._ordenados = {}
+        self._mascaras = {}
+        self._cajas = {}
+
+    def values(self, col: str) -> np.ndarray:
+        """Columna como float64 con ±inf → NaN (alineada con las filas de `df`)."""
+        if col not in self._valores:
+            v = pd.to_numeric(self.df[col], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+            self._valores[col] = np.where(np.isinf(v), np.nan, v)
+        return self._valores[col]
+
+    def sorted_values(self, col: str) -> np.ndarray:
+        if col not in self._ordenados:
+            v = self.values(col)
+            self._ordenados[col] = np.sort(v[~np.isnan(v)])
+        return self._ordenados[col]
+
+    def quantiles(self, col: str, qs) -> np.ndarray:
+        return _interp_quantiles(self.sorted_values(col), qs)
+
+    def clip_mask(self, col: str, lo: float = 0.01, hi: float = 0.99) -> np.ndarray:
+        """Filas con p{lo} ≤ valor ≤ p{hi} (NaN/inf quedan fuera)."""
+        clave = (col, lo, hi)
+        if clave not in self._mascaras:
+            p_lo, p_hi = self.quantiles(col, [lo, hi])
+            v = self.values(col)
+            with np.errstate(invalid="ignore"):
+                self._mascaras[clave] = (v >= p_lo) & (v <= p_hi)
+        return self._mascaras[clave]
+
+    def box_stats(self, col: str, by: str, lo: float = 0.01, hi: float = 0.99, whis: float = 1.5) -> list[dict]:
+        """
+        Estadísticas de caja de `col` por grupo de `by` sobre las filas recortadas p{lo}–p{hi},
+        en el formato de `ax.bxp` (label, med, q1, q3, whislo, whishi, n). Los bigotes siguen la
+        regla de Matplotlib: el dato más extremo dentro de `whis`·IQR.
+        """
+        clave = (col, by, lo, hi, whis)
+        if clave in self._cajas:
+            return self._cajas[clave]
+
+        codigos, etiquetas = pd.factorize(self.df[by], sort=True)
+        dentro = self.clip_mask(col, lo, hi) & (codigos >= 0)  # copia: la máscara de clip_mask es compartida
+        v, codigos = self.values(col)[dentro], codigos[dentro]
+        orden = np.lexsort((v, codigos))
+        v, codigos = v[orden], codigos[orden]
+        limites = np.searchsorted(codigos, np.arange(len(etiquetas) + 1))
+
+        cajas = []
+        for g, etiqueta in enumerate(etiquetas):
+            x = v[limites[g]:limites[g + 1]]
+            if not len(x):
+                continue
+            q1, med, q3 = _interp_quantiles(x, [0.25, 0.5, 0.75])
+            iqr = q3 - q1
+            bajo = x[np.searchsorted(x, q1 - whis * iqr, side="left")]
+            alto = x[np.searchsorted(x, q3 + whis * iqr, side="right") - 1]
+            cajas.append({"label": str(etiqueta), "med": med, "q1": q1, "q3": q3,
+                          "whislo": min(bajo, q1), "whishi": max(alto, q3), "n": len(x)})
+        self._cajas[clave] = cajas
+        return cajas
+
+
+# ======================== GRÁFICAS ==========================
+# Cada función arma y devuelve la figura; mostrarla o guardarla lo decide main().
+def plot_top15(top15: pd.DataFrame) -> plt.Figure:
+    """Barras del TOP por Servicio de Deuda (una barra por fila de `top15`)."""
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(10, 5))
+    ax.bar(top15["Sucursal"].astype(str), top15["ServiciodeDeuda"])
+    ax.set_title(f"Top {len(top15)} Sucursales por Servicio de Deuda")
+    ax.tick_params(axis="x", labelrotation=90, labelsize=8)
+    fig.tight_layout()
+    return fig
+
+
+def plot_icv_boxplot(cajas: list[dict], by: str) -> plt.Figure:
+    """Boxplot del ICV por `by` (Zona o Región) desde `SummaryStats.box_stats` (recortado p1–p99)."""
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(12, 5))
+    ax.bxp(cajas, showfliers=False)
+    ax.grid(True)
+    ax.set_title(f"ICV por {by} (recortado p1–p99)")
+    ax.set_xlabel(by)
+    ax.set_ylabel("ICV")
+    plt.setp(ax.get_xticklabels(), rotation=45, ha="right")
+    fig.tight_layout()
+    return fig
+
+
+def _sample_by_group(posiciones: np.ndarray, grupos: np.ndarray, cupo: int, rng) -> np.ndarray:
+    """
+    `cupo` de las `posiciones` al azar, estratificado por `grupos` con cuota
+    proporcional al tamaño de cada grupo (el sobrante del redondeo va a los mayores residuos).
+    """
+    if cupo >= len(posiciones):
+        return posiciones
+    if cupo <= 0:
+        return posiciones[:0]
+    codigos = pd.factorize(grupos, use_na_sentinel=False)[0]
+    tam = np.bincount(codigos)
+    exacta = tam * cupo / len(posiciones)
+    cuota = np.floor(exacta).astype(np.int64)
+    faltan = cupo - int(cuota.sum())
+    if faltan > 0:
+        cuota[np.argsort(cuota - exacta, kind="stable")[:faltan]] += 1
+
+    # Orden al azar dentro de cada grupo; se toman los primeros `cuota` de cada uno
+    orden = np.lexsort((rng.random(len(posiciones)), codigos))
+    rango = np.arange(len(posiciones)) - np.repeat(np.cumsum(tam) - tam, tam)
+    return posiciones[orden[rango < np.repeat(cuota, tam)]]
+
+
+def sample_scatter(df3d: pd.DataFrame, ejes, max_puntos: int | None = SCATTER_MAX_PUNTOS,
+                   por: str = "Región", seed: int = 0, p99=None,
+                   cuota_atipicos: float = SCATTER_CUOTA_ATIPICOS) -> pd.DataFrame:
+    """
+    Muestra para los scatter 3D con a lo más `max_puntos` filas (0/None = todas):
+    - Las filas que pasan del p99 en cualquier eje (atípicos) van todas si caben en
+      `cuota_atipicos` del presupuesto (o en lo que deje libre el resto); si no, se
+      muestrean también. `p99` = un valor por eje si ya se calculó.
+    - El resto llena el presupuesto, al azar estratificado por `por` con cuota
+      proporcional al tamaño de cada grupo.
+    Devuelve las filas elegidas en su orden original.
+    """
+    if not max_puntos or len(df3d) <= max_puntos:
+        return df3d
+    valores = df3d[list(ejes)].to_numpy(dtype=float)
+    if p99 is None:
+        p99 = np.nanquantile(valores, 0.99, axis=0)
+    atipico = (valores > np.asarray(p99, dtype=float)).any(axis=1)
+    atipicos, resto = np.flatnonzero(atipico), np.flatnonzero(~atipico)
+
+    cupo_atipicos = min(len(atipicos), max(int(max_puntos * cuota_atipicos), max_puntos - len(resto)))
+    cupo_resto = min(len(resto), max_puntos - cupo_atipicos)
+    rng = np.random.default_rng(seed)
+    grupos = df3d[por].to_numpy()
+    elegidas = np.zeros(len(df3d), dtype=bool)
+    elegidas[_sample_by_group(atipicos, grupos[atipicos], cupo_atipicos, rng)] = True
+    elegidas[_sample_by_group(resto, grupos[resto], cupo_resto, rng)] = True
+    return df3d[elegidas]
+
+
+def plot_icv_trends(trayectorias: pd.DataFrame, total=None) -> plt.Figure:
+    """
+    ICV mes a mes (T-12 … Actual) de las sucursales en `trayectorias` (una fila por
+    sucursal, columnas en orden cronológico) y, si se da, la serie `total` punteada.
+    """
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(10, 5))
+    meses = list(trayectorias.columns)
+    for sucursal, serie in trayectorias.iterrows():
+        ax.plot(meses, serie.to_numpy(), marker="o", markersize=3, linewidth=1.2, label=str(sucursal))
+    if total is not None:
+        ax.plot(meses, total, color="black", linestyle="--", linewidth=2, label="Total")
+    ax.set_title(f"ICV mensual: {len(trayectorias)} sucursales con mayor deterioro")
+    ax.set_ylabel("ICV")
+    ax.legend(fontsize=7, ncol=2)
+    fig.tight_layout()
+    return fig
+
+
+def plot_scatter3d(X, Y, Z, x_col: str, y_col: str, z_col: str, clip_p99: bool = False,
+                   p99=None) -> plt.Figure:
+    """
+    Scatter 3D Matplotlib; con `clip_p99` deja fuera lo que pase del p99 en cualquier eje.
+    `p99` = (x, y, z) ya calculados sobre todas las filas (si X/Y/Z son una muestra).
+    """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 (activa proyección 3D)
+    if clip_p99:
+        xq, yq, zq = p99 if p99 is not None else (X.quantile(0.99), Y.quantile(0.99), Z.quantile(0.99))
+        m_clip = (X <= xq) & (Y <= yq) & (Z <= zq)
+        X, Y, Z = X[m_clip], Y[m_clip], Z[m_clip]
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111, projection="3d")
+    ax.scatter(X, Y, Z, s=8, alpha=0.7)
+    ax.set_xlabel(x_col); ax.set_ylabel(y_col); ax.set_zlabel(z_col)
+    titulo = "3D (p99 clip)" if clip_p99 else "3D"
+    ax.set_title(f"{titulo}: {y_col} vs {x_col} vs {z_col}")
+    fig.tight_layout()
+    return fig
+
+
+def plot_density3d(X, Y, Z, x_col: str, y_col: str, z_col: str, bins: int = 24, p99=None) -> plt.Figure:
+    """
+    Densidad 3D: cuenta las filas por celda con np.histogramdd (todas las filas, sin muestreo)
+    y dibuja un punto por celda ocupada, con color y tamaño según log(1 + filas).
+    `p99` = (x, y, z) limita la rejilla para que los atípicos no la aplasten.
+    """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D  # noqa: F401 (activa proyección 3D)
+    datos = np.column_stack([np.asarray(X, dtype=float), np.asarray(Y, dtype=float), np.asarray(Z, dtype=float)])
+    rango = None
+    if p99 is not None:
+        minimos = np.nanmin(datos, axis=0)
+        rango = [(lo, hi if hi > lo else lo + 1.0) for lo, hi in zip(minimos, p99)]
+    conteo, bordes = np.histogramdd(datos, bins=bins, range=rango)
+    centros = [(b[:-1] + b[1:]) / 2 for b in bordes]
+    ix, iy, iz = np.nonzero(conteo)
+    peso = np.log1p(conteo[ix, iy, iz])
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111, projection="3d")
+    puntos = ax.scatter(centros[0][ix], centros[1][iy], centros[2][iz], c=peso,
+                        s=6 + 60 * peso / max(peso.max(initial=0), 1e-12), cmap="viridis", alpha=0.8)
+    fig.colorbar(puntos, ax=ax, shrink=0.6, pad=0.1, label="log(1 + filas)")
+    ax.set_xlabel(x_col); ax.set_ylabel(y_col); ax.set_zlabel(z_col)
+    titulo = "Densidad 3D (≤ p99)" if p99 is not None else "Densidad 3D"
+    ax.set_title(f"{titulo}: {y_col} vs {x_col} vs {z_col}")
+    fig.tight_layout()
+    return fig
+
+
+def plot_scatter3d_plotly(df3d: pd.DataFrame, x_col: str, y_col: str, z_col: str):
+    """
+    Scatter 3D interactivo (Plotly, WebGL) coloreado por Región.
+    Una traza por Región con arreglos float32, que se embeben en binario; las
+    sucursales sin mapeo van en su propia traza "Sin región".
+    El hover lleva sólo Sucursal y Zona. El tamaño sigue a `x_col` en escala
+    de área, como `px.scatter_3d(size=...)`.
+    """
+    import plotly.express as px
+    import plotly.graph_objects as go
+    paleta = px.colors.qualitative.Plotly
+    tam_max = float(np.nanmax(df3d[x_col], initial=0))
+    sizeref = 2.0 * tam_max / 20 ** 2 if tam_max > 0 else 1.0  # sizemax 20 px, como px
+
+    fig = go.Figure()
+    for i, (region, g) in enumerate(df3d.groupby("Región", observed=True, sort=False, dropna=False)):
+        region = "Sin región" if pd.isna(region) else str(region)
+        fig.add_trace(go.Scatter3d(
+            x=g[x_col].to_numpy(np.float32),
+            y=g[y_col].to_numpy(np.float32),
+            z=g[z_col].to_numpy(np.float32),
+            mode="markers",
+            name=region,
+            marker=dict(size=np.clip(g[x_col].to_numpy(np.float32), 0, None), sizemode="area",
+                        sizeref=sizeref, color=paleta[i % len(paleta)], opacity=0.7, line_width=0),
+            customdata=np.column_stack([g["Sucursal"].astype(str), g["Zona"].astype(str)]),
+            hovertemplate=(f"%{{customdata[0]}} · %{{customdata[1]}}<br>{x_col}=%{{x}}<br>"
+                           f"{y_col}=%{{y}}<br>{z_col}=%{{z}}<extra>{region}</extra>"),
+        ))
+    fig.update_layout(
+        title=f"Scatter 3D interactivo: {y_col} vs {x_col} vs {z_col}",
+        legend_title_text="Región",
+        scene=dict(xaxis_title=x_col, yaxis_title=y_col, zaxis_title=z_col),
+    )
+    return fig
+
+
+# ===================== DASHBOARD HTML =======================
+_DASHBOARD_CSS = """
+body { font-family: system-ui, sans-serif; margin: 2rem auto; max-width: 1200px; color: #222; }
+h1 { font-size: 1.5rem; } h2 { font-size: 1.15rem; margin-top: 2rem; border-bottom: 1px solid #ddd; }
+table.tabla { border-collapse: collapse; font-size: .85rem; }
+table.tabla th, table.tabla td { padding: .25rem .6rem; border-bottom: 1px solid #eee; text-align: right; }
+table.tabla th { background: #f4f4f4; }
+img { max-width: 100%; }
+"""
+
+
+def _figure_fragment(funcion, kwargs: dict, archivo: str, out_dir: str | None = None) -> str:
+    """
+    Arma una figura con `funcion(**kwargs)` y devuelve su fragmento HTML: PNG en
+    base64 (Matplotlib) o <div> de Plotly sin plotly.js. Con `out_dir` también la
+    guarda como `archivo` (un HTML suelto carga plotly.js del CDN). Corre en un worker.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig = funcion(**kwargs)
+    if archivo.endswith(".html"):
+        if out_dir is not None:
+            fig.write_html(os.path.join(out_dir, archivo), include_plotlyjs="cdn")
+        return fig.to_html(full_html=False, include_plotlyjs=False)
+
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=140, bbox_inches="tight")
+    plt.close(fig)
+    png = buf.getvalue()
+    if out_dir is not None:
+        Path(out_dir, archivo).write_bytes(png)
+    return f'<img alt="{html.escape(archivo)}" src="data:image/png;base64,{base64.b64encode(png).decode("ascii")}">'
+
+
+def _table_html(tabla: pd.DataFrame) -> str:
+    """Tabla HTML con montos a 2 decimales y separador de miles."""
+    return tabla.to_html(index=False, border=0, classes="tabla", na_rep="",
+                         float_format=lambda v: f"{v:,.2f}")
+
+
+def build_dashboard(tareas, ruta, tablas: dict | None = None, out_dir=None, workers: int | None = None,
+                    titulo: str = "Análisis de sucursales") -> Path:
+    """
+    Un solo HTML autocontenido con las `tablas` ({título: DataFrame}) y las
+    figuras de `tareas` (archivo, funcion, kwargs), en ese orden. Las figuras se
+    renderizan una vez, en un pool de procesos (`workers=1` en serie); los PNG
+    van embebidos en base64 y plotly.js se incluye una sola vez para todas las
+    figuras interactivas. Con `out_dir` cada figura también queda como archivo.
+    Una figura que falla no detiene a las demás. Devuelve la ruta escrita.
+    """
+    tareas = list(tareas)
+    if out_dir is not None:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+        out_dir = str(out_dir)
+    fragmentos = {}
+
+    if workers == 1:
+        for archivo, funcion, kwargs in tareas:
+            try:
+                fragmentos[archivo] = _figure_fragment(funcion, kwargs, archivo, out_dir)
+            except Exception as e:
+                print(f"[Aviso] No se pudo generar {archivo}. Detalle: {e}")
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futuros = {pool.submit(_figure_fragment, funcion, kwargs, archivo, out_dir): archivo
+                       for archivo, funcion, kwargs in tareas}
+            for fut in as_completed(futuros):
+                try:
+                    fragmentos[futuros[fut]] = fut.result()
+                except Exception as e:
+                    print(f"[Aviso] No se pudo generar {futuros[fut]}. Detalle: {e}")
+
+    partes = [f"<h1>{html.escape(titulo)}</h1>",
+              f"<p>Generado: {datetime.now():%Y-%m-%d %H:%M}</p>"]
+    for nombre, tabla in (tablas or {}).items():
+        if tabla is not None:
+            partes.append(f"<h2>{html.escape(nombre)}</h2>\n{_table_html(tabla)}")
+    for archivo, _, _ in tareas:  # orden de las tareas, no de terminación
+        if archivo in fragmentos:
+            partes.append(f"<h2>{html.escape(Path(archivo).stem)}</h2>\n{fragmentos[archivo]}")
+
+    plotly_js = ""
+    if any(archivo.endswith(".html") for archivo in fragmentos):
+        from plotly.offline import get_plotlyjs
+        plotly_js = f'<script type="text/javascript">{get_plotlyjs()}</script>'
+
+    ruta = Path(ruta)
+    ruta.write_text(
+        "<!DOCTYPE html>\n<html lang=\"es\"><head><meta charset=\"utf-8\">"
+        f"<title>{html.escape(titulo)}</title><style>{_DASHBOARD_CSS}</style>{plotly_js}</head>\n"
+        "<body>\n" + "\n".join(partes) + "\n</body></html>\n",
+        encoding="utf-8",
+    )
+    return ruta
+
+
+# ===================== CACHÉ DEL EXCEL ======================
+def _file_fingerprint(path: Path) -> str:
+    """Huella del contenido del archivo (cambia si el Excel cambia)."""
+    h = hashlib.blake2b(digest_size=12)
+    with open(path, "rb") as f:
+        for bloque in iter(lambda: f.read(1 << 20), b""):
+            h.update(bloque)
+    return h.hexdigest()
 
 
-# ===================== UTILIDADES UI ========================
-def show_in_browser(fig: plt.Figure | None = None, title_prefix: str = "fig"):
+def _cache_prefix(path: Path) -> str:
+    """Prefijo de caché de `path`: nombre + hash corto de la ruta absoluta (2024/x.xlsx ≠ 2025/x.xlsx)."""
+    ruta = hashlib.blake2b(str(Path(path).resolve()).encode("utf-8"), digest_size=4).hexdigest()
+    return f"{path.stem}-{ruta}"
+
+
+def _cache_paths(path: Path, cache_dir=CACHE_DIR) -> tuple[Path, Path]:
+    """Rutas (parquet, pickle) de la caché correspondiente al contenido actual de `path`."""
+    cache_dir = Path(cache_dir)
+    base = f"{_cache_prefix(path)}-{_file_fingerprint(path)}"
+    return cache_dir / f"{base}.parquet", cache_dir / f"{base}.pkl"
+
+
+def load(path=EXCEL_FILE, columns=None, use_cache=True, refresh=False, cache_dir=CACHE_DIR,
+         verbose=True) -> pd.DataFrame:
     """
-    Abre una figura de Matplotlib en el navegador.
-    1) Intenta exportar a HTML con mpld3 si está disponible.
-    2) Si mpld3 no está o falla, guarda un PNG temporal y lo abre.
+    Carga el Excel pasando por una caché columnar en disco.
+    - La caché se guarda en `cache_dir` como Parquet (o pickle si no hay pyarrow),
+      con la huella del contenido en el nombre: si el Excel cambia, se regenera.
+    - `columns` limita la lectura a esas columnas (las que no existan se ignoran).
+    - `use_cache=False` lee directo con pd.read_excel; `refresh=True` fuerza regenerarla.
+    - .parquet/.csv (p.ej. los sintéticos de más de 1M filas) se leen directo, sin caché.
+    - `verbose=False` no avisa cuando se usa la caché.
     """
-    if fig is None:
-        fig = plt.gcf()
+    path = Path(path)
+    if path.suffix.lower() == ".parquet":
+        import pyarrow.parquet as pq
+        cols = None
+        if columns is not None:
+            disponibles = set(pq.read_schema(path).names)
+            cols = [c for c in columns if c in disponibles]
+        return pd.read_parquet(path, columns=cols)
+    if path.suffix.lower() == ".csv":
+        return pd.read_csv(path, usecols=(lambda c: c in columns) if columns is not None else None)
+
+    if not use_cache:
+        df = pd.read_excel(path)
+        return df[[c for c in columns if c in df.columns]] if columns is not None else df
+
+    cache_dir = Path(cache_dir)
+    parquet_file, pickle_file = _cache_paths(path, cache_dir)
+
+    if not refresh and _HAS_PYARROW and parquet_file.exists():
+        cols = None
+        if columns is not None:
+            import pyarrow.parquet as pq
+            disponibles = set(pq.read_schema(parquet_file).names)
+            cols = [c for c in columns if c in disponibles]
+        if verbose:
+            print(f"⚡ Usando caché: {parquet_file}")
+        return pd.read_parquet(parquet_file, columns=cols)
+    if not refresh and pickle_file.exists():
+        if verbose:
+            print(f"⚡ Usando caché: {pickle_file}")
+        df = pd.read_pickle(pickle_file)
+        return df[[c for c in columns if c in df.columns]] if columns is not None else df
 
-    # Intento HTML con mpld3
-    if _HAS_MPLD3:
+    df = pd.read_excel(path)
+
+    # Guardar caché nueva y borrar las de versiones anteriores del mismo Excel (misma ruta)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    prefijo = glob.escape(_cache_prefix(path))
+    for viejo in list(cache_dir.glob(f"{prefijo}-*.parquet")) + list(cache_dir.glob(f"{prefijo}-*.pkl")):
+        viejo.unlink(missing_ok=True)
+    guardado = False
+    if _HAS_PYARROW:
         try:
-            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".html")
-            html = mpld3.fig_to_html(fig)
-            with open(tmp.name, "w", encoding="utf-8") as f:
-                f.write(html)
-            webbrowser.open("file://" + os.path.realpath(tmp.name))
-            return
+            df.to_parquet(parquet_file, index=False)
+            guardado = True
         except Exception as e:
-            print(f"[Aviso] mpld3 falló, uso PNG estático. Detalle: {e}")
+            print(f"[Aviso] No se pudo guardar la caché Parquet, uso pickle. Detalle: {e}")
+            parquet_file.unlink(missing_ok=True)
+    if not guardado:
+        df.to_pickle(pickle_file)
+
+    return df[[c for c in columns if c in df.columns]] if columns is not None else df
+
+
+# ================== LECTURA POR BLOQUES =====================
+def iter_chunks(path, chunk_rows: int = 50_000, columns=None):
+    """
+    Lee el archivo en bloques de `chunk_rows` filas (DataFrames) sin cargarlo entero.
+    - .xlsx/.xlsm: openpyxl en modo read_only (iter_rows).
+    - .csv: pd.read_csv con chunksize.
+    - .parquet: row groups / batches de pyarrow.
+    `columns` limita las columnas leídas (las que no existan se ignoran).
+    """
+    path = Path(path)
+    suffix = path.suffix.lower()
+
+    if suffix == ".csv":
+        usecols = (lambda c: c in columns) if columns is not None else None
+        yield from pd.read_csv(path, chunksize=chunk_rows, usecols=usecols)
+        return
 
-    # Fallback: PNG
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    fig.savefig(tmp.name, dpi=140, bbox_inches="tight")
-    webbrowser.open("file://" + os.path.realpath(tmp.name))
+    if suffix == ".parquet":
+        if not _HAS_PYARROW:
+            raise ImportError("Leer Parquet por bloques requiere pyarrow.")
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(path)
+        cols = [c for c in columns if c in pf.schema_arrow.names] if columns is not None else None
+        for batch in pf.iter_batches(batch_size=chunk_rows, columns=cols):
+            yield batch.to_pandas()
+        return
+
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = [str(h) if h is not None else None for h in next(rows, ())]
+        idx = [i for i, h in enumerate(header) if h is not None and (columns is None or h in columns)]
+        names = [header[i] for i in idx]
+        # Columnas numéricas del cálculo: openpyxl no infiere dtypes, se fuerzan aquí
+        numericas = [c for c in names if c in PIPELINE_COLS and c not in ("Sucursal", "Vendedor")]
+
+        def _to_frame(buffer):
+            chunk = pd.DataFrame(buffer, columns=names)
+            for c in numericas:
+                if chunk[c].dtype == object:
+                    chunk[c] = pd.to_numeric(chunk[c], errors="coerce")
+            return chunk
+
+        buffer = []
+        for row in rows:
+            if all(v is None for v in row):
+                continue
+            buffer.append([row[i] if i < len(row) else None for i in idx])
+            if len(buffer) >= chunk_rows:
+                yield _to_frame(buffer)
+                buffer = []
+        if buffer:
+            yield _to_frame(buffer)
+    finally:
+        wb.close()
 
 
 # ===================== FUNCIONES CÁLCULO ====================
+def ratio_block(num, den) -> np.ndarray:
+    """num / den elemento a elemento sobre arrays (2-D o 1-D); NaN donde den es 0 o NaN."""
+    num = np.asarray(num, dtype=float)
+    den = np.asarray(den, dtype=float)
+    out = np.full(np.broadcast_shapes(num.shape, den.shape), np.nan)
+    np.divide(num, den, out=out, where=den != 0)
+    return out
+
+
 def safe_div(num, den):
     """División segura (evita división por cero)."""
     num = pd.to_numeric(num, errors="coerce")
-    den = pd.to_numeric(den, errors="coerce").replace(0, np.nan)
-    return num / den
+    den = pd.to_numeric(den, errors="coerce")
+    return pd.Series(ratio_block(num, den), index=num.index)
 
 
-# ========================= MAIN =============================
-def main():
-    # ---------- Cargar Excel ----------
-    if not Path(EXCEL_FILE).exists():
-        raise FileNotFoundError(
-            f"No encontré el archivo '{EXCEL_FILE}'. "
-            "Pon este script en la MISMA carpeta que el Excel o ajusta EXCEL_FILE."
-        )
+def ratio_columns(df: pd.DataFrame, num_cols, den_cols, out_cols) -> pd.DataFrame:
+    """
+    Agrega out_cols[i] = num_cols[i] / den_cols[i] calculando todo el bloque con
+    una sola división y pegándolo con un único concat (sin inserts por columna).
+    Los pares con alguna columna faltante se omiten. Sirve para ICV, tasas FPD, etc.
+    """
+    pares = [(n, d, o) for n, d, o in zip(num_cols, den_cols, out_cols)
+             if n in df.columns and d in df.columns]
+    if not pares:
+        return df
+
+    num = _numeric_block(df, [n for n, _, _ in pares])
+    den = _numeric_block(df, [d for _, d, _ in pares])
+    nombres = [o for _, _, o in pares]
+    bloque = pd.DataFrame(ratio_block(num, den), columns=nombres, index=df.index)
+    return pd.concat([df.drop(columns=[o for o in nombres if o in df.columns]), bloque], axis=1)
+
+
+# ---- Calidad de datos por fila (bloque 2-D de saldos) ----
+# Pruebas por fila sobre bloques (filas × columnas); `b` es el bloque pareado si la regla lo usa
+_PRUEBAS_FILA = {
+    "todas_cero_o_nan": lambda a, b: np.all(np.isnan(a) | (a == 0), axis=1),
+    "alguna_negativa":  lambda a, b: np.any(a < 0, axis=1),
+    "alguna_mayor":     lambda a, b: np.any(a > b, axis=1),
+}
+
+# Reglas de calidad como datos: (nombre, prueba, columnas, columnas pareadas, ¿descarta la fila?).
+# Sólo "saldos_en_cero" descarta; las demás quedan marcadas en la auditoría.
+REGLAS_CALIDAD = [
+    ("saldos_en_cero",      "todas_cero_o_nan", SALDO_COLS,                                 None,               True),
+    ("saldo_negativo",      "alguna_negativa",  SALDO_PERIODO_COLS + VENCIDO_PERIODO_COLS, None,               False),
+    ("vencido_mayor_saldo", "alguna_mayor",     VENCIDO_PERIODO_COLS,                       SALDO_PERIODO_COLS, False),
+]
+
+
+def quality_checks(df: pd.DataFrame, reglas=REGLAS_CALIDAD, bloque_filas: int = 1_000_000) -> dict[str, np.ndarray]:
+    """
+    Evalúa todas las `reglas` por fila en una pasada: las columnas que usan se
+    convierten una sola vez a un bloque 2-D float (por tramos de `bloque_filas`
+    para acotar la memoria) y cada regla toma sus columnas de ahí.
+    Devuelve {regla: máscara booleana por fila}; las columnas pareadas faltantes se omiten.
+    """
+    check_columns(df.columns, SALDO_COLS)
+    presentes = set(df.columns)
+    planes = []
+    for nombre, prueba, cols, pares, _ in reglas:
+        if pares is None:
+            cols_a, cols_b = [c for c in cols if c in presentes], []
+        else:
+            juntos = [(a, b) for a, b in zip(cols, pares) if a in presentes and b in presentes]
+            cols_a, cols_b = [a for a, _ in juntos], [b for _, b in juntos]
+        planes.append((nombre, _PRUEBAS_FILA[prueba], cols_a, cols_b))
+
+    usadas = list(dict.fromkeys(c for _, _, a, b in planes for c in a + b))
+    posicion = {c: k for k, c in enumerate(usadas)}
+    mascaras = {nombre: np.zeros(len(df), dtype=bool) for nombre, *_ in planes}
+    for inicio in range(0, len(df), bloque_filas):
+        bloque = _numeric_block(df.iloc[inicio:inicio + bloque_filas], usadas)
+        with np.errstate(invalid="ignore"):
+            for nombre, prueba, cols_a, cols_b in planes:
+                if not cols_a:
+                    continue
+                a = bloque[:, [posicion[c] for c in cols_a]]
+                b = bloque[:, [posicion[c] for c in cols_b]] if cols_b else None
+                mascaras[nombre][inicio:inicio + len(bloque)] = prueba(a, b)
+    return mascaras
+
+
+def drop_mask(calidad: dict[str, np.ndarray], reglas=REGLAS_CALIDAD) -> np.ndarray:
+    """Filas a descartar: alguna regla con `descarta=True` marcada."""
+    descarta = [calidad[nombre] for nombre, *_, quita in reglas if quita and nombre in calidad]
+    return np.logical_or.reduce(descarta) if descarta else np.zeros(len(next(iter(calidad.values()))), dtype=bool)
+
+
+def write_audit(df: pd.DataFrame, calidad: dict[str, np.ndarray], ruta, reglas=REGLAS_CALIDAD) -> dict:
+    """
+    Escribe las filas marcadas por alguna regla (descartadas o con aviso) a `ruta`
+    con su fila de Excel, Vendedor/Sucursal, los saldos del filtro y una columna
+    por regla. Formato según la extensión (ver `export`).
+    """
+    marcadas = np.logical_or.reduce(list(calidad.values()))
+    filas = np.flatnonzero(marcadas)
+    cols = [c for c in ["Vendedor", "Sucursal"] + SALDO_COLS if c in df.columns]
+    auditoria = df.iloc[filas][cols].reset_index(drop=True)
+    auditoria.insert(0, "Fila Excel", filas + 2)  # +1 encabezado, +1 base 1
+    for nombre, mascara in calidad.items():
+        auditoria[nombre] = mascara[filas]
+    auditoria["descartada"] = drop_mask(calidad, reglas)[filas]
+    return export({"auditoria": auditoria}, ruta)
+
+
+def zero_saldo_mask(df: pd.DataFrame) -> np.ndarray:
+    """Máscara de filas con todas las SALDO_COLS en 0 o NaN."""
+    return quality_checks(df, reglas=REGLAS_CALIDAD[:1])["saldos_en_cero"]
+
+
+# ---- Motor de reglas por celda (bloques 2-D de periodos) ----
+# Condiciones disponibles para las reglas, sobre arrays float (NaN = vacío)
+_CONDICIONES = {
+    "nan":        np.isnan,
+    "cero":       lambda a: a == 0,
+    "no_cero":    lambda a: ~np.isnan(a) & (a != 0),
+    "cero_o_nan": lambda a: np.isnan(a) | (a == 0),
+}
+
+# Reglas como datos: (nombre, condición referencia, condición valor, valor nuevo).
+# Se aplican en orden sobre los bloques completos de 13 periodos.
+REGLAS_CAPITAL_FPD = [
+    ("capital≠0 & fpd NaN → 0",         "no_cero",    "nan",        0.0),
+    ("capital 0/NaN & fpd 0/NaN → NaN", "cero_o_nan", "cero_o_nan", np.nan),
+]
+
+
+def _numeric_block(df: pd.DataFrame, cols: list[str]) -> np.ndarray:
+    """Bloque de columnas como array float 2-D (lo no numérico pasa a NaN)."""
+    bloque = df[cols]
+    if not all(pd.api.types.is_numeric_dtype(t) for t in bloque.dtypes):
+        bloque = bloque.apply(pd.to_numeric, errors="coerce")
+    return bloque.to_numpy(dtype=float, na_value=np.nan)
+
+
+def apply_rules(df: pd.DataFrame, ref_cols: list[str], val_cols: list[str], reglas) -> dict[str, int]:
+    """
+    Aplica `reglas` celda a celda sobre los pares (ref_cols[i], val_cols[i]) de `df`
+    en una sola pasada por bloques 2-D y escribe `val_cols` de vuelta (modifica `df`).
+    Sirve igual para Capital/FPD que para Saldo/Vencido T-xx.
+    Devuelve cuántas celdas cambió cada regla.
+    """
+    pares = [(r, v) for r, v in zip(ref_cols, val_cols) if r in df.columns and v in df.columns]
+    conteo = {nombre: 0 for nombre, *_ in reglas}
+    if not pares:
+        return conteo
+
+    ref = _numeric_block(df, [r for r, _ in pares])
+    val_names = [v for _, v in pares]
+    val = _numeric_block(df, val_names)
+    if not val.flags.writeable:  # vista de sólo lectura del frame (copy-on-write)
+        val = val.copy()
+
+    for nombre, cond_ref, cond_val, nuevo in reglas:
+        mask = _CONDICIONES[cond_ref](ref) & _CONDICIONES[cond_val](val)
+        cambia = mask & ~np.isnan(val) if np.isnan(nuevo) else mask & (val != nuevo)
+        conteo[nombre] = int(cambia.sum())
+        val[mask] = nuevo
+
+    compacto = all(t == np.float32 for t in df[val_names].dtypes)  # 0/NaN caben exactos en float32
+    df[val_names] = val.astype(np.float32) if compacto else val
+    return conteo
+
+
+def apply_capital_fpd_rules(df: pd.DataFrame) -> dict[str, int]:
+    """
+    Reglas Capital–FPD (modifica `df`):
+    - FPD a numérico (si no lo es ya).
+    - Capital ≠ 0 y FPD NaN -> FPD = 0.
+    - Capital 0/NaN y FPD 0/NaN -> FPD = NaN.
+    Devuelve las celdas cambiadas por regla.
+    """
+    no_numericas = [c for c in FPD_COLS if c in df.columns and not pd.api.types.is_numeric_dtype(df[c])]
+    if no_numericas:
+        df[no_numericas] = _numeric_block(df, no_numericas)
+
+    return apply_rules(df, CAPITAL_COLS, FPD_COLS, REGLAS_CAPITAL_FPD)
+
+
+def clean(df: pd.DataFrame) -> tuple[pd.DataFrame, dict]:
+    """
+    Reglas de calidad (descarta filas con todos los saldos en 0/NaN) + reglas Capital–FPD.
+    Devuelve (copia limpia, info) con la máscara descartada, las máscaras por regla
+    de calidad y las celdas cambiadas por regla.
+    """
+    calidad = quality_checks(df)
+    filtro = drop_mask(calidad)
+    df_limpio = df.loc[~filtro].copy()
+    reglas = apply_capital_fpd_rules(df_limpio)
+    return df_limpio, {"filtro": filtro, "descartadas": int(filtro.sum()), "calidad": calidad, "reglas": reglas}
+
+
+def map_hierarchy(df: pd.DataFrame, jerarquia: HierarchyIndex | None = None) -> pd.DataFrame:
+    """Agrega Región y Zona por Sucursal (modifica `df`) y las deja como primeras columnas."""
+    if jerarquia is None:
+        jerarquia = default_hierarchy()
+    region, zona = jerarquia.lookup(df["Sucursal"])
+    for col in ("Región", "Zona"):
+        if col in df.columns:
+            del df[col]
+    df.insert(0, "Zona", zona)
+    df.insert(0, "Región", region)
+    df.insert(2, "Sucursal", df.pop("Sucursal"))
+    return df
+
+
+def add_calculated_columns(df: pd.DataFrame, tasa_interes: float = TASA_INTERES_ANUAL,
+                           tasa_fondeo: float = TASA_FONDEO_ANUAL) -> pd.DataFrame:
+    """SaldoInsolutoVigente, InteresGenerado y ServiciodeDeuda con tasas anuales (modifica `df`)."""
+    tasainteresanual = tasa_interes / 12
+    tasacostefondeo  = tasa_fondeo / 12
+
+    if {"Saldo Insoluto Actual", "Saldo Insoluto Vencido Actual"}.issubset(df.columns):
+        saldo = df["Saldo Insoluto Actual"].astype(np.float64)  # en float64 aunque venga compacto
+        df["SaldoInsolutoVigente"] = saldo - df["Saldo Insoluto Vencido Actual"].astype(np.float64)
+        df["InteresGenerado"]      = df["SaldoInsolutoVigente"] * tasainteresanual
+        df["ServiciodeDeuda"]      = saldo * tasacostefondeo
+    return df
+
+
+def sum_by(df: pd.DataFrame, keys: list[str], cols: list[str]) -> pd.DataFrame:
+    """
+    Como `df.groupby(keys, as_index=False, observed=True)[cols].sum()` pero acumulando
+    en float64 aunque las columnas vengan en float32 (np.bincount suma en double),
+    una columna a la vez.
+    """
+    grupos = df.groupby(keys, observed=True, sort=True)
+    codigos = grupos.ngroup().to_numpy(dtype=float)  # NaN = fila sin grupo (llave nula)
+    validas = ~np.isnan(codigos)
+    codigos = codigos[validas].astype(np.intp)
+    resultado = grupos.size().index.to_frame(index=False)
+    for c in cols:
+        v = pd.to_numeric(df[c], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)[validas]
+        resultado[c] = np.bincount(codigos, weights=np.nan_to_num(v, nan=0.0), minlength=len(resultado))
+    return resultado
+
+
+def aggregate(df_final: pd.DataFrame) -> pd.DataFrame:
+    """Suma SUMA_COLS por Región/Zona/Sucursal (acumuladores float64)."""
+    cols_sumar = [c for c in SUMA_COLS if c in df_final.columns]
+    return sum_by(df_final, ["Región", "Zona", "Sucursal"], cols_sumar)
+
+
+def compute_icv(df_sucursal: pd.DataFrame) -> pd.DataFrame:
+    """ICV Actual y T-01..T-12 = Vencido / Saldo, los 13 periodos en una sola operación."""
+    return ratio_columns(df_sucursal, VENCIDO_PERIODO_COLS, SALDO_PERIODO_COLS, ICV_COLS)
+
+
+# =================== CUBO DE AGREGADOS ======================
+class AggregationCube:
+    """
+    Sumas por Sucursal, Zona, Región y Total en arrays float64.
+    Se construye desde el agregado por sucursal (un único groupby sobre las filas)
+    y los niveles superiores se obtienen sumando hacia arriba esas filas.
+    El ICV de cada nivel se calcula con vencido y saldo sumados, no promediando ICVs.
+    """
+
+    NIVELES = {
+        "Sucursal": ["Región", "Zona", "Sucursal"],
+        "Zona":     ["Región", "Zona"],
+        "Región":   ["Región"],
+        "Total":    [],
+    }
+
+    def __init__(self, df_sucursal: pd.DataFrame, cols=None):
+        if cols is None:
+            cols = [c for c in SUMA_COLS if c in df_sucursal.columns]
+        self.columns = list(cols)
+        base = df_sucursal[self.NIVELES["Sucursal"]].reset_index(drop=True)
+        valores = df_sucursal[self.columns].to_numpy(dtype=float, na_value=np.nan)
+
+        self._keys = {}
+        self._values = {}
+        for nivel, keys in self.NIVELES.items():
+            if nivel == "Sucursal":
+                self._keys[nivel], self._values[nivel] = base, valores
+            elif keys:
+                grupos = base.groupby(keys, observed=True, sort=True)
+                claves = grupos.size().index.to_frame(index=False)
+                sumas = np.zeros((len(claves), len(self.columns)))
+                np.add.at(sumas, grupos.ngroup().to_numpy(), valores)
+                self._keys[nivel], self._values[nivel] = claves, sumas
+            else:
+                self._keys[nivel] = pd.DataFrame(index=range(1))
+                self._values[nivel] = valores.sum(axis=0, keepdims=True)
+
+    def values(self, nivel: str, cols=None) -> np.ndarray:
+        """Array (grupos × columnas) del nivel; `cols` elige columnas en ese orden."""
+        if cols is None:
+            return self._values[nivel]
+        return self._values[nivel][:, [self.columns.index(c) for c in cols]]
+
+    def frame(self, nivel: str = "Sucursal", icv: bool = False, **filtros) -> pd.DataFrame:
+        """
+        DataFrame del nivel con sus llaves y sumas; `icv=True` agrega ICV y ICV T-xx.
+        Los filtros van por llave, p.ej. frame("Sucursal", Región="Núcleo Uno").
+        """
+        keys = self._keys[nivel]
+        mask = np.ones(len(keys), dtype=bool)
+        for col, valor in filtros.items():
+            if col not in keys.columns:
+                raise KeyError(f"El nivel '{nivel}' no tiene la llave '{col}'.")
+            mask &= (keys[col] == valor).to_numpy()
+
+        out = keys.loc[mask].reset_index(drop=True)
+        out[self.columns] = self._values[nivel][mask]
+        return compute_icv(out) if icv else out
+
+
+# ========================= RANKING ==========================
+def top_n(df: pd.DataFrame, col: str, n: int = 15, by=None) -> pd.DataFrame:
+    """
+    Las `n` filas con mayor `col`, de mayor a menor, sin ordenar todo el frame.
+    - Sin `by`: `DataFrame.nlargest` (selección parcial).
+    - Con `by` ("Región", "Zona" o una lista): top-n dentro de cada grupo en una sola
+      pasada (posiciones por grupo de `groupby.indices` + `np.partition` en cada uno)
+      y columna Ranking (1 = mayor del grupo).
+    Los NaN no entran; en empates gana la fila que aparece primero (como nlargest).
+    """
+    if by is None:
+        return df.nlargest(n, col)
+
+    valores = pd.to_numeric(df[col], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    elegidas, rangos = [], []
+    for posiciones in df.groupby(by, observed=True, sort=True).indices.values():
+        posiciones = posiciones[~np.isnan(valores[posiciones])]
+        x = valores[posiciones]
+        if len(posiciones) > n:
+            umbral = -np.partition(-x, n - 1)[n - 1]  # n-ésimo mayor
+            mayores = posiciones[x > umbral]
+            posiciones = np.concatenate([mayores, posiciones[x == umbral][: n - len(mayores)]])
+            x = valores[posiciones]
+        elegidas.append(posiciones[np.lexsort((posiciones, -x))])
+        rangos.append(np.arange(1, len(posiciones) + 1))
+
+    if not elegidas:
+        return df.iloc[:0].assign(Ranking=pd.Series(dtype="int64"))
+    resultado = df.iloc[np.concatenate(elegidas)].copy()
+    resultado["Ranking"] = np.concatenate(rangos)
+    return resultado
+
+
+def rank_sucursales(df_sucursal: pd.DataFrame, n: int = 15, by=None, **tasas) -> pd.DataFrame | None:
+    """
+    Top-n de sucursales por Servicio de Deuda total, sobre el frame agregado
+    (una fila por sucursal, sin etiquetas repetidas). El Servicio de Deuda es
+    lineal en el saldo, así que sale de los saldos ya sumados.
+    `tasas` (tasa_interes, tasa_fondeo) van a `add_calculated_columns`.
+    None si df_sucursal no trae los saldos necesarios.
+    """
+    cols = [c for c in ["Región", "Zona", "Sucursal", "Saldo Insoluto Actual", "Saldo Insoluto Vencido Actual"]
+            if c in df_sucursal.columns]
+    base = add_calculated_columns(df_sucursal[cols].copy(), **tasas)
+    if "ServiciodeDeuda" not in base.columns:
+        return None
+    return top_n(base, "ServiciodeDeuda", n, by=by)
+
+
+# ======================= TENDENCIAS =========================
+# Serie por sucursal: T-12 … T-01, Actual (orden cronológico, 13 meses)
+TENDENCIA_VENTANA = 3     # meses de la media móvil
+TENDENCIA_PERIODOS = 6    # últimos meses para la pendiente
+TENDENCIA_MESES_ALZA = 3  # alzas consecutivas hasta el mes actual que marcan deterioro
+TENDENCIA_UMBRAL = 0.05   # o pendiente > 5 % mensual del nivel medio de la ventana
+
+
+def period_matrix(df: pd.DataFrame, cols) -> np.ndarray:
+    """Bloque (filas × periodos) float64 en orden cronológico; `cols` viene en orden de PERIODOS (Actual primero)."""
+    return _numeric_block(df, list(cols)[::-1])
+
+
+def rolling_mean(m: np.ndarray, ventana: int = TENDENCIA_VENTANA) -> np.ndarray:
+    """
+    Media móvil por fila de `ventana` meses (ignora NaN) con sumas acumuladas:
+    una resta por ventana, sin bucles. Los primeros ventana-1 meses quedan en NaN.
+    """
+    validos = ~np.isnan(m)
+    ceros = np.zeros((m.shape[0], 1))
+    suma = np.concatenate([ceros, np.cumsum(np.where(validos, m, 0.0), axis=1)], axis=1)
+    cuenta = np.concatenate([ceros, np.cumsum(validos, axis=1)], axis=1)
+    medias = np.full(m.shape, np.nan)
+    medias[:, ventana - 1:] = ratio_block(suma[:, ventana:] - suma[:, :-ventana],
+                                          cuenta[:, ventana:] - cuenta[:, :-ventana])
+    return medias
 
-    df = pd.read_excel(EXCEL_FILE)
-    print(f"✅ Excel cargado: {EXCEL_FILE} | Filas: {len(df):,}")
-
-    # ---------- Filtrado inicial (todas estas columnas en 0 o NaN) ----------
-    saldo_cols = [
-        "Saldo Insoluto Actual",
-        "Saldo Insoluto T-01",
-        "Saldo Insoluto T-02",
-        "Saldo Insoluto T-03",
-        "Saldo Insoluto T-04",
-        "Saldo Insoluto T-05",
-        "Saldo Insoluto T-06",
-        "Saldo Insoluto T-12",
-    ]
-    for c in saldo_cols:
-        if c not in df.columns:
-            raise KeyError(f"Falta la columna requerida en el Excel: '{c}'")
-
-    filtro = np.logical_and.reduce([(df[c].isna() | (df[c] == 0)) for c in saldo_cols])
-
-    print("\nVendedores con todas las columnas en 0 o nulas:")
-    if "Vendedor" in df.columns:
-        print(df.loc[filtro, "Vendedor"])
+
+def trend_slope(m: np.ndarray) -> np.ndarray:
+    """
+    Pendiente por fila de la recta de mínimos cuadrados contra t = 0, 1, …
+    (forma cerrada cov(t, y) / var(t), ignorando NaN). NaN con menos de 2 puntos.
+    """
+    validos = ~np.isnan(m)
+    t = np.arange(m.shape[1], dtype=float)
+    n = validos.sum(axis=1)
+    t_media = ratio_block(validos @ t, n)
+    y_media = ratio_block(np.where(validos, m, 0.0).sum(axis=1), n)
+    dt = np.where(validos, t - t_media[:, None], 0.0)
+    dy = np.where(validos, m - y_media[:, None], 0.0)
+    return ratio_block((dt * dy).sum(axis=1), (dt * dt).sum(axis=1))
+
+
+def compute_trends(df: pd.DataFrame, cols, nombre: str, ventana: int = TENDENCIA_VENTANA,
+                   periodos: int = TENDENCIA_PERIODOS, meses_alza: int = TENDENCIA_MESES_ALZA,
+                   umbral: float = TENDENCIA_UMBRAL) -> pd.DataFrame:
+    """
+    Tendencia de la serie `cols` (orden de PERIODOS) para todas las filas a la vez:
+    valor actual, media móvil, delta mes a mes, pendiente de los últimos `periodos`
+    meses, alzas consecutivas y la marca de deterioro (`meses_alza` alzas seguidas o
+    pendiente mayor a `umbral` veces el nivel medio de la ventana).
+    Con menos de 2 periodos (p.ej. sin las columnas T-xx) delta, pendiente y media
+    quedan en NaN y no se marca deterioro.
+    Devuelve las llaves Región/Zona/Sucursal presentes más una columna por métrica.
+    """
+    m = period_matrix(df, cols)
+    sin_dato = np.full(len(m), np.nan)
+    reciente = m[:, -periodos:]
+    pendiente = trend_slope(reciente)
+    with np.errstate(invalid="ignore"):
+        alza = np.diff(m, axis=1) > 0  # NaN cuenta como "no sube"
+        nivel = np.abs(ratio_block(np.nansum(reciente, axis=1), (~np.isnan(reciente)).sum(axis=1)))
+        pendiente_alta = pendiente > umbral * nivel
+    meses_al_alza = np.cumprod(alza[:, ::-1], axis=1).sum(axis=1)
+
+    tendencias = df[[k for k in ["Región", "Zona", "Sucursal"] if k in df.columns]].reset_index(drop=True)
+    tendencias[f"{nombre} Actual"] = m[:, -1] if m.shape[1] else sin_dato
+    tendencias[f"{nombre} media {ventana}m"] = rolling_mean(m, ventana)[:, -1] if m.shape[1] else sin_dato
+    tendencias[f"{nombre} Δ mes"] = m[:, -1] - m[:, -2] if m.shape[1] >= 2 else sin_dato
+    tendencias[f"{nombre} pendiente {periodos}m"] = pendiente
+    tendencias[f"{nombre} meses al alza"] = meses_al_alza
+    tendencias[f"{nombre} deterioro"] = (meses_al_alza >= meses_alza) | pendiente_alta
+    return tendencias
+
+
+def fpd_by_sucursal(df_final: pd.DataFrame) -> pd.DataFrame | None:
+    """
+    % FPD Actual y T-01..T-12 por sucursal, ponderado por el Capital Dispersado
+    del mismo periodo (Σ capital·FPD / Σ capital, sólo filas con ambos valores).
+    None si faltan las llaves o los pares Capital–FPD.
+    """
+    keys = ["Región", "Zona", "Sucursal"]
+    pares = [(c, f) for c, f in zip(CAPITAL_COLS, FPD_COLS) if c in df_final.columns and f in df_final.columns]
+    if not pares or not set(keys).issubset(df_final.columns):
+        return None
+    capital = _numeric_block(df_final, [c for c, _ in pares])
+    fpd = _numeric_block(df_final, [f for _, f in pares])
+    validos = ~(np.isnan(capital) | np.isnan(fpd))
+    pesos = [f"__w{i}" for i in range(len(pares))]
+    productos = [f"__p{i}" for i in range(len(pares))]
+    base = pd.concat([
+        df_final[keys].reset_index(drop=True),
+        pd.DataFrame(np.where(validos, capital, 0.0), columns=pesos),
+        pd.DataFrame(np.where(validos, capital * fpd, 0.0), columns=productos),
+    ], axis=1)
+    sumas = sum_by(base, keys, pesos + productos)
+    return ratio_columns(sumas, productos, pesos, [f for _, f in pares]).drop(columns=pesos + productos)
+
+
+def trend_table(df_sucursal: pd.DataFrame, df_final: pd.DataFrame | None = None, **opciones) -> pd.DataFrame:
+    """
+    Tendencias por sucursal del ICV (desde df_sucursal) y, si hay datos a nivel
+    fila, del % FPD ponderado por capital. `opciones` va a `compute_trends`.
+    """
+    tendencias = compute_trends(df_sucursal, [c for c in ICV_COLS if c in df_sucursal.columns], "ICV", **opciones)
+    fpd = fpd_by_sucursal(df_final) if df_final is not None else None
+    if fpd is not None:
+        tendencias_fpd = compute_trends(fpd, [c for c in FPD_COLS if c in fpd.columns], "FPD", **opciones)
+        tendencias = tendencias.merge(tendencias_fpd, on=["Región", "Zona", "Sucursal"], how="left")
+    return tendencias
+
+
+# ======================= ESCENARIOS =========================
+def parse_rates(texto: str) -> np.ndarray:
+    """Tasas anuales desde "0.55,0.65,0.75" o "inicio:fin:paso" (fin incluido)."""
+    if ":" in texto:
+        inicio, fin, paso = (float(x) for x in texto.split(":"))
+        if paso <= 0 or fin < inicio:
+            raise ValueError(f"Rango de tasas inválido '{texto}': se espera inicio ≤ fin y paso positivo.")
+        tasas = np.round(np.arange(inicio, fin + paso / 2, paso), 10)
     else:
-        print("(No existe columna 'Vendedor' en tu archivo.)")
-
-    df_filtrado = df.loc[~filtro].copy()
-    print(f"🔧 Se limpiaron {int(filtro.sum())} filas con todos los saldos 0/NaN.")
-
-    # ---------- Reglas Capital–FPD ----------
-    capital_cols = [
-        "Capital Dispersado Actual", "Capital Dispersado T-01", "Capital Dispersado T-02",
-        "Capital Dispersado T-03", "Capital Dispersado T-04", "Capital Dispersado T-05",
-        "Capital Dispersado T-06", "Capital Dispersado T-07", "Capital Dispersado T-08",
-        "Capital Dispersado T-09", "Capital Dispersado T-10", "Capital Dispersado T-11",
-        "Capital Dispersado T-12"
-    ]
-    fpd_cols = [
-        "% FPD Actual", "% FPD T-01", "% FPD T-02",
-        "% FPD T-03", "% FPD T-04", "% FPD T-05",
-        "% FPD T-06", "% FPD T-07", "% FPD T-08",
-        "% FPD T-09", "% FPD T-10", "% FPD T-11",
-        "% FPD T-12"
-    ]
-
-    for col in fpd_cols:
-        if col in df_filtrado.columns:
-            df_filtrado[col] = pd.to_numeric(df_filtrado[col], errors="coerce")
-
-    for cap_col, fpd_col in zip(capital_cols, fpd_cols):
-        if cap_col not in df_filtrado.columns or fpd_col not in df_filtrado.columns:
-            continue
-        mask_fill_zero = (df_filtrado[cap_col].fillna(0) != 0) & (df_filtrado[fpd_col].isna())
-        df_filtrado.loc[mask_fill_zero, fpd_col] = 0
-
-        mask_zero_to_nan = (df_filtrado[cap_col].fillna(0) == 0) & (df_filtrado[fpd_col].fillna(0) == 0)
-        df_filtrado.loc[mask_zero_to_nan, fpd_col] = np.nan
-
-    # ---------- Mapeo Región–Zona–Sucursal ----------
-    datos = [
-        # Brokers
-        ("Brokers", "Centro Metrópolis", "Centro Metrópolis"),
-        ("Brokers", "Conexión Magna", "Conexión Magna"),
-        ("Brokers", "Enlace Regio", "Enlace Regio"),
-        ("Brokers", "Puerto Magna", "Puerto Magna"),
-        ("Brokers", "Brokers", "Brokers"),
-
-        # Núcleo Uno
-        ("Núcleo Uno", "División. Red Mexiquense", "Ciudad Pirámide"),
-        ("Núcleo Uno", "División. Red Mexiquense", "Valle Verde"),
-        ("Núcleo Uno", "División. Red Mexiquense", "Río Blanco"),
-        ("Núcleo Uno", "División. Red Mexiquense", "Colina del Sol"),
-        ("Núcleo Uno", "División. Red Mexiquense", "Colina del Sol BIS"),
-        ("Núcleo Uno", "División. Red Mexiquense", "Parque Jurica"),
-        ("Núcleo Uno", "División. Red Mexiquense", "Colina Plateada"),
-        ("Núcleo Uno", "División. Red Mexiquense", "Altos de Querétaro"),
-        ("Núcleo Uno", "División. Red Mexiquense", "Sol y Campo"),
-        ("Núcleo Uno", "Conexión Naucalpan", "Satélite 1"),
-        ("Núcleo Uno", "Conexión Naucalpan", "Satélite 2"),
-        ("Núcleo Uno", "Conexión Naucalpan", "Satélite 3"),
-        ("Núcleo Uno", "Zona Sur Central", "Bahía Dorada"),
-        ("Núcleo Uno", "Zona Sur Central", "Costa Marquesa"),
-        ("Núcleo Uno", "Zona Sur Central", "Bahía Dorada BIS"),
-        ("Núcleo Uno", "Zona Sur Central", "Alto de Chilpan"),
-        ("Núcleo Uno", "Zona Sur Central", "Cuautla Vista"),
-        ("Núcleo Uno", "Zona Sur Central", "Jardines del Valle"),
-        ("Núcleo Uno", "Zona Sur Central", "Llanos de Igualdad"),
-        ("Núcleo Uno", "Zona Sur Central", "Parque Jojutla"),
-        ("Núcleo Uno", "Zona Oriente Valle", "Valle Chalco"),
-        ("Núcleo Uno", "Zona Oriente Valle", "Montaña Azul"),
-        ("Núcleo Uno", "Zona Oriente Valle", "Reyes Paz A"),
-        ("Núcleo Uno", "Zona Oriente Valle", "Reyes Paz B"),
-        ("Núcleo Uno", "Zona Oriente Valle", "Bosques Neza"),
-        ("Núcleo Uno", "Zona Oriente Valle", "Cumbre Neza"),
-        ("Núcleo Uno", "Zona Oriente Valle", "Cumbre Neza BIS"),
-        ("Núcleo Uno", "Zona Oriente Valle", "Riberas Texcoco"),
-        ("Núcleo Uno", "Zona Norte Valle", "Pinar del Valle"),
-        ("Núcleo Uno", "Zona Norte Valle", "Cielos de Metepec"),
-        ("Núcleo Uno", "Zona Norte Valle", "Lomas de Naucalpan"),
-        ("Núcleo Uno", "Zona Norte Valle", "Puente de Tlalne"),
-        ("Núcleo Uno", "Zona Norte Valle", "Puente de Tlalne II"),
-        ("Núcleo Uno", "Zona Norte Valle", "Valles Toluca"),
-        ("Núcleo Uno", "Zona Norte Valle", "Cumbre Toluca"),
-        ("Núcleo Uno", "Zona Norte Valle", "Bosques Tultitlán"),
-
-        # Núcleo Dos
-        ("Núcleo Dos", "División. Distrito Central", "Jardín Aragón A"),
-        ("Núcleo Dos", "División. Distrito Central", "Pilares del Norte"),
-        ("Núcleo Dos", "División. Distrito Central", "Pilares del Norte BIS"),
-        ("Núcleo Dos", "División. Distrito Central", "Residencia A"),
-        ("Núcleo Dos", "División. Distrito Central", "Residencia B"),
-        ("Núcleo Dos", "División. Distrito Central", "Colinas GAM"),
-        ("Núcleo Dos", "División. Distrito Central", "Plaza Central"),
-        ("Núcleo Dos", "División. Distrito Central", "Los Arcos"),
-        ("Núcleo Dos", "División. Distrito Central", "Los Arcos BIS"),
-        ("Núcleo Dos", "División. Distrito Central", "Campo Zaragoza"),
-        ("Núcleo Dos", "División. Distrito Central", "Lomas Zaragoza"),
-        ("Núcleo Dos", "División. Distrito Central", "Campo Zaragoza BIS"),
-        ("Núcleo Dos", "Núcleo Avance", "Avance 1"),
-        ("Núcleo Dos", "Núcleo Avance", "Avance 2"),
-        ("Núcleo Dos", "Núcleo Avance", "Avance 3"),
-        ("Núcleo Dos", "Núcleo Avance", "Avance 4"),
-        ("Núcleo Dos", "Zona Núcleo CDMX", "Parque Obregón"),
-        ("Núcleo Dos", "Zona Núcleo CDMX", "Centro Viejo"),
-        ("Núcleo Dos", "Zona Núcleo CDMX", "Mirador Tlalpan A"),
-        ("Núcleo Dos", "Zona Núcleo CDMX", "Mirador Tlalpan A BIS"),
-        ("Núcleo Dos", "Zona Núcleo CDMX", "Mirador Tlalpan B"),
-        ("Núcleo Dos", "Zona Núcleo CDMX", "Lagunas de Xochimilco"),
-        ("Núcleo Dos", "Zona Núcleo CDMX", "Plaza Zapata"),
-        ("Núcleo Dos", "Zona Oriente Conexión", "Robledal A"),
-        ("Núcleo Dos", "Zona Oriente Conexión", "Robledal B"),
-        ("Núcleo Dos", "Zona Oriente Conexión", "Campo Florido A"),
-        ("Núcleo Dos", "Zona Oriente Conexión", "Campo Florido B"),
-        ("Núcleo Dos", "Zona Oriente Conexión", "Campo Florido C"),
-        ("Núcleo Dos", "Zona Oriente Conexión", "Campo Florido D"),
-        ("Núcleo Dos", "Zona Oriente Conexión", "Riberas del Sur"),
-        ("Núcleo Dos", "Zona Cordillera Puebla", "Sierra Cordobesa"),
-        ("Núcleo Dos", "Zona Cordillera Puebla", "Valles de Orizaba"),
-        ("Núcleo Dos", "Zona Cordillera Puebla", "Alturas de Puebla"),
-        ("Núcleo Dos", "Zona Cordillera Puebla", "Jardines Manuel"),
-        ("Núcleo Dos", "Zona Cordillera Puebla", "Lomas Santiago"),
-        ("Núcleo Dos", "Zona Cordillera Puebla", "Alturas de Puebla BIS"),
-        ("Núcleo Dos", "Zona Cordillera Puebla", "Llanos Tehuacán"),
-        ("Núcleo Dos", "Zona Cordillera Puebla", "Bosques Tlaxcala"),
-        ("Núcleo Dos", "Zona Bahía Veracruz", "Colinas Mirón"),
-        ("Núcleo Dos", "Zona Bahía Veracruz", "Valle Rica"),
-        ("Núcleo Dos", "Zona Bahía Veracruz", "Puerto Bravo"),
-        ("Núcleo Dos", "Zona Bahía Veracruz", "Puerta Cuauhtémoc"),
-        ("Núcleo Dos", "Zona Bahía Veracruz", "Puerto Bravo BIS"),
-        ("Núcleo Dos", "Zona Bahía Veracruz", "Cumbres Xalapa"),
-        ("Núcleo Dos", "Zona Bahía Veracruz", "Lomas Xalapa"),
-
-        # Red Norteña
-        ("Red Norteña","División Red Norteña","Paso del Norte"),
-        ("Red Norteña","División Red Norteña","Río Bravo"),
-        ("Red Norteña","División Red Norteña","Aceros del Norte"),
-        ("Red Norteña","División Red Norteña","Aceros del Norte BIS"),
-        ("Red Norteña","División Red Norteña","Paso Nuevo"),
-        ("Red Norteña","División Red Norteña","Paso Nuevo BIS"),
-        ("Red Norteña","División Red Norteña","Piedras Altas"),
-        ("Red Norteña","División Red Norteña","Piedras Altas BIS"),
-        ("Red Norteña","División Red Norteña","Valles del Norte"),
-        ("Red Norteña","División Red Norteña","Laguna Norte"),
-        ("Red Norteña","División Red Norteña","Sabinas Sierra"),
-        ("Red Norteña","División Red Norteña","Campos Saltillo"),
-        ("Red Norteña","División Red Norteña","Centro Saltillo"),
-        ("Red Norteña","División Red Norteña","Centro Saltillo BIS"),
-        ("Red Norteña","División Red Norteña","Campos Saltillo BIS"),
-
-        ("Red Norteña", "Zona Sierra Norte", "Lomas de Álamos"),
-        ("Red Norteña", "Zona Sierra Norte", "Lomas de Álamos BIS"),
-        ("Red Norteña", "Zona Sierra Norte", "Valle Apodaca"),
-        ("Red Norteña", "Zona Sierra Norte", "Valle Apodaca BIS"),
-        ("Red Norteña", "Zona Sierra Norte", "Puente Lincoln"),
-        ("Red Norteña", "Zona Sierra Norte", "Cumbres Regias"),
-        ("Red Norteña", "Zona Sierra Norte", "Centro Regio"),
-        ("Red Norteña", "Zona Sierra Norte", "Bulevar Regio"),
-        ("Red Norteña", "Zona Sierra Norte", "San Nicolás Valle"),
-        ("Red Norteña", "Zona Sierra Norte", "San Nicolás Valle BIS"),
-        ("Red Norteña", "Zona Sierra Norte", "Sierra Santa"),
-
-        ("Red Norteña", "Zona Red frontera este", "Bosque Verde"),
-        ("Red Norteña", "Zona Red frontera este", "Palacio del Norte"),
-        ("Red Norteña", "Zona Red frontera este", "Palacio del Norte BIS"),
-        ("Red Norteña", "Zona Red frontera este", "Valle de Guadalupe"),
-        ("Red Norteña", "Zona Red frontera este", "Parque Madero"),
-        ("Red Norteña", "Zona Red frontera este", "Parque Madero BIS"),
-        ("Red Norteña", "Zona Red frontera este", "Expo Regia"),
-        ("Red Norteña", "Zona Red frontera este", "Desierto Norte"),
-        ("Red Norteña", "Zona Red frontera este", "Desierto Bravo"),
-        ("Red Norteña", "Zona Red frontera este", "Río Revolución"),
-        ("Red Norteña", "Zona Red frontera este", "Desierto Norte BIS"),
-
-        ("Red Norteña", "Zona Bahía del Sol", "Valle Real"),
-        ("Red Norteña", "Zona Bahía del Sol", "Victoria Alta"),
-        ("Red Norteña", "Zona Bahía del Sol", "Victoria Alta BIS"),
-        ("Red Norteña", "Zona Bahía del Sol", "Bahía Aeropuerto"),
-        ("Red Norteña", "Zona Bahía del Sol", "Plaza Tampico"),
-        ("Red Norteña", "Zona Bahía del Sol", "Colinas Tampico"),
-        ("Red Norteña", "Zona Bahía del Sol", "Colinas Tampico BIS"),
-        ("Red Norteña", "Zona Bahía del Sol", "Río Madero"),
-
-        # Red Noroeste
-        ("Red Noroeste","División Sierra del Desierto","Sierra Chihuahua"),
-        ("Red Noroeste","División Sierra del Desierto","Campus Sierra"),
-        ("Red Noroeste","División Sierra del Desierto","Victoria Sierra"),
-        ("Red Noroeste","División Sierra del Desierto","Victoria Sierra BIS"),
-        ("Red Noroeste","División Sierra del Desierto","Plaza Cuauhtémoc"),
-        ("Red Noroeste","División Sierra del Desierto","Juárez Norte"),
-        ("Red Noroeste","División Sierra del Desierto","Jardines del Norte"),
-        ("Red Noroeste","División Sierra del Desierto","Americas Plaza"),
-        ("Red Noroeste","División Sierra del Desierto","Americas Plaza BIS"),
-        ("Red Noroeste","División Sierra del Desierto","Patio Grande"),
-        ("Red Noroeste","División Sierra del Desierto","Colinas Jilotepec"),
-        ("Red Noroeste","División Sierra del Desierto","Parral Viejo"),
-        ("Red Noroeste","División Sierra del Desierto","División Sierra del Desierto"),
-        ("Red Noroeste","Zona Costa del Pacífico","Bahía Azul"),
-        ("Red Noroeste","Zona Costa del Pacífico","Bahía Azul BIS"),
-        ("Red Noroeste","Zona Costa del Pacífico","Plaza Pacifico"),
-        ("Red Noroeste","Zona Costa del Pacífico","Plaza Pacifico BIS"),
-        ("Red Noroeste","Zona Costa del Pacífico","Cabo Fuerte"),
-        ("Red Noroeste","Zona Costa del Pacífico","Valle Mexicali"),
-        ("Red Noroeste","Zona Costa del Pacífico","Norte Mexicali"),
-        ("Red Noroeste","Zona Costa del Pacífico","Valle Mexicali BIS"),
-        ("Red Noroeste","Zona Costa del Pacífico","Frontera Oeste"),
-        ("Red Noroeste","Zona Costa del Pacífico","Frontera Bravo"),
-        ("Red Noroeste","Zona Costa del Pacífico","Frontera Bravo BIS"),
-        ("Red Noroeste","Zona Costa del Pacífico","Zona Costa del Pacífico"),
-        ("Red Noroeste","Zona Valle Dorado","Valles de Culiacán"),
-        ("Red Noroeste","Zona Valle Dorado","Culiacán Norte"),
-        ("Red Noroeste","Zona Valle Dorado","Valles de Culiacán BIS"),
-        ("Red Noroeste","Zona Valle Dorado","Sierra Durango"),
-        ("Red Noroeste","Zona Valle Dorado","Durango Norte"),
-        ("Red Noroeste","Zona Valle Dorado","Valle del Río"),
-        ("Red Noroeste","Zona Valle Dorado","Plaza Mochis"),
-        ("Red Noroeste","Zona Valle Dorado","Plaza Mochis BIS"),
-        ("Red Noroeste","Zona Valle Dorado","Bahía Dorada"),
-        ("Red Noroeste","Zona Valle Dorado","Norte Dorado"),
-        ("Red Noroeste","Zona Valle Dorado","Zona Valle Dorado"),
-        ("Red Noroeste","Zona Desierto del Sol","Obregón Central"),
-        ("Red Noroeste","Zona Desierto del Sol","Obregón Norte"),
-        ("Red Noroeste","Zona Desierto del Sol","Obregón Central BIS"),
-        ("Red Noroeste","Zona Desierto del Sol","Sierra Hermosillo"),
-        ("Red Noroeste","Zona Desierto del Sol","Hermosillo Norte"),
-        ("Red Noroeste","Zona Desierto del Sol","Sierra Hermosillo BIS"),
-        ("Red Noroeste","Zona Desierto del Sol","Valle de Navojoa"),
-        ("Red Noroeste","Zona Desierto del Sol","Frontera Nogales"),
-        ("Red Noroeste","Zona Desierto del Sol","Zona Desierto del Sol"),
-
-        # Occidente Conexión
-        ("Occidente Conexión","Conexión GDL","Guadalajara Uno"),
-        ("Occidente Conexión","Conexión GDL","Guadalajara Dos"),
-        ("Occidente Conexión","Conexión GDL","Guadalajara Tres"),
-        ("Occidente Conexión","Conexión GDL","Conexión GDL"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","Aguas Central"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","Aguas Norte"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","Aguas Central BIS"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","Sierra Colima"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","Río Fresnillo"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","Bahía Manzanillo"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","San Luis Norte"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","San Luis Alturas"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","Cumbres Zacatecas"),
-        ("Occidente Conexión","Zona Corazón de la Sierra","Zona Corazón de la Sierra"),
-        ("Occidente Conexión","Zona Valles Centrales","Plaza Celaya"),
-        ("Occidente Conexión","Zona Valles Centrales","Hidalgo Valle"),
-        ("Occidente Conexión","Zona Valles Centrales","Jardines Irapuato"),
-        ("Occidente Conexión","Zona Valles Centrales","Jardines Irapuato BIS"),
-        ("Occidente Conexión","Zona Valles Centrales","Cañadas León"),
-        ("Occidente Conexión","Zona Valles Centrales","Norte León"),
-        ("Occidente Conexión","Zona Valles Centrales","Cañadas León BIS"),
-        ("Occidente Conexión","Zona Valles Centrales","Zona Valles Centrales"),
-        ("Occidente Conexión","Zona Tierra de lagos","Valle Piedad"),
-        ("Occidente Conexión","Zona Tierra de lagos","Bahía Lázaro"),
-        ("Occidente Conexión","Zona Tierra de lagos","Colinas Morelia"),
-        ("Occidente Conexión","Zona Tierra de lagos","Morelia Norte"),
-        ("Occidente Conexión","Zona Tierra de lagos","Morelia Norte BIS"),
-        ("Occidente Conexión","Zona Tierra de lagos","Camelinas Plaza"),
-        ("Occidente Conexión","Zona Tierra de lagos","Jardines Uruapan"),
-        ("Occidente Conexión","Zona Tierra de lagos","Valle Zamora"),
-        ("Occidente Conexión","Zona Tierra de lagos","Valle Zamora BIS"),
-        ("Occidente Conexión","Zona Tierra de lagos","Riviera Zihua"),
-        ("Occidente Conexión","Zona Tierra de lagos","Montes Zitácuaro"),
-        ("Occidente Conexión","Zona Tierra de lagos","Zona Tierra de lagos"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","GDL Central"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","Norte GDL"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","Riviera Vallarta"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","Riviera Vallarta BIS"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","Valle Tepic"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","Norte Tepic"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","Jardines Tlaque"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","Montes Tonalá"),
-        ("Occidente Conexión","Zona Cumbres del Pacífico","Zona Cumbres del Pacífico"),
-        ("Occidente Conexión","Zona Valles del Pacífico","Guzmán Valle"),
-        ("Occidente Conexión","Zona Valles del Pacífico","IMSS GDL"),
-        ("Occidente Conexión","Zona Valles del Pacífico","Oblatos Plaza"),
-        ("Occidente Conexión","Zona Valles del Pacífico","Las Águilas"),
-        ("Occidente Conexión","Zona Valles del Pacífico","Zapopan Plaza"),
-        ("Occidente Conexión","Zona Valles del Pacífico","Zona Valles del Pacífico"),
-
-        # Red Sureste
-        ("Red Sureste","Zona Selva Alta","Río Coatzacoalcos"),
-        ("Red Sureste","Zona Selva Alta","Valle Comitán"),
-        ("Red Sureste","Zona Selva Alta","Selva Tapachula"),
-        ("Red Sureste","Zona Selva Alta","Tuxtla Norte"),
-        ("Red Sureste","Zona Selva Alta","Tuxtla Central"),
-        ("Red Sureste","Zona Selva Alta","Villa Central"),
-        ("Red Sureste","Zona Selva Alta","Villa Norte"),
-        ("Red Sureste","Zona Selva Alta","Villa Norte BIS"),
-        ("Red Sureste","Zona Selva Alta","Villa Alturas"),
-        ("Red Sureste","Zona Selva Alta","Zona Selva Alta"),
-        ("Red Sureste","Zona Sierra Escondida","Sierra Oaxaca"),
-        ("Red Sureste","Zona Sierra Escondida","Riviera Escondida"),
-        ("Red Sureste","Zona Sierra Escondida","Bahía Cruz"),
-        ("Red Sureste","Zona Sierra Escondida","Bahía Cruz BIS"),
-        ("Red Sureste","Zona Sierra Escondida","Río Tuxtepec"),
-        ("Red Sureste","Zona Sierra Escondida","Zona Sierra Escondida"),
-        ("Red Sureste","Zona Riviera del Caribe","Bahía Campeche"),
-        ("Red Sureste","Zona Riviera del Caribe","Riviera Cancún"),
-        ("Red Sureste","Zona Riviera del Caribe","Bahía Chetumal"),
-        ("Red Sureste","Zona Riviera del Caribe","Isla del Carmen"),
-        ("Red Sureste","Zona Riviera del Caribe","Sierra Mérida"),
-        ("Red Sureste","Zona Riviera del Caribe","Mérida Norte"),
-        ("Red Sureste","Zona Riviera del Caribe","Alturas Mérida"),
-        ("Red Sureste","Zona Riviera del Caribe","Sierra Mérida BIS"),
-        ("Red Sureste","Zona Riviera del Caribe","Riviera Playa"),
-        ("Red Sureste","Zona Riviera del Caribe","Zona Riviera del Caribe"),
-    ]
-
-    df_mapa = pd.DataFrame(datos, columns=["Región", "Zona", "Sucursal"])
-    df_final = df_filtrado.merge(df_mapa, on="Sucursal", how="left")
-    cols = ["Región", "Zona", "Sucursal"] + [c for c in df_final.columns if c not in ["Región","Zona","Sucursal"]]
-    df_final = df_final[cols]
-
-    # ---------- Columnas calculadas ----------
-    tasainteresanual = 0.65 / 12
-    tasacostefondeo  = 0.11 / 12
-
-    if {"Saldo Insoluto Actual", "Saldo Insoluto Vencido Actual"}.issubset(df_final.columns):
-        df_final["SaldoInsolutoVigente"] = df_final["Saldo Insoluto Actual"] - df_final["Saldo Insoluto Vencido Actual"]
-        df_final["InteresGenerado"]      = df_final["SaldoInsolutoVigente"] * tasainteresanual
-        df_final["ServiciodeDeuda"]      = df_final["Saldo Insoluto Actual"] * tasacostefondeo
-
-    # ---------- Agrupar por Región/Zona/Sucursal ----------
-    cols_sumar = (
-        ["Saldo Insoluto Actual", "Saldo Insoluto Vencido Actual"]
-        + [f"Saldo Insoluto T-{i:02d}" for i in range(1,13)]
-        + [f"Saldo Insoluto Vencido T-{i:02d}" for i in range(1,13)]
+        tasas = np.array([float(x) for x in texto.split(",") if x.strip()])
+    if not len(tasas):
+        raise ValueError(f"No hay tasas en '{texto}'.")
+    return tasas
+
+
+def scenario_sweep(cubo: AggregationCube, tasas_interes=(TASA_INTERES_ANUAL,), tasas_fondeo=(TASA_FONDEO_ANUAL,),
+                   niveles=tuple(AggregationCube.NIVELES)) -> pd.DataFrame:
+    """
+    InteresGenerado y ServiciodeDeuda para todas las combinaciones de tasas anuales
+    (producto cartesiano) en cada nivel del cubo. Ambos son lineales en los saldos,
+    así que salen de los saldos ya sumados: un producto exterior (grupos × escenarios)
+    por nivel, sin recorrer las filas otra vez.
+    Devuelve formato largo: Nivel, llaves, Escenario, tasas, SaldoInsolutoVigente,
+    InteresGenerado y ServiciodeDeuda (llaves y Nivel como category).
+    """
+    ti, tf = np.meshgrid(np.atleast_1d(np.asarray(tasas_interes, dtype=float)),
+                         np.atleast_1d(np.asarray(tasas_fondeo, dtype=float)), indexing="ij")
+    ti, tf = ti.ravel(), tf.ravel()
+    n_esc = len(ti)
+    escenario = np.arange(n_esc, dtype=np.int32)
+
+    partes = []
+    for nivel in niveles:
+        keys = cubo.frame(nivel)[AggregationCube.NIVELES[nivel]]
+        saldo, vencido = cubo.values(nivel, ["Saldo Insoluto Actual", "Saldo Insoluto Vencido Actual"]).T
+        vigente = saldo - vencido
+        n_grupos = len(keys)
+
+        parte = keys.iloc[np.repeat(np.arange(n_grupos), n_esc)].reset_index(drop=True)
+        parte.insert(0, "Nivel", nivel)
+        parte["Escenario"] = np.tile(escenario, n_grupos)
+        parte["Tasa interés anual"] = np.tile(ti, n_grupos)
+        parte["Tasa fondeo anual"] = np.tile(tf, n_grupos)
+        parte["SaldoInsolutoVigente"] = np.repeat(vigente, n_esc)
+        parte["InteresGenerado"] = np.outer(vigente, ti / 12).ravel()  # (grupos × escenarios) en orden C
+        parte["ServiciodeDeuda"] = np.outer(saldo, tf / 12).ravel()
+        partes.append(parte)
+
+    escenarios = pd.concat(partes, ignore_index=True)
+    escenarios["Nivel"] = pd.Categorical(escenarios["Nivel"], categories=list(niveles))
+    for k in ["Región", "Zona", "Sucursal"]:
+        if k in escenarios.columns:
+            escenarios[k] = escenarios[k].astype("category")
+    return escenarios
+
+
+# ==================== MODO STREAMING ========================
+def aggregate_streaming(path, chunk_rows: int = 50_000, use_cache=True, cache_dir=CACHE_DIR,
+                        jerarquia: HierarchyIndex | None = None, verbose=True):
+    """
+    Mismo cálculo que el camino en memoria pero bloque a bloque:
+    filtro de saldos en 0, reglas Capital–FPD, mapeo Región/Zona y suma por
+    sucursal acumulada de forma incremental. La memoria pico depende de
+    `chunk_rows`, no del tamaño del archivo.
+
+    Si existe la caché Parquet del Excel se lee de ahí (por row groups).
+    Devuelve (df_sucursal, resumen) con filas leídas/descartadas, celdas cambiadas
+    por regla Capital–FPD, sucursales sin mapeo, suma total de 'Saldo Insoluto Actual' y el TOP 15 por
+    ServiciodeDeuda a nivel fila.
+    """
+    path = Path(path)
+    source = path
+    if use_cache and _HAS_PYARROW and path.suffix.lower() in (".xlsx", ".xlsm"):
+        parquet_file, _ = _cache_paths(path, cache_dir)
+        if parquet_file.exists():
+            if verbose:
+                print(f"⚡ Streaming desde caché: {parquet_file}")
+            source = parquet_file
+
+    jerarquia = jerarquia or default_hierarchy()
+    keys = ["Región", "Zona", "Sucursal"]
+    sin_mapeo = set()
+    acumulado = None
+    top15 = None
+    filas = descartadas = offset = 0
+    reglas = {}
+    suma_insoluto = 0.0
+
+    for chunk in iter_chunks(source, chunk_rows, columns=PIPELINE_COLS):
+        filas += len(chunk)
+        filtro = zero_saldo_mask(chunk)
+        descartadas += int(filtro.sum())
+        chunk = chunk.loc[~filtro].copy()
+        for nombre, n in apply_capital_fpd_rules(chunk).items():
+            reglas[nombre] = reglas.get(nombre, 0) + n
+        sin_mapeo.update(jerarquia.unmapped(chunk["Sucursal"]))
+        chunk = add_calculated_columns(map_hierarchy(chunk, jerarquia))
+        chunk.index += offset
+        offset += len(chunk)
+
+        cols_sumar = [c for c in SUMA_COLS if c in chunk.columns]
+        parcial = chunk.groupby(keys, observed=True)[cols_sumar].sum()
+        acumulado = (parcial if acumulado is None
+                     else pd.concat([acumulado, parcial]).groupby(level=keys, observed=True).sum())
+
+        if "Saldo Insoluto Actual" in chunk.columns:
+            suma_insoluto += pd.to_numeric(chunk["Saldo Insoluto Actual"], errors="coerce").sum()
+        if "ServiciodeDeuda" in chunk.columns:
+            cand = chunk.nlargest(15, "ServiciodeDeuda")
+            top15 = cand if top15 is None else pd.concat([top15, cand]).nlargest(15, "ServiciodeDeuda")
+
+    if acumulado is None:
+        raise ValueError(f"El archivo '{path}' no tiene filas de datos.")
+
+    df_sucursal = acumulado.reset_index()
+    resumen = {
+        "filas": filas,
+        "descartadas": descartadas,
+        "suma_insoluto": suma_insoluto,
+        "reglas": reglas,
+        "sin_mapeo": sorted(sin_mapeo),
+        "top15": top15,
+    }
+    return df_sucursal, resumen
+
+
+# ===================== MOTOR POLARS =========================
+MOTORES = ("pandas", "polars")
+
+
+def _polars_conditions(pl):
+    """_CONDICIONES como expresiones Polars (null = vacío; nunca devuelven null)."""
+    return {
+        "nan":        lambda e: e.is_null(),
+        "cero":       lambda e: (e == 0).fill_null(False),
+        "no_cero":    lambda e: e.is_not_null() & (e != 0).fill_null(False),
+        "cero_o_nan": lambda e: e.is_null() | (e == 0).fill_null(False),
+    }
+
+
+def _polars_source(path: Path, use_cache=True, cache_dir=CACHE_DIR, verbose=True):
+    """LazyFrame de entrada: Parquet/CSV directo; Excel vía su caché Parquet (se crea si falta)."""
+    import polars as pl
+    suffix = path.suffix.lower()
+    if suffix == ".parquet":
+        return pl.scan_parquet(path)
+    if suffix == ".csv":
+        return pl.scan_csv(path, infer_schema_length=10_000)
+    if use_cache and _HAS_PYARROW:
+        parquet_file, _ = _cache_paths(path, cache_dir)
+        if not parquet_file.exists():
+            load(path, use_cache=True, cache_dir=cache_dir, verbose=verbose)
+        if parquet_file.exists():
+            if verbose:
+                print(f"⚡ Polars desde caché: {parquet_file}")
+            return pl.scan_parquet(parquet_file)
+    return pl.from_pandas(load(path, use_cache=use_cache, cache_dir=cache_dir, verbose=verbose)).lazy()
+
+
+def aggregate_polars(path, use_cache=True, cache_dir=CACHE_DIR, jerarquia: HierarchyIndex | None = None,
+                     verbose=True):
+    """
+    Mismo cálculo que el camino pandas (filtro de saldos, reglas Capital–FPD, mapeo,
+    suma por sucursal e ICV) como un plan lazy de Polars: multi-hilo, lee sólo las
+    columnas que usa (projection pushdown) y filtra al escanear (predicate pushdown).
+    Las reglas Capital–FPD sólo se cuentan: FPD no entra a las sumas.
+    Devuelve (df_sucursal con ICV, resumen) en pandas, con las mismas llaves que
+    `aggregate_streaming`; no hay df_final a nivel fila.
+    """
+    if not (_HAS_POLARS and _HAS_PYARROW):
+        raise ImportError("El motor Polars requiere polars y pyarrow (pip install polars pyarrow).")
+    import polars as pl
+
+    path = Path(path)
+    jerarquia = jerarquia or default_hierarchy()
+    keys = ["Región", "Zona", "Sucursal"]
+    fuente = _polars_source(path, use_cache, cache_dir, verbose)
+    presentes = set(fuente.collect_schema().names())
+    check_columns(presentes)
+    numericas = [c for c in PIPELINE_COLS if c in presentes and c not in ("Sucursal", "Vendedor")]
+    cols_sumar = [c for c in SUMA_COLS if c in presentes]
+
+    # Números como Float64 con NaN → null (así null es el único "vacío", como NaN en pandas)
+    lf = fuente.select(
+        pl.col("Sucursal").cast(pl.Utf8, strict=False),
+        *[pl.col(c).cast(pl.Float64, strict=False).fill_nan(None) for c in numericas],
     )
-    cols_sumar = [c for c in cols_sumar if c in df_final.columns]
 
-    df_sucursal = df_final.groupby(["Región", "Zona", "Sucursal"], as_index=False)[cols_sumar].sum()
+    # ---------- Filtro de saldos en 0/NaN ----------
+    vacio = pl.all_horizontal([pl.col(c).fill_null(0) == 0 for c in SALDO_COLS])
+    conteos = [pl.len().alias("filas"), vacio.sum().alias("descartadas")]
+    limpio = lf.filter(~vacio)
+
+    # ---------- Reglas Capital–FPD (sólo conteos, mismo orden que apply_rules) ----------
+    condiciones = _polars_conditions(pl)
+    por_regla = {nombre: [] for nombre, *_ in REGLAS_CAPITAL_FPD}
+    for ref, val in zip(CAPITAL_COLS, FPD_COLS):
+        if ref not in presentes or val not in presentes:
+            continue
+        r, v = pl.col(ref), pl.col(val)
+        for nombre, cond_ref, cond_val, nuevo in REGLAS_CAPITAL_FPD:
+            mask = condiciones[cond_ref](r) & condiciones[cond_val](v)
+            cambia = mask & v.is_not_null() if np.isnan(nuevo) else mask & (v != nuevo).fill_null(True)
+            por_regla[nombre].append(cambia.sum())
+            v = pl.when(mask).then(None if np.isnan(nuevo) else pl.lit(nuevo)).otherwise(v)
+    reglas_expr = [(pl.sum_horizontal(e) if e else pl.lit(0)).alias(nombre) for nombre, e in por_regla.items()]
 
-    print("\nVista rápida de df_sucursal:")
-    print(df_sucursal.head())
+    # ---------- Mapeo Región/Zona (join con la jerarquía, primera ocurrencia) ----------
+    mapa = pl.DataFrame({
+        "Sucursal": np.asarray(jerarquia.sucursales, dtype=object).astype(str),
+        "Región": np.asarray(jerarquia.region, dtype=object).astype(str),
+        "Zona": np.asarray(jerarquia.zona, dtype=object).astype(str),
+    }).lazy()
+    mapeado = limpio.join(mapa, on="Sucursal", how="left")
 
-    # ---------- ICV (manejo división por cero) ----------
-    if {"Saldo Insoluto Vencido Actual", "Saldo Insoluto Actual"}.issubset(df_sucursal.columns):
-        df_sucursal["ICV"] = safe_div(df_sucursal["Saldo Insoluto Vencido Actual"],
-                                      df_sucursal["Saldo Insoluto Actual"])
+    # ---------- Suma por sucursal + ICV ----------
+    icv = [pl.when(pl.col(d) != 0).then(pl.col(n) / pl.col(d)).otherwise(None).alias(o)
+           for n, d, o in zip(VENCIDO_PERIODO_COLS, SALDO_PERIODO_COLS, ICV_COLS)
+           if n in cols_sumar and d in cols_sumar]
+    por_sucursal = (mapeado
+                    .filter(pl.all_horizontal([pl.col(k).is_not_null() for k in keys]))
+                    .group_by(keys)
+                    .agg([pl.col(c).sum() for c in cols_sumar])
+                    .with_columns(icv))
 
-    for i in range(1, 13):
-        v = f"Saldo Insoluto Vencido T-{i:02d}"
-        s = f"Saldo Insoluto T-{i:02d}"
-        if {v, s}.issubset(df_sucursal.columns):
-            df_sucursal[f"ICV T-{i:02d}"] = safe_div(df_sucursal[v], df_sucursal[s])
+    # TOP 15 a nivel fila: ServiciodeDeuda es proporcional al saldo actual (empates: primera fila)
+    saldo = "Saldo Insoluto Actual"
+    top = (mapeado.with_row_index("_fila")
+           .filter(pl.col(saldo).is_not_null())
+           .top_k(15, by=[saldo, "_fila"], reverse=[False, True])
+           .select(keys + [saldo, "Saldo Insoluto Vencido Actual"] if "Saldo Insoluto Vencido Actual" in presentes
+                   else keys + [saldo]))
+    sin_mapeo = (limpio.select("Sucursal").unique()
+                 .join(mapa, on="Sucursal", how="anti")
+                 .filter(pl.col("Sucursal").is_not_null()))
 
-    # ---------- Análisis preliminar ----------
-    if "ServiciodeDeuda" in df_final.columns:
-        top15 = df_final.sort_values("ServiciodeDeuda", ascending=False).head(15)
-        print("\nTOP 15 por Servicio de Deuda:")
-        print(top15[["Sucursal","Región","Zona","ServiciodeDeuda"]])
+    totales, suma, df_pl, top_pl, sin_mapeo_pl = pl.collect_all([
+        lf.select(conteos),
+        limpio.select(pl.col(saldo).sum().alias("suma_insoluto"), *reglas_expr),
+        por_sucursal,
+        top,
+        sin_mapeo,
+    ])
+
+    df_sucursal = df_pl.to_pandas()
+    df_sucursal["Región"] = pd.Categorical(df_sucursal["Región"], dtype=jerarquia.region.dtype)
+    df_sucursal["Zona"] = pd.Categorical(df_sucursal["Zona"], dtype=jerarquia.zona.dtype)
+    df_sucursal["Sucursal"] = df_sucursal["Sucursal"].astype("category")
+    df_sucursal = df_sucursal.sort_values(keys, kind="stable", ignore_index=True)
+
+    top15 = add_calculated_columns(top_pl.to_pandas())
+    resumen = {
+        "filas": int(totales["filas"][0]),
+        "descartadas": int(totales["descartadas"][0]),
+        "suma_insoluto": float(suma["suma_insoluto"][0] or 0.0),
+        "reglas": {nombre: int(suma[nombre][0]) for nombre in por_regla},
+        "sin_mapeo": sorted(sin_mapeo_pl["Sucursal"].to_list()),
+        "top15": top15,
+    }
+    return df_sucursal, resumen
+
+
+def check_engines(path, rtol: float = 1e-9, **opciones) -> dict:
+    """
+    Prueba de equivalencia: corre `analyze` con ambos motores sobre `path` y compara
+    df_sucursal (valores, con tolerancia `rtol` por el orden de suma en paralelo),
+    filas descartadas y celdas cambiadas por regla. Devuelve {"ok", "diferencias"}.
+    """
+    pandas_r = analyze(path, motor="pandas", verbose=False, **opciones)
+    polars_r = analyze(path, motor="polars", verbose=False, **opciones)
+    diferencias = []
+    for clave in ("filas", "descartadas", "reglas"):
+        if pandas_r[clave] != polars_r[clave]:
+            diferencias.append(f"{clave}: pandas={pandas_r[clave]} polars={polars_r[clave]}")
+    try:
+        pd.testing.assert_frame_equal(pandas_r["df_sucursal"], polars_r["df_sucursal"], check_dtype=False,
+                                      check_categorical=False, rtol=rtol, atol=0.0)
+    except AssertionError as e:
+        diferencias.append(f"df_sucursal: {e}")
+    return {"ok": not diferencias, "diferencias": diferencias}
+
+
+# =================== MODO INCREMENTAL =======================
+def _shift_map(nuevos: list[str]) -> dict[str, str]:
+    """Columna del mes anterior que pasa a cada columna T-01..T-12 (T-01 <- Actual, T-k <- T-(k-1))."""
+    mapa = {}
+    for nombres in (SALDO_PERIODO_COLS, VENCIDO_PERIODO_COLS):
+        for anterior, nuevo in zip(nombres[:-1], nombres[1:]):
+            if nuevo in nuevos:
+                mapa[nuevo] = anterior
+    return mapa
+
+
+def _key_index(claves: pd.DataFrame) -> pd.MultiIndex:
+    """Región/Zona/Sucursal como MultiIndex de texto (comparable entre corridas)."""
+    return pd.MultiIndex.from_frame(claves[["Región", "Zona", "Sucursal"]].astype(str))
+
+
+def aggregate_incremental(df_final: pd.DataFrame, estado_dir=ESTADO_DIR, rtol: float = 1e-9):
+    """
+    Como `aggregate` pero reutilizando las sumas por sucursal del mes anterior.
+
+    Cada mes las columnas se recorren un periodo (T-01 = Actual anterior, ...).
+    Siempre se suman Actual y T-01; si la suma T-01 de una sucursal coincide
+    (`rtol`) con la Actual guardada el mes pasado, T-02..T-12 se toman
+    desplazando lo guardado en vez de sumarse. Las sucursales nuevas, las de
+    T-01 distinto y las que tienen filas que el filtro de saldos en cero pudo
+    dejar fuera el mes pasado (y traen historia) se suman completas.
+    Un cambio que no mueva la suma T-01 de la sucursal (corregir T-02..T-12,
+    o una fila que cambia de sucursal con T-01 en cero) no se detecta: en ese
+    caso correr sin --incremental (o borrar `estado_dir`) recalcula todo.
+    Guarda el resultado en `estado_dir` y devuelve (df_sucursal sin ICV, resumen).
+    """
+    keys = ["Región", "Zona", "Sucursal"]
+    estado_dir = Path(estado_dir)
+    estado_file = estado_dir / "estado.pkl"
+    cols_sumar = [c for c in SUMA_COLS if c in df_final.columns]
+    mapa = _shift_map(cols_sumar)
+    control = [c for c in ("Saldo Insoluto T-01", "Saldo Insoluto Vencido T-01") if c in cols_sumar]
+    siempre = [c for c in cols_sumar if c not in mapa] + control  # Actual + T-01
+
+    grupos = df_final.groupby(keys, observed=True, sort=True)
+    claves = grupos.size().index.to_frame(index=False)
+    n = len(claves)
+    codes = grupos.ngroup().to_numpy(dtype=float)
+    codes = np.where(np.isnan(codes), n, codes).astype(np.intp)  # llave nula -> grupo extra n
+
+    def _valores(c, filas=slice(None)):
+        """Columna `c` como float64 (NaN = vacío) en `filas`."""
+        return pd.to_numeric(df_final[c], errors="coerce").to_numpy(dtype=np.float64, na_value=np.nan)[filas]
+
+    def _sumar(c, filas=slice(None)):
+        pesos = np.nan_to_num(_valores(c, filas), nan=0.0)
+        return np.bincount(codes[filas], weights=pesos, minlength=n + 1)[:n]
+
+    sumas = {c: _sumar(c) for c in siempre}
+
+    anterior = pd.read_pickle(estado_file) if estado_file.exists() else None
+    desplazar = np.zeros(n, dtype=bool)
+    if anterior is not None and len(control) == 2 and set(mapa.values()) <= set(anterior.columns):
+        idx = _key_index(anterior).get_indexer(_key_index(claves))
+        desplazar = idx >= 0
+        for c in control:
+            previo = np.full(n, np.nan)
+            previo[desplazar] = anterior[mapa[c]].to_numpy(dtype=np.float64)[idx[desplazar]]
+            desplazar &= np.isclose(sumas[c], previo, rtol=rtol, atol=0.0)
+
+        # Filas que el filtro de saldos en cero pudo descartar el mes pasado (las SALDO_COLS
+        # de entonces son hoy esas columnas un periodo después): si traen historia en otros
+        # periodos no están en lo guardado, y su sucursal se suma completa.
+        no_cero = _CONDICIONES["no_cero"]
+        siguiente = {previa: nueva for nueva, previa in mapa.items()}
+        con_saldo = np.zeros(len(df_final), dtype=bool)
+        for c in SALDO_COLS:
+            if c in siguiente:
+                con_saldo |= no_cero(_valores(siguiente[c]))
+        candidatas = np.flatnonzero(~con_saldo)
+        con_historia = np.zeros(len(candidatas), dtype=bool)
+        for c in mapa:
+            con_historia |= no_cero(_valores(c, candidatas))
+        afectadas = codes[candidatas[con_historia]]
+        desplazar[afectadas[afectadas < n]] = False
+
+    recalcular = np.flatnonzero(~np.append(desplazar, True)[codes])  # filas que se suman completas
+    for c in cols_sumar:
+        if c in siempre:
+            continue
+        sumas[c] = _sumar(c, recalcular)
+        if desplazar.any():
+            sumas[c][desplazar] = anterior[mapa[c]].to_numpy(dtype=np.float64)[idx[desplazar]]
+    df_sucursal = pd.concat([claves, pd.DataFrame({c: sumas[c] for c in cols_sumar})], axis=1)
+
+    # Estado para el próximo mes
+    estado_dir.mkdir(parents=True, exist_ok=True)
+    df_sucursal.to_pickle(estado_file)
+
+    resumen = {
+        "desplazadas": int(desplazar.sum()),
+        "recalculadas": int((~desplazar).sum()),
+        "estado_previo": anterior is not None,
+        "estado": str(estado_file),
+    }
+    return df_sucursal, resumen
+
+
+# ======================== EXPORTACIÓN =======================
+EXPORT_FORMATOS = ("xlsx", "parquet", "feather", "csv")
+_EXT_COMPRESION_CSV = {"gzip": ".gz", "bz2": ".bz2", "zip": ".zip", "xz": ".xz", "zstd": ".zst"}
+
+
+def _write_xlsx(hojas: dict, ruta: Path) -> None:
+    """Todas las hojas en un solo xlsx; con xlsxwriter fila a fila en constant_memory."""
+    if not _HAS_XLSXWRITER:
+        with pd.ExcelWriter(ruta, engine="openpyxl") as writer:
+            for nombre, df in hojas.items():
+                df.to_excel(writer, sheet_name=nombre[:31], index=False)
+        return
+
+    import xlsxwriter
+    wb = xlsxwriter.Workbook(str(ruta), {
+        "constant_memory": True,
+        "nan_inf_to_errors": True,
+        "default_date_format": "yyyy-mm-dd",
+    })
+    try:
+        negrita = wb.add_format({"bold": True})
+        for nombre, df in hojas.items():
+            ws = wb.add_worksheet(nombre[:31])
+            ws.write_row(0, 0, [str(c) for c in df.columns], negrita)
+            # constant_memory exige escribir en orden de filas; bloques para no duplicar todo el frame
+            for inicio in range(0, len(df), 50_000):
+                bloque = df.iloc[inicio:inicio + 50_000].astype(object)
+                bloque = bloque.where(bloque.notna(), None)
+                for r, fila in enumerate(bloque.itertuples(index=False, name=None), start=inicio + 1):
+                    ws.write_row(r, 0, fila)
+    finally:
+        wb.close()
+
+
+def _write_columnar(df: pd.DataFrame, ruta: Path, formato: str, compresion: str | None) -> None:
+    if formato == "csv":
+        df.to_csv(ruta, index=False, compression=compresion)
+        return
+
+    escribir = (lambda d: d.to_parquet(ruta, index=False, compression=compresion or "snappy")) if formato == "parquet" \
+        else (lambda d: d.reset_index(drop=True).to_feather(ruta, compression=compresion))
+    try:
+        escribir(df)
+    except Exception:
+        # Columnas object con tipos mezclados (números y texto): se escriben como texto
+        mixtas = {c: "string" for c in df.columns if df[c].dtype == object}
+        escribir(df.astype(mixtas))
+
+
+def export(hojas: dict, ruta=EXPORT_EXCEL, formato: str | None = None, compresion: str | None = None) -> dict:
+    """
+    Exporta {nombre_hoja: DataFrame}.
+    - xlsx: todas las hojas en `ruta`.
+    - parquet/feather/csv: la primera hoja en `ruta` y las demás en `<ruta>_<hoja>`.
+    `formato` se deduce de la extensión si no se da; `compresion` va directo al writer
+    (parquet: snappy/zstd/gzip, feather: lz4/zstd, csv: gzip/bz2/zip/xz/zstd).
+    Devuelve archivos escritos, bytes totales y segundos.
+    """
+    ruta = Path(ruta)
+    formato = (formato or ruta.suffix.lstrip(".") or "xlsx").lower()
+    if formato not in EXPORT_FORMATOS:
+        raise ValueError(f"Formato de exportación no soportado: '{formato}' (opciones: {', '.join(EXPORT_FORMATOS)}).")
+    ext = f".{formato}"
+    if formato == "csv" and compresion:
+        ext += _EXT_COMPRESION_CSV.get(compresion, "")
+    base = ruta.with_suffix("")
+
+    t0 = time.perf_counter()
+    if formato == "xlsx":
+        archivos = [base.with_name(base.name + ext)]
+        _write_xlsx(hojas, archivos[0])
     else:
-        print("\n(No existe columna 'ServiciodeDeuda')")
-
-    if "Saldo Insoluto Actual" in df_final.columns:
-        suma_insoluto_stat = pd.to_numeric(df_final["Saldo Insoluto Actual"], errors="coerce").sum()
-        print(f"\nSuma total 'Saldo Insoluto Actual': ${suma_insoluto_stat:,.2f}\n")
-
-    # ---------- Gráfica tablero (Matplotlib -> navegador) ----------
-    if "ServiciodeDeuda" in df_final.columns:
-        aux = df_final.sort_values("ServiciodeDeuda", ascending=False).head(15)
-        fig, ax = plt.subplots(figsize=(10, 5))
-        ax.bar(aux["Sucursal"].astype(str), aux["ServiciodeDeuda"])
-        ax.set_title("Top 15 Sucursales por Servicio de Deuda")
-        ax.tick_params(axis="x", labelrotation=90, labelsize=8)
-        plt.tight_layout()
-        show_in_browser(fig)
-
-    # ---------- Boxplot ICV por Zona (Matplotlib -> navegador) ----------
-    if {"ICV", "Zona"}.issubset(df_sucursal.columns):
-        icv_series = pd.to_numeric(df_sucursal["ICV"], errors="coerce").replace([np.inf, -np.inf], np.nan)
-        p01, p99 = icv_series.quantile([0.01, 0.99])
-        df_clip = df_sucursal[(icv_series >= p01) & (icv_series <= p99)].copy()
-
-        fig, ax = plt.subplots(figsize=(12, 5))
-        df_clip.boxplot(column="ICV", by="Zona", showfliers=False, ax=ax)
-        ax.set_title("ICV por Zona (recortado p1–p99)")
-        plt.suptitle("")
-        ax.set_ylabel("ICV")
-        plt.xticks(rotation=45, ha="right")
-        plt.tight_layout()
-        show_in_browser(fig)
-
-    # ---------- Boxplot ICV por Región (Matplotlib -> navegador) ----------
-    if {"ICV", "Región"}.issubset(df_sucursal.columns):
-        icv_series = pd.to_numeric(df_sucursal["ICV"], errors="coerce").replace([np.inf, -np.inf], np.nan)
-        p01, p99 = icv_series.quantile([0.01, 0.99])
-        df_clip = df_sucursal[(icv_series >= p01) & (icv_series <= p99)].copy()
-
-        fig, ax = plt.subplots(figsize=(12, 5))
-        df_clip.boxplot(column="ICV", by="Región", showfliers=False, ax=ax)
-        ax.set_title("ICV por Región (recortado p1–p99)")
-        plt.suptitle("")
-        ax.set_ylabel("ICV")
-        plt.xticks(rotation=45, ha="right")
-        plt.tight_layout()
-        show_in_browser(fig)
-
-    # ---------- Scatter 3D interactivo (Plotly -> navegador) ----------
+        archivos = []
+        for i, (nombre, df) in enumerate(hojas.items()):
+            destino = base.with_name(base.name + ext if i == 0 else f"{base.name}_{nombre}{ext}")
+            _write_columnar(df, destino, formato, compresion)
+            archivos.append(destino)
+
+    return {
+        "archivos": archivos,
+        "bytes": sum(a.stat().st_size for a in archivos),
+        "segundos": time.perf_counter() - t0,
+    }
+
+
+# ======================== PERFILADO =========================
+ETAPAS = ("carga", "esquema", "filtro", "reglas", "mapeo", "columnas", "agregado", "streaming", "polars",
+          "cubo", "icv", "resumen", "tendencias", "escenarios", "graficas", "export", "lote")
+
+
+def _rss_peak_mb() -> float | None:
+    """Pico de memoria residente del proceso en MB (None si el SO no lo expone)."""
+    if resource is None:
+        return None
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(pico / 1e6 if sys.platform == "darwin" else pico / 1024, 1)  # macOS: bytes, Linux: KB
+
+
+class StageProfiler:
+    """
+    Mide cada etapa del pipeline: tiempo de pared, CPU, pico de RSS del proceso,
+    delta y pico de tracemalloc (sólo con `memoria=True`, tiene costo) y
+    filas/columnas del resultado. Con `cprofile_stage` guarda un volcado cProfile
+    de esa etapa en `<prefijo>.<etapa>.prof`.
+    """
+
+    def __init__(self, prefijo=Path(EXPORT_EXCEL).with_suffix(""), memoria: bool = False,
+                 cprofile_stage: str | None = None):
+        self.prefijo = Path(prefijo)
+        self.memoria = memoria
+        self.cprofile_stage = cprofile_stage
+        self.etapas = []
+        self._actual = None
+        if memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, nombre: str):
+        registro = {"etapa": nombre}
+        self._actual = registro
+        if self.memoria:
+            tracemalloc.reset_peak()
+            mem0 = tracemalloc.get_traced_memory()[0]
+        perfil = cProfile.Profile() if nombre == self.cprofile_stage else None
+        t0, c0 = time.perf_counter(), time.process_time()
+        if perfil is not None:
+            perfil.enable()
+        try:
+            yield registro
+        finally:
+            if perfil is not None:
+                perfil.disable()
+                ruta = self.prefijo.with_name(f"{self.prefijo.name}.{nombre}.prof")
+                perfil.dump_stats(ruta)
+                registro["cprofile"] = str(ruta)
+            registro["wall_s"] = round(time.perf_counter() - t0, 4)
+            registro["cpu_s"] = round(time.process_time() - c0, 4)
+            registro["rss_pico_mb"] = _rss_peak_mb()
+            if self.memoria:
+                actual, pico = tracemalloc.get_traced_memory()
+                registro["tracemalloc_delta_mb"] = round((actual - mem0) / 1e6, 3)
+                registro["tracemalloc_pico_mb"] = round((pico - mem0) / 1e6, 3)
+            self.etapas.append(registro)
+            self._actual = None
+
+    def track(self, df):
+        """Anota filas/columnas de `df` en la etapa en curso y lo devuelve."""
+        if self._actual is not None and df is not None:
+            self._actual["filas"], self._actual["columnas"] = df.shape
+        return df
+
+    def summary(self) -> str:
+        lineas = [f"{'etapa':<10} {'pared s':>8} {'CPU s':>8} {'RSS MB':>8} {'filas':>10}"]
+        for e in self.etapas:
+            rss = f"{e['rss_pico_mb']:>8.1f}" if e.get("rss_pico_mb") is not None else f"{'-':>8}"
+            filas = f"{e['filas']:>10,}" if "filas" in e else f"{'-':>10}"
+            lineas.append(f"{e['etapa']:<10} {e['wall_s']:>8.2f} {e['cpu_s']:>8.2f} {rss} {filas}")
+        return "\n".join(lineas)
+
+    def report(self, **extra) -> Path:
+        """Escribe `<prefijo>.perfil.json` con todas las etapas y devuelve la ruta."""
+        ruta = self.prefijo.with_name(f"{self.prefijo.name}.perfil.json")
+        datos = {
+            **extra,
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "total_wall_s": round(sum(e["wall_s"] for e in self.etapas), 4),
+            "etapas": self.etapas,
+        }
+        ruta.write_text(json.dumps(datos, ensure_ascii=False, indent=2, default=str), encoding="utf-8")
+        return ruta
+
+
+# ======================== MODO LOTE =========================
+LOTE_EXTENSIONES = (".xlsx", ".xlsm", ".xls")
+
+
+def batch_files(patron) -> list[Path]:
+    """Archivos del lote: una carpeta (todos los libros soportados) o un glob ("historico/*.xlsx")."""
+    carpeta = Path(patron)
+    if carpeta.is_dir():
+        candidatos = carpeta.iterdir()
+    else:
+        candidatos = (Path(p) for p in glob.glob(str(patron)))
+    return sorted(p for p in candidatos
+                  if p.is_file() and p.suffix.lower() in LOTE_EXTENSIONES and not p.name.startswith("~$"))
+
+
+def _periodo_archivo(path: Path) -> pd.Timestamp:
+    """
+    Fecha de corte del archivo: YYYYMMDD o YYMMDD en el nombre
+    (…250811.xlsx → 2025-08-11); si no trae fecha, la de modificación.
+    """
+    for digitos in re.findall(r"(?<!\d)(\d{8}|\d{6})(?!\d)", path.stem):
+        fecha = pd.to_datetime(digitos, format="%Y%m%d" if len(digitos) == 8 else "%y%m%d", errors="coerce")
+        if pd.notna(fecha):
+            return fecha
+    return pd.Timestamp(path.stat().st_mtime, unit="s").normalize()
+
+
+def _batch_task(path: str, opciones: dict) -> dict:
+    """Trabajador del lote: corre `analyze` sobre un archivo y devuelve sólo df_sucursal (con ICV)."""
+    t0 = time.perf_counter()
+    r = analyze(path, verbose=False, **opciones)
+    return {
+        "df_sucursal": r["df_sucursal"],
+        "filas": r["filas"],
+        "descartadas": r["descartadas"],
+        "segundos": time.perf_counter() - t0,
+        "rss_pico_mb": _rss_peak_mb(),
+    }
+
+
+def run_batch(archivos, workers: int | None = None, **opciones) -> tuple[pd.DataFrame, dict]:
+    """
+    Analiza cada archivo en un pool de procesos y consolida los df_sucursal
+    en un solo DataFrame indexado por Periodo (fecha de corte), con la columna Archivo.
+    - `workers`: procesos simultáneos (default: min(4, CPUs); 1 = en serie).
+      Cada proceso atiende un solo archivo y se recicla, así la memoria de un
+      libro no se acumula en el siguiente; con `streaming=True` además cada
+      proceso lee por bloques.
+    - Un archivo que falla (o cuyo proceso muere) no detiene a los demás.
+    `opciones` va directo a `analyze` (jerarquia, use_cache, streaming, chunk_rows, columns,
+    tolerancia_monto, motor, tasas); un .xls con `streaming=True` se carga completo.
+    Devuelve (consolidado, resumen) con fallidos, filas y throughput.
+    """
+    archivos = [Path(a) for a in archivos]
+    workers = workers or min(4, os.cpu_count() or 1)
+    t0 = time.perf_counter()
+    resultados, fallidos = {}, {}
+
+    if workers == 1:
+        for archivo in archivos:
+            try:
+                resultados[archivo] = _batch_task(str(archivo), opciones)
+            except Exception as e:
+                fallidos[archivo] = f"{type(e).__name__}: {e}"
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(archivos) or 1), max_tasks_per_child=1) as pool:
+            futuros = {pool.submit(_batch_task, str(archivo), opciones): archivo for archivo in archivos}
+            for fut in as_completed(futuros):
+                archivo = futuros[fut]
+                try:
+                    resultados[archivo] = fut.result()
+                except Exception as e:
+                    fallidos[archivo] = f"{type(e).__name__}: {e}"
+
+    partes = []
+    for archivo in archivos:  # orden de entrada, no de terminación
+        if archivo in resultados:
+            parte = resultados[archivo]["df_sucursal"]
+            parte.insert(0, "Archivo", archivo.name)
+            parte.insert(0, "Periodo", _periodo_archivo(archivo))
+            partes.append(parte)
+    if partes:
+        consolidado = pd.concat(partes, ignore_index=True).set_index("Periodo").sort_index(kind="stable")
+    else:
+        consolidado = pd.DataFrame(index=pd.DatetimeIndex([], name="Periodo"))
+
+    segundos = time.perf_counter() - t0
+    filas = sum(r["filas"] for r in resultados.values())
+    resumen = {
+        "archivos": len(archivos),
+        "ok": len(resultados),
+        "fallidos": {str(a): e for a, e in fallidos.items()},
+        "filas": filas,
+        "segundos": round(segundos, 2),
+        "filas_por_s": round(filas / segundos, 1) if segundos else None,
+        "archivos_por_min": round(len(resultados) * 60 / segundos, 2) if segundos else None,
+        "rss_pico_trabajador_mb": max((r["rss_pico_mb"] or 0 for r in resultados.values()), default=None),
+        "por_archivo": {str(a): {"filas": r["filas"], "segundos": round(r["segundos"], 2)}
+                        for a, r in resultados.items()},
+    }
+    return consolidado, resumen
+
+
+# ====================== MODO SERVICIO =======================
+# pyplot guarda la figura actual en estado global: los hilos del servidor grafican de a uno
+_PYPLOT_LOCK = threading.Lock()
+
+
+class AnalysisService:
+    """
+    Resultado de `analyze` residente en memoria para consultas repetidas.
+    Un hilo vigila el mtime del archivo y, si cambia, recalcula en segundo plano
+    y reemplaza el resultado de golpe (las consultas en curso siguen con el anterior).
+    Las respuestas se memorizan en un LRU de `max_cache` entradas que se vacía al refrescar.
+    """
+
+    def __init__(self, path=EXCEL_FILE, intervalo: float = 2.0, max_cache: int = 128, **opciones):
+        self.path = Path(path)
+        self.intervalo = intervalo
+        self.max_cache = max_cache
+        self.opciones = {"verbose": False, **opciones}
+        self.tasas = {k: opciones[k] for k in ("tasa_interes", "tasa_fondeo") if k in opciones}
+        self._lock = threading.Lock()
+        self._cache: OrderedDict = OrderedDict()
+        self._stop = threading.Event()
+        self.aciertos = self.fallos = 0
+        self._visto = self._fallido = None
+        self._load()
+
+    def _load(self):
+        """Corre el análisis y reemplaza el estado (el cálculo va fuera del candado)."""
+        mtime = self.path.stat().st_mtime_ns
+        t0 = time.perf_counter()
+        resultado = analyze(self.path, **self.opciones)
+        estado = {
+            "resultado": resultado,
+            "tendencias": trend_table(resultado["df_sucursal"], resultado["df_final"]),
+            "mtime": mtime,
+            "cargado": datetime.now().isoformat(timespec="seconds"),
+            "segundos": round(time.perf_counter() - t0, 3),
+        }
+        with self._lock:
+            self._estado = estado
+            self._cache.clear()
+
+    def refresh_if_changed(self, estable: bool = False) -> bool:
+        """
+        Recalcula si el archivo cambió desde la última carga; True si refrescó.
+        Con `estable=True` espera a que el mtime no cambie entre dos revisiones
+        (el archivo se sigue escribiendo) y no reintenta una versión que ya falló.
+        """
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return False
+        visto, self._visto = self._visto, mtime
+        if mtime == self._estado["mtime"] or (estable and (mtime != visto or mtime == self._fallido)):
+            return False
+        try:
+            self._load()
+        except Exception:
+            self._fallido = mtime
+            raise
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.intervalo):
+            try:
+                if self.refresh_if_changed(estable=True):
+                    print(f"♻️ {self.path.name} cambió: datos recargados en {self._estado['segundos']:.2f} s")
+            except Exception as e:
+                print(f"[Aviso] No se pudo recargar {self.path.name}; sigo con los datos anteriores. Detalle: {e}")
+
+    def start_watching(self) -> threading.Thread:
+        hilo = threading.Thread(target=self._watch, name="vigilancia", daemon=True)
+        hilo.start()
+        return hilo
+
+    def stop(self):
+        self._stop.set()
+
+    # ---------- consultas ----------
+    def query(self, ruta: str, params: dict) -> tuple[str, bytes]:
+        """(content-type, cuerpo) de la consulta, memorizado por (ruta, parámetros); /estado no se memoriza."""
+        clave = (ruta, tuple(sorted(params.items())))
+        with self._lock:
+            estado = self._estado
+            if ruta == "/estado":
+                return _json_response({
+                    "archivo": str(self.path), "cargado": estado["cargado"], "segundos": estado["segundos"],
+                    "filas": estado["resultado"]["filas"], "descartadas": estado["resultado"]["descartadas"],
+                    "sucursales": len(estado["resultado"]["df_sucursal"]), "cache": len(self._cache),
+                    "aciertos": self.aciertos, "fallos": self.fallos,
+                })
+            if clave in self._cache:
+                self._cache.move_to_end(clave)
+                self.aciertos += 1
+                return self._cache[clave]
+        respuesta = self._answer(estado, ruta, params)
+        with self._lock:
+            self.fallos += 1
+            if self._estado is estado:  # no guardar respuestas de datos ya reemplazados
+                self._cache[clave] = respuesta
+                while len(self._cache) > self.max_cache:
+                    self._cache.popitem(last=False)
+        return respuesta
+
+    def _answer(self, estado: dict, ruta: str, params: dict) -> tuple[str, bytes]:
+        resultado = estado["resultado"]
+        df_sucursal = resultado["df_sucursal"]
+        cubo = resultado["cubo"]
+        nivel = params.get("nivel", "Sucursal")
+        if nivel not in AggregationCube.NIVELES:
+            raise KeyError(f"nivel debe ser uno de {list(AggregationCube.NIVELES)}")
+
+        if ruta == "/agregados":
+            filtros = {k: v for k, v in params.items() if k in ("Región", "Zona", "Sucursal")}
+            return _frame_response(cubo.frame(nivel, icv=True, **filtros))
+        if ruta == "/top":
+            por = params.get("por")
+            return _frame_response(rank_sucursales(df_sucursal, _count_param(params, "n", 15), by=por, **self.tasas))
+        if ruta == "/icv":
+            periodo = params.get("periodo", "Actual")
+            if periodo not in PERIODOS:
+                raise KeyError(f"periodo debe ser uno de {PERIODOS}")
+            col = "ICV" if periodo == "Actual" else f"ICV {periodo}"
+            tabla = cubo.frame(nivel, icv=True)
+            return _frame_response(tabla[list(AggregationCube.NIVELES[nivel]) + [col]])
+        if ruta == "/tendencias":
+            return _frame_response(estado["tendencias"])
+        if ruta == "/escenarios":
+            return _frame_response(scenario_sweep(
+                cubo,
+                parse_rates(params.get("interes", str(self.tasas.get("tasa_interes", TASA_INTERES_ANUAL)))),
+                parse_rates(params.get("fondeo", str(self.tasas.get("tasa_fondeo", TASA_FONDEO_ANUAL)))),
+                niveles=(nivel,),
+            ))
+        if ruta.startswith("/grafica/"):
+            return "image/png", self._chart(estado, ruta.removeprefix("/grafica/").removesuffix(".png"), params)
+        raise FileNotFoundError(ruta)
+
+    def _chart(self, estado: dict, nombre: str, params: dict) -> bytes:
+        """PNG de una de las gráficas de resumen (top, boxplot_Zona, boxplot_Región, tendencia_ICV)."""
+        import matplotlib
+        matplotlib.use("Agg")
+        import matplotlib.pyplot as plt
+
+        # Datos de la figura fuera del candado; sólo pyplot (estado global) va serializado
+        df_sucursal = estado["resultado"]["df_sucursal"]
+        if nombre == "top":
+            top15 = rank_sucursales(df_sucursal, _count_param(params, "n", 15), **self.tasas)
+            if top15 is None:
+                raise FileNotFoundError("top (el agregado no trae los saldos Actual)")
+            funcion, kwargs = plot_top15, {"top15": top15}
+        elif nombre in ("boxplot_Zona", "boxplot_Región"):
+            by = nombre.removeprefix("boxplot_")
+            funcion, kwargs = plot_icv_boxplot, {"cajas": SummaryStats(df_sucursal).box_stats("ICV", by), "by": by}
+        elif nombre == "tendencia_ICV":
+            tendencias = estado["tendencias"]
+            col_pendiente = next(c for c in tendencias.columns if c.startswith("ICV pendiente"))
+            peores = tendencias[tendencias["ICV deterioro"]].nlargest(_count_param(params, "n", 10), col_pendiente)
+            filas = df_sucursal[df_sucursal["Sucursal"].isin(peores["Sucursal"])]
+            cols_icv = [c for c in ICV_COLS if c in df_sucursal.columns]
+            trayectorias = pd.DataFrame(period_matrix(filas, cols_icv), index=filas["Sucursal"].astype(str),
+                                        columns=[c.replace("ICV", "").strip() or "Actual" for c in cols_icv][::-1])
+            funcion, kwargs = plot_icv_trends, {"trayectorias": trayectorias}
+        else:
+            raise FileNotFoundError(nombre)
+
+        buf = io.BytesIO()
+        with _PYPLOT_LOCK:
+            fig = funcion(**kwargs)
+            try:
+                fig.savefig(buf, format="png", dpi=110, bbox_inches="tight")
+            finally:
+                plt.close(fig)
+        return buf.getvalue()
+
+
+def _json_response(datos) -> tuple[str, bytes]:
+    return "application/json; charset=utf-8", json.dumps(datos, ensure_ascii=False, default=str).encode("utf-8")
+
+
+def _frame_response(tabla: pd.DataFrame | None) -> tuple[str, bytes]:
+    if tabla is None:
+        return _json_response([])
+    return "application/json; charset=utf-8", tabla.to_json(orient="records", force_ascii=False).encode("utf-8")
+
+
+def _count_param(params: dict, nombre: str, default: int) -> int:
+    """Parámetro entero ≥ 1 de la consulta (ValueError si no lo es → 400)."""
+    n = int(params.get(nombre, default))
+    if n < 1:
+        raise ValueError(f"{nombre} debe ser ≥ 1 (llegó {n})")
+    return n
+
+
+def serve(servicio: AnalysisService, puerto: int = SERVICIO_PUERTO, host: str = "127.0.0.1"):
+    """
+    Atiende HTTP en host:puerto (sólo localhost por defecto) hasta Ctrl+C.
+    GET /estado, /agregados?nivel=Zona[&Región=…], /top?n=15[&por=Región],
+    /icv?periodo=T-03&nivel=Región, /tendencias, /escenarios?interes=0.5:0.8:0.05&fondeo=0.11&nivel=Zona,
+    /grafica/{top,boxplot_Zona,boxplot_Región,tendencia_ICV}.png
+    """
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            # http.server decodifica la línea de la petición como latin-1; acentos sin %-escapar vienen en UTF-8
+            url = urlparse(self.path.encode("latin-1").decode("utf-8", errors="replace"))
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            try:
+                tipo, cuerpo = servicio.query(unquote(url.path).rstrip("/") or "/estado", params)
+                codigo = 200
+            except FileNotFoundError as e:
+                tipo, cuerpo = _json_response({"error": f"no existe: {e}"})
+                codigo = 404
+            except (KeyError, ValueError) as e:
+                tipo, cuerpo = _json_response({"error": str(e)})
+                codigo = 400
+            self.send_response(codigo)
+            self.send_header("Content-Type", tipo)
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, formato, *args):  # sin una línea por petición en la consola
+            pass
+
+    servidor = ThreadingHTTPServer((host, puerto), _Handler)
+    servicio.start_watching()
+    print(f"🌐 Sirviendo {servicio.path.name} en http://{host}:{servidor.server_address[1]}/ (Ctrl+C para salir)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servicio.stop()
+        servidor.server_close()
+
+
+# ========================= MAIN =============================
+def _rates_arg(texto: str) -> np.ndarray:
+    """`parse_rates` para argparse: el error sale como mensaje de uso, no como traza."""
+    try:
+        return parse_rates(texto)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e)) from None
+
+
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Análisis de sucursales (ICV, Servicio de Deuda, gráficos).")
+    parser.add_argument("--sin-cache", action="store_true",
+                        help="Leer el Excel directo con pd.read_excel, sin usar ni escribir la caché.")
+    parser.add_argument("--refrescar-cache", action="store_true",
+                        help="Regenerar la caché columnar aunque el Excel no haya cambiado.")
+    parser.add_argument("--solo-columnas", action="store_true",
+                        help="Cargar sólo las columnas que usa el cálculo (el Excel exportado llevará sólo esas).")
+    parser.add_argument("--tolerancia-montos", type=float, default=0.0, metavar="PESOS",
+                        help="Opcional: guardar un monto en float32 si ningún valor cambia más de esto "
+                             "(default: 0 = sólo si es exacto, casi nunca con centavos; 0.005 conserva "
+                             "centavos y reduce esas columnas a la mitad).")
+    parser.add_argument("--motor", choices=MOTORES, default="pandas",
+                        help="Motor del cálculo: pandas (default) o polars (plan lazy multi-hilo; "
+                             "como --streaming, sin df_final a nivel fila).")
+    parser.add_argument("--verificar-motores", action="store_true",
+                        help="Correr ambos motores sobre EXCEL_FILE, comparar resultados y salir (código 1 si difieren).")
+    parser.add_argument("--sin-auditoria", action="store_true",
+                        help="No escribir <EXPORT_EXCEL>.auditoria.csv con las filas descartadas/marcadas.")
+    parser.add_argument("--streaming", action="store_true",
+                        help="Procesar el archivo por bloques de filas (memoria acotada). "
+                             "No hay df_final a nivel fila: se omiten los scatter 3D y se exporta df_sucursal.")
+    parser.add_argument("--chunk-filas", type=int, default=50_000,
+                        help="Filas por bloque en modo --streaming (default: 50000).")
+    parser.add_argument("--headless", action="store_true",
+                        help="Sin navegador: backend Agg; el dashboard y las figuras sólo se escriben a archivos.")
+    parser.add_argument("--salida-figuras", default=FIGURAS_DIR,
+                        help=f"Carpeta de las figuras (default: {FIGURAS_DIR}).")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Procesos para renderizar las figuras (default: núm. de CPUs) "
+                             "o para --lote (default: min(4, CPUs)); 1 = en serie.")
+    parser.add_argument("--top-n", type=int, default=15,
+                        help="Tamaño de los rankings por Servicio de Deuda (default: 15). La gráfica usa el "
+                             "ranking por sucursal; con --hojas-agregados se exporta también por Región y Zona.")
+    parser.add_argument("--max-puntos", type=int, default=SCATTER_MAX_PUNTOS,
+                        help=f"Máximo de puntos por scatter 3D, muestreados por Región; los atípicos > p99 "
+                             f"van todos si caben en el {SCATTER_CUOTA_ATIPICOS * 100:.0f}%% del máximo, si no se muestrean "
+                             f"(default: {SCATTER_MAX_PUNTOS}; 0 = todos).")
+    parser.add_argument("--densidad-3d", action="store_true",
+                        help="Agregar la vista de densidad 3D (conteo por celda, todas las filas).")
+    parser.add_argument("--formato", choices=EXPORT_FORMATOS, default=None,
+                        help="Formato de exportación (default: según la extensión de EXPORT_EXCEL).")
+    parser.add_argument("--compresion", default=None,
+                        help="Compresión para parquet/feather/csv (p.ej. zstd, snappy, gzip).")
+    parser.add_argument("--hojas-agregados", action="store_true",
+                        help="Exportar también df_sucursal, los agregados por Zona/Región/Total, "
+                             "los rankings y las tendencias ICV/FPD por sucursal.")
+    parser.add_argument("--perfil-memoria", action="store_true",
+                        help="Medir memoria por etapa con tracemalloc (más lento).")
+    parser.add_argument("--cprofile", choices=ETAPAS, metavar="ETAPA",
+                        help=f"Guardar un volcado cProfile de una etapa ({', '.join(ETAPAS)}).")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Reusar las sumas del mes anterior guardadas en --estado: de las sucursales cuyo "
+                             "T-01 coincide con el Actual guardado sólo se suman Actual y T-01 "
+                             "(no aplica con --streaming ni --motor polars).")
+    parser.add_argument("--estado", default=ESTADO_DIR,
+                        help=f"Carpeta del estado para --incremental (default: {ESTADO_DIR}).")
+    parser.add_argument("--jerarquia", metavar="CSV",
+                        help="CSV con columnas Región, Zona, Sucursal (default: JERARQUIA del script).")
+    parser.add_argument("--servir", type=int, nargs="?", const=SERVICIO_PUERTO, metavar="PUERTO",
+                        help=f"Servicio HTTP local (default: {SERVICIO_PUERTO}) con los datos en memoria; "
+                             "recarga sola si EXCEL_FILE cambia.")
+    parser.add_argument("--intervalo-vigilancia", type=float, default=2.0, metavar="SEG",
+                        help="Cada cuántos segundos revisa --servir si EXCEL_FILE cambió (default: 2).")
+    parser.add_argument("--tasa-interes", type=float, default=TASA_INTERES_ANUAL, metavar="TASA",
+                        help=f"Tasa de interés anual para InteresGenerado (default: {TASA_INTERES_ANUAL}).")
+    parser.add_argument("--tasa-fondeo", type=float, default=TASA_FONDEO_ANUAL, metavar="TASA",
+                        help=f"Tasa de fondeo anual para ServiciodeDeuda (default: {TASA_FONDEO_ANUAL}).")
+    parser.add_argument("--escenarios-interes", type=_rates_arg, metavar="LISTA|INICIO:FIN:PASO",
+                        help="Tasas de interés anuales a barrer, p.ej. 0.55,0.65 o 0.50:0.80:0.05. Con esta o "
+                             "--escenarios-fondeo se calcula el producto de escenarios por nivel y se exporta "
+                             "la hoja 'escenarios' en formato largo.")
+    parser.add_argument("--escenarios-fondeo", type=_rates_arg, metavar="LISTA|INICIO:FIN:PASO",
+                        help="Tasas de fondeo anuales a barrer (misma sintaxis).")
+    parser.add_argument("--lote", metavar="GLOB|CARPETA",
+                        help="Procesar varios libros (carpeta o glob) en paralelo y consolidar df_sucursal/ICV "
+                             "por periodo en <EXPORT_EXCEL>.lote.* (sin gráficas). Usa --motor, "
+                             "--tolerancia-montos y las tasas; no admite --escenarios-* ni --incremental.")
+    args = parser.parse_args(argv)
+    if args.lote:
+        sin_lote = [opcion for opcion, usada in (("--escenarios-interes", args.escenarios_interes is not None),
+                                                 ("--escenarios-fondeo", args.escenarios_fondeo is not None),
+                                                 ("--incremental", args.incremental)) if usada]
+        if sin_lote:
+            parser.error(f"--lote no admite {', '.join(sin_lote)}.")
+    return args
+
+
+def _run_plots(args, df_final, df_sucursal, top15, tablas: dict | None = None,
+               tendencias: pd.DataFrame | None = None):
+    """
+    Arma las figuras y las tablas en un solo dashboard HTML (<EXPORT_EXCEL>.dashboard.html)
+    y deja cada figura en --salida-figuras; sin --headless abre el dashboard en el navegador.
+    """
+    # ---------- Gráficas: (archivo, función, datos) ----------
+    figuras = []
+    if top15 is not None:
+        figuras.append(("top15_servicio_deuda.png", plot_top15, {"top15": top15}))
+    stats_sucursal = SummaryStats(df_sucursal)  # un solo orden del ICV para ambos boxplots
+    for by, archivo in (("Zona", "boxplot_ICV_por_Zona.png"), ("Región", "boxplot_ICV_por_Region.png")):
+        if {"ICV", by}.issubset(df_sucursal.columns):
+            figuras.append((archivo, plot_icv_boxplot, {"cajas": stats_sucursal.box_stats("ICV", by), "by": by}))
+
+    # ---------- Tendencia del ICV: las sucursales con mayor pendiente entre las marcadas ----------
+    if tendencias is not None and "ICV deterioro" in tendencias.columns:
+        col_pendiente = next(c for c in tendencias.columns if c.startswith("ICV pendiente"))
+        peores = tendencias[tendencias["ICV deterioro"]].nlargest(10, col_pendiente)["Sucursal"]
+        if len(peores):
+            cols_icv = [c for c in ICV_COLS if c in df_sucursal.columns]
+            filas = df_sucursal[df_sucursal["Sucursal"].isin(peores)]
+            trayectorias = pd.DataFrame(period_matrix(filas, cols_icv), index=filas["Sucursal"].astype(str),
+                                        columns=[c.replace("ICV", "").strip() or "Actual" for c in cols_icv][::-1])
+            total = ratio_block(
+                period_matrix(df_sucursal, [f"Saldo Insoluto Vencido {p}" for p in PERIODOS]).sum(axis=0),
+                period_matrix(df_sucursal, SALDO_PERIODO_COLS).sum(axis=0),
+            ) if set(SALDO_PERIODO_COLS + VENCIDO_PERIODO_COLS).issubset(df_sucursal.columns) else None
+            figuras.append(("tendencia_ICV.png", plot_icv_trends, {"trayectorias": trayectorias, "total": total}))
+
+    # ---------- Scatter 3D (Plotly interactivo + Matplotlib completo y recortado p99) ----------
     y_candidates = ["%FPD Actual", "% FPD Actual"]
-    y_col = next((c for c in y_candidates if c in df_final.columns), None)
-    x_col = "Capital Dispersado Actual" if "Capital Dispersado Actual" in df_final.columns else None
-    z_col = "Saldo Insoluto Actual" if "Saldo Insoluto Actual" in df_final.columns else None
+    cols_fila = df_final.columns if df_final is not None else []
+    y_col = next((c for c in y_candidates if c in cols_fila), None)
+    x_col = "Capital Dispersado Actual" if "Capital Dispersado Actual" in cols_fila else None
+    z_col = "Saldo Insoluto Actual" if "Saldo Insoluto Actual" in cols_fila else None
 
-    if all([x_col, y_col, z_col]) and {"Sucursal","Región","Zona"}.issubset(df_final.columns):
+    if all([x_col, y_col, z_col]) and {"Sucursal","Región","Zona"}.issubset(cols_fila):
         _df3d = df_final[[x_col, y_col, z_col, "Sucursal", "Región", "Zona"]].copy()
         _df3d[x_col] = pd.to_numeric(_df3d[x_col], errors="coerce")
         _df3d[y_col] = pd.to_numeric(_df3d[y_col], errors="coerce")
         _df3d[z_col] = pd.to_numeric(_df3d[z_col], errors="coerce")
         _df3d = _df3d.dropna(subset=[x_col, y_col, z_col])
 
-        fig_plotly = px.scatter_3d(
-            _df3d,
-            x=x_col, y=y_col, z=z_col,
-            color="Región",
-            hover_data=["Sucursal","Zona","Región"],
-            size=x_col,
-            opacity=0.7,
-            title=f"Scatter 3D interactivo: {y_col} vs {x_col} vs {z_col}"
-        )
-        # abre en navegador automáticamente por pio.renderers
-        fig_plotly.show()
+        # p99 sobre todas las filas; los scatter usan una muestra acotada (atípicos incluidos)
+        stats_fila = SummaryStats(_df3d)
+        p99 = tuple(stats_fila.quantiles(c, 0.99).item() for c in (x_col, y_col, z_col))
+        muestra = sample_scatter(_df3d, [x_col, y_col, z_col], max_puntos=args.max_puntos, p99=p99)
+        if len(muestra) < len(_df3d):
+            print(f"🔧 Scatter 3D: {len(muestra):,} de {len(_df3d):,} puntos "
+                  f"(muestra por Región, con atípicos > p99).")
+        figuras.append(("scatter3D_interactivo.html", plot_scatter3d_plotly,
+                        {"df3d": muestra, "x_col": x_col, "y_col": y_col, "z_col": z_col}))
+
+        ejes = {"x_col": x_col, "y_col": y_col, "z_col": z_col}
+        xyz = {"X": muestra[x_col], "Y": muestra[y_col], "Z": muestra[z_col], **ejes}
+        figuras_3d = [
+            ("H_scatter3D_fdp_capital_saldo.png", plot_scatter3d, xyz),
+            ("H_scatter3D_fdp_capital_saldo_p99.png", plot_scatter3d, {**xyz, "clip_p99": True, "p99": p99}),
+        ]
+        if args.densidad_3d:
+            figuras_3d.append(("H_densidad3D_fdp_capital_saldo.png", plot_density3d,
+                               {"X": _df3d[x_col], "Y": _df3d[y_col], "Z": _df3d[z_col], **ejes, "p99": p99}))
+        figuras += figuras_3d
+    elif df_final is None:
+        print("(Modo streaming/polars: sin datos a nivel fila, se omiten los scatter 3D.)")
     else:
-        print("⛔ No se generó el scatter 3D interactivo (faltan columnas x/y/z o Sucursal/Región/Zona).")
-
-    # ---------- Scatter 3D Matplotlib y versión recortada (-> navegador) ----------
-    if all([x_col, y_col, z_col]) and {"Sucursal","Región","Zona"}.issubset(df_final.columns):
-        OUT = Path("figuras_dimex"); OUT.mkdir(exist_ok=True)
-
-        X = pd.to_numeric(df_final[x_col], errors="coerce")
-        Y = pd.to_numeric(df_final[y_col], errors="coerce")
-        Z = pd.to_numeric(df_final[z_col], errors="coerce")
-        mask = X.notna() & Y.notna() & Z.notna()
-        X, Y, Z = X[mask], Y[mask], Z[mask]
-
-        # Completo
-        fig = plt.figure()
-        ax = fig.add_subplot(111, projection="3d")
-        ax.scatter(X, Y, Z, s=8, alpha=0.7)
-        ax.set_xlabel(x_col); ax.set_ylabel(y_col); ax.set_zlabel(z_col)
-        ax.set_title(f"3D: {y_col} vs {x_col} vs {z_col}")
-        plt.tight_layout()
-        fig.savefig(OUT / "H_scatter3D_fdp_capital_saldo.png", dpi=140)
-        show_in_browser(fig)
-
-        # Recortado p99
-        xq, yq, zq = X.quantile(0.99), Y.quantile(0.99), Z.quantile(0.99)
-        m_clip = (X <= xq) & (Y <= yq) & (Z <= zq)
-        fig2 = plt.figure()
-        ax2 = fig2.add_subplot(111, projection="3d")
-        ax2.scatter(X[m_clip], Y[m_clip], Z[m_clip], s=8, alpha=0.7)
-        ax2.set_xlabel(x_col); ax2.set_ylabel(y_col); ax2.set_zlabel(z_col)
-        ax2.set_title(f"3D (p99 clip): {y_col} vs {x_col} vs {z_col}")
-        plt.tight_layout()
-        fig2.savefig(OUT / "H_scatter3D_fdp_capital_saldo_p99.png", dpi=140)
-        show_in_browser(fig2)
-
-        print("✅ Scatter 3D (Matplotlib) generado y abierto en navegador. PNG guardados en ./figuras_dimex/")
+        print("⛔ No se generaron los scatter 3D (faltan columnas x/y/z o Sucursal/Región/Zona).")
+
+    t0 = time.perf_counter()
+    ruta = Path(EXPORT_EXCEL).with_name(Path(EXPORT_EXCEL).stem + DASHBOARD_SUFIJO)
+    build_dashboard(figuras, ruta, tablas, out_dir=args.salida_figuras, workers=args.workers)
+    print(f"✅ Dashboard: {ruta} ({len(figuras)} figuras, {time.perf_counter() - t0:.1f} s); "
+          f"figuras también en ./{args.salida_figuras}/")
+    if not args.headless:
+        webbrowser.open(ruta.resolve().as_uri())
+
+
+def analyze(path=EXCEL_FILE, *, jerarquia: HierarchyIndex | None = None, use_cache=True, refresh=False,
+            columns=None, streaming=False, chunk_rows: int = 50_000, estado_dir=None,
+            tolerancia_monto: float = 0.0, motor: str = "pandas", auditoria=None,
+            tasa_interes: float = TASA_INTERES_ANUAL, tasa_fondeo: float = TASA_FONDEO_ANUAL,
+            perf: StageProfiler | None = None, verbose=True) -> dict:
+    """
+    Todo el cálculo (sin gráficas ni exportación): carga, limpieza, mapeo,
+    columnas calculadas, agregado por sucursal, cubo e ICV.
+    - `streaming=True` procesa por bloques (no hay df_final).
+    - `estado_dir` activa el modo incremental con ese estado.
+    - `tolerancia_monto` para guardar montos en float32 (ver `apply_schema`).
+    - `motor="polars"` corre filtro, reglas, mapeo, suma e ICV como plan lazy de
+      Polars (no hay df_final; ver `aggregate_polars`).
+    - `auditoria`: archivo donde escribir las filas descartadas o marcadas por
+      REGLAS_CALIDAD (sólo en el camino pandas en memoria).
+    - `tasa_interes` / `tasa_fondeo`: tasas anuales de InteresGenerado y ServiciodeDeuda.
+    Devuelve un dict con df_final, df_sucursal (con ICV), cubo, reglas, filas,
+    descartadas y, en streaming, top15 y suma_insoluto.
+    """
+    if not Path(path).exists():
+        raise FileNotFoundError(
+            f"No encontré el archivo '{path}'. "
+            "Pon este script en la MISMA carpeta que el Excel o ajusta EXCEL_FILE."
+        )
+    log = print if verbose else (lambda *a, **k: None)
+    perf = perf or StageProfiler()
+    jerarquia = jerarquia or default_hierarchy()
+    resultado = {"archivo": str(path), "df_final": None, "incremental": None}
+
+    if motor not in MOTORES:
+        raise ValueError(f"Motor desconocido: '{motor}' (opciones: {', '.join(MOTORES)}).")
+    if streaming and Path(path).suffix.lower() == ".xls":
+        log(f"[Aviso] {Path(path).name}: un .xls no se puede leer por bloques (openpyxl); se carga completo.")
+        streaming = False
+
+    if motor == "polars":
+        # ---------- Polars: todo el pipeline como un plan lazy multi-hilo ----------
+        with perf.stage("polars"):
+            df_sucursal, resumen = aggregate_polars(path, use_cache=use_cache, jerarquia=jerarquia, verbose=verbose)
+            perf.track(df_sucursal)
+        log(f"✅ Archivo procesado con Polars: {path} | Filas: {resumen['filas']:,}")
+        log(f"🔧 Se limpiaron {resumen['descartadas']} filas con todos los saldos 0/NaN.")
+        if verbose:
+            jerarquia.report(resumen["sin_mapeo"])
+        resultado.update(filas=resumen["filas"], descartadas=resumen["descartadas"], reglas=resumen["reglas"],
+                         top15=resumen["top15"], suma_insoluto=resumen["suma_insoluto"])
+    elif streaming:
+        # ---------- Streaming: filtro, reglas, mapeo y suma por bloques ----------
+        with perf.stage("streaming"):
+            df_sucursal, resumen = aggregate_streaming(
+                path, chunk_rows=chunk_rows, use_cache=use_cache, jerarquia=jerarquia, verbose=verbose,
+            )
+            perf.track(df_sucursal)
+        log(f"✅ Excel procesado por bloques: {path} | Filas: {resumen['filas']:,}")
+        log(f"🔧 Se limpiaron {resumen['descartadas']} filas con todos los saldos 0/NaN.")
+        if verbose:
+            jerarquia.report(resumen["sin_mapeo"])
+        resultado.update(filas=resumen["filas"], descartadas=resumen["descartadas"], reglas=resumen["reglas"],
+                         top15=resumen["top15"], suma_insoluto=resumen["suma_insoluto"])
     else:
-        print("⛔ No se generaron PNG 3D (faltan columnas x/y/z o Sucursal/Región/Zona).")
+        with perf.stage("carga"):
+            df = perf.track(load(path, columns=columns, use_cache=use_cache, refresh=refresh, verbose=verbose))
+        log(f"✅ Excel cargado: {path} | Filas: {len(df):,}")
+        resultado["filas"] = len(df)
+
+        # ---------- Esquema: validar columnas y tipos ----------
+        with perf.stage("esquema"):
+            df, info_esquema = apply_schema(df, tolerancia_monto=tolerancia_monto)
+            perf.track(df)
+        log(f"🔧 Esquema: {info_esquema['mb_antes']:,.1f} MB → {info_esquema['mb_despues']:,.1f} MB "
+            f"({', '.join(f'{n} {t}' for t, n in info_esquema['tipos'].items())}).")
+        if info_esquema["no_numericos"]:
+            log(f"[Aviso] {info_esquema['no_numericos']:,} celdas no numéricas en montos/porcentajes quedaron como NaN.")
+        resultado["esquema"] = info_esquema
+
+        # ---------- Calidad de datos: reglas por fila, filtro y auditoría ----------
+        with perf.stage("filtro"):
+            calidad = quality_checks(df)
+            filtro = drop_mask(calidad)
+            if auditoria is not None and any(m.any() for m in calidad.values()):
+                resultado["auditoria"] = write_audit(df, calidad, auditoria)["archivos"][0]
+            df_filtrado = perf.track(df.loc[~filtro].copy())
+            del df
+        resultado["descartadas"] = int(filtro.sum())
+        resultado["calidad"] = {nombre: int(m.sum()) for nombre, m in calidad.items()}
+        log(f"🔧 Se limpiaron {resultado['descartadas']} filas con todos los saldos 0/NaN.")
+        avisos = {n: k for n, k in resultado["calidad"].items() if k and n != "saldos_en_cero"}
+        if avisos:
+            log("[Aviso] Filas con reglas de calidad marcadas: "
+                + ", ".join(f"{n} {k:,}" for n, k in avisos.items()))
+        if resultado.get("auditoria"):
+            log(f"📝 Auditoría de filas descartadas/marcadas: {resultado['auditoria']}")
+
+        # ---------- Reglas Capital–FPD ----------
+        with perf.stage("reglas"):
+            resultado["reglas"] = apply_capital_fpd_rules(perf.track(df_filtrado))
+
+        # ---------- Mapeo Región–Zona–Sucursal ----------
+        with perf.stage("mapeo"):
+            if verbose:
+                jerarquia.report(jerarquia.unmapped(df_filtrado["Sucursal"]))
+            df_final = perf.track(map_hierarchy(df_filtrado, jerarquia))
+            del df_filtrado
+
+        # ---------- Columnas calculadas ----------
+        with perf.stage("columnas"):
+            perf.track(add_calculated_columns(df_final, tasa_interes, tasa_fondeo))
+
+        # ---------- Agrupar por Región/Zona/Sucursal ----------
+        with perf.stage("agregado"):
+            if estado_dir is not None:
+                df_sucursal, info_inc = aggregate_incremental(df_final, estado_dir)
+                resultado["incremental"] = info_inc
+            else:
+                df_sucursal = aggregate(df_final)
+            perf.track(df_sucursal)
+        if estado_dir is not None:
+            if info_inc["estado_previo"]:
+                log(f"♻️  Incremental: {info_inc['desplazadas']} sucursales desplazadas un periodo, "
+                    f"{info_inc['recalculadas']} recalculadas.")
+            else:
+                log(f"♻️  Incremental: sin estado previo, cálculo completo ({info_inc['estado']}).")
+        resultado["df_final"] = df_final
+
+    if resultado.get("top15") is not None:  # streaming/polars: el top se eligió por saldo; columnas con estas tasas
+        add_calculated_columns(resultado["top15"], tasa_interes, tasa_fondeo)
+
+    for nombre, n in resultado["reglas"].items():
+        log(f"🔧 Regla Capital–FPD [{nombre}]: {n:,} celdas cambiadas.")
 
-    # ---------- Exportar Excel final ----------
-    df_final.to_excel(EXPORT_EXCEL, index=False)
-    print(f"\n✅ Exportado: {EXPORT_EXCEL} (aparece en tu carpeta de trabajo)\n")
+    log("\nVista rápida de df_sucursal:")
+    log(df_sucursal.head())
+
+    # ---------- Cubo Sucursal → Zona → Región → Total ----------
+    with perf.stage("cubo"):
+        cubo = AggregationCube(df_sucursal)
+        df_region = perf.track(cubo.frame("Región", icv=True))
+    if "ICV" in df_region.columns:
+        log("\nICV por Región (vencido / saldo sumados):")
+        log(df_region[["Región", "Saldo Insoluto Actual", "ICV"]].to_string(index=False))
+        log(f"ICV total: {cubo.frame('Total', icv=True)['ICV'].iloc[0]:.4f}")
+
+    # ---------- ICV (manejo división por cero) ----------
+    with perf.stage("icv"):
+        if "ICV" not in df_sucursal.columns:  # el motor polars ya trae el ICV
+            df_sucursal = compute_icv(df_sucursal)
+        perf.track(df_sucursal)
+
+    resultado.update(df_sucursal=df_sucursal, cubo=cubo)
+    return resultado
+
+
+def _run_batch_cli(args, perf: StageProfiler):
+    """--lote: analiza cada archivo en paralelo, exporta el consolidado e imprime el throughput."""
+    salida = Path(EXPORT_EXCEL).stem
+    archivos = [a for a in batch_files(args.lote) if not a.stem.startswith(salida)]  # sin nuestras propias salidas
+    if not archivos:
+        raise FileNotFoundError(f"No encontré libros para el lote '{args.lote}'.")
+    print(f"📚 Lote: {len(archivos)} archivos en '{args.lote}'")
+
+    with perf.stage("lote"):
+        consolidado, resumen = run_batch(
+            archivos,
+            workers=args.workers,
+            jerarquia=HierarchyIndex.from_csv(args.jerarquia) if args.jerarquia else None,
+            use_cache=not args.sin_cache,
+            columns=PIPELINE_COLS if args.solo_columnas else None,
+            streaming=args.streaming,
+            chunk_rows=args.chunk_filas,
+            tolerancia_monto=args.tolerancia_montos,
+            motor=args.motor,
+            tasa_interes=args.tasa_interes,
+            tasa_fondeo=args.tasa_fondeo,
+        )
+        perf.track(consolidado)
+
+    for archivo, error in resumen["fallidos"].items():
+        print(f"[Aviso] Falló {archivo}. Detalle: {error}")
+    print(f"✅ Lote: {resumen['ok']}/{resumen['archivos']} archivos | {resumen['filas']:,} filas "
+          f"en {resumen['segundos']:.2f} s ({resumen['filas_por_s']:,.0f} filas/s, "
+          f"{resumen['archivos_por_min']:.1f} archivos/min)")
+    if resumen["rss_pico_trabajador_mb"]:
+        print(f"   Pico de memoria por trabajador: {resumen['rss_pico_trabajador_mb']:,.1f} MB")
+
+    with perf.stage("export"):
+        base = Path(EXPORT_EXCEL)
+        info = export({"lote": consolidado.reset_index()}, base.with_name(f"{base.stem}.lote{base.suffix}"),
+                      formato=args.formato, compresion=args.compresion)
+    print(f"\n✅ Exportado: {', '.join(str(a) for a in info['archivos'])}")
+
+    ruta_perfil = perf.report(lote=resumen, argumentos=vars(args), export_bytes=info["bytes"])
+    print(perf.summary())
+    print(f"⏱️  Perfil por etapa: {ruta_perfil}")
+
+
+def main(argv=None):
+    args = _parse_args(argv)
+    if args.headless:
+        import matplotlib
+        matplotlib.use("Agg")
+
+    perf = StageProfiler(Path(EXPORT_EXCEL).with_suffix(""), memoria=args.perfil_memoria,
+                         cprofile_stage=args.cprofile)
+    if args.lote:
+        return _run_batch_cli(args, perf)
+    if args.servir is not None:
+        print(f"⏳ Cargando {EXCEL_FILE} ...")
+        servicio = AnalysisService(
+            EXCEL_FILE,
+            intervalo=args.intervalo_vigilancia,
+            jerarquia=HierarchyIndex.from_csv(args.jerarquia) if args.jerarquia else None,
+            use_cache=not args.sin_cache,
+            columns=PIPELINE_COLS if args.solo_columnas else None,
+            tolerancia_monto=args.tolerancia_montos,
+            tasa_interes=args.tasa_interes,
+            tasa_fondeo=args.tasa_fondeo,
+        )
+        print(f"✅ {servicio._estado['resultado']['filas']:,} filas listas en {servicio._estado['segundos']:.2f} s")
+        return serve(servicio, args.servir)
+    if args.verificar_motores:
+        verificacion = check_engines(EXCEL_FILE, use_cache=not args.sin_cache)
+        for diferencia in verificacion["diferencias"]:
+            print(f"⛔ {diferencia}")
+        print("✅ pandas y polars dan el mismo resultado." if verificacion["ok"] else "⛔ Los motores difieren.")
+        return 0 if verificacion["ok"] else 1
+
+    resultado = analyze(
+        EXCEL_FILE,
+        jerarquia=HierarchyIndex.from_csv(args.jerarquia) if args.jerarquia else None,
+        use_cache=not args.sin_cache,
+        refresh=args.refrescar_cache,
+        columns=PIPELINE_COLS if args.solo_columnas else None,
+        streaming=args.streaming,
+        chunk_rows=args.chunk_filas,
+        estado_dir=args.estado if args.incremental and not args.streaming and args.motor == "pandas" else None,
+        tolerancia_monto=args.tolerancia_montos,
+        motor=args.motor,
+        auditoria=None if args.sin_auditoria else Path(EXPORT_EXCEL).with_name(f"{Path(EXPORT_EXCEL).stem}.auditoria.csv"),
+        tasa_interes=args.tasa_interes,
+        tasa_fondeo=args.tasa_fondeo,
+        perf=perf,
+    )
+    df_final, df_sucursal, cubo = resultado["df_final"], resultado["df_sucursal"], resultado["cubo"]
+
+    # ---------- Análisis preliminar ----------
+    with perf.stage("resumen"):
+        # Rankings una sola vez (selección parcial); sirven a la tabla, la gráfica y la exportación
+        if df_final is None:
+            top15 = resultado["top15"]  # streaming/polars: top 15 por fila ya calculado
+        elif "ServiciodeDeuda" in df_final.columns:
+            top15 = top_n(df_final, "ServiciodeDeuda", args.top_n)
+        else:
+            top15 = None
+        tasas = {"tasa_interes": args.tasa_interes, "tasa_fondeo": args.tasa_fondeo}
+        top_sucursal = rank_sucursales(df_sucursal, args.top_n, **tasas)
+
+        if top15 is not None:
+            print(f"\nTOP {len(top15)} por Servicio de Deuda:")
+            print(top15[["Sucursal","Región","Zona","ServiciodeDeuda"]])
+        else:
+            print("\n(No existe columna 'ServiciodeDeuda')")
+        if top_sucursal is not None:
+            print(f"\nTOP {len(top_sucursal)} sucursales por Servicio de Deuda (suma por sucursal):")
+            print(top_sucursal[["Sucursal","Región","Zona","ServiciodeDeuda"]].to_string(index=False))
+
+        suma_insoluto = None
+        if df_final is None:
+            suma_insoluto = resultado["suma_insoluto"]
+        elif "Saldo Insoluto Actual" in df_final.columns:
+            suma_insoluto = pd.to_numeric(df_final["Saldo Insoluto Actual"], errors="coerce").sum()
+        if suma_insoluto is not None:
+            print(f"\nSuma total 'Saldo Insoluto Actual': ${suma_insoluto:,.2f}\n")
+
+    # ---------- Tendencias ICV / FPD por sucursal ----------
+    with perf.stage("tendencias"):
+        tendencias = perf.track(trend_table(df_sucursal, df_final)) if "ICV" in df_sucursal.columns else None
+        if tendencias is not None:
+            col_pendiente = next(c for c in tendencias.columns if c.startswith("ICV pendiente"))
+            en_deterioro = tendencias[tendencias["ICV deterioro"]].nlargest(args.top_n, col_pendiente)
+            print(f"📈 ICV en deterioro: {int(tendencias['ICV deterioro'].sum()):,} de {len(tendencias):,} sucursales"
+                  + (f"; FPD en deterioro: {int(tendencias['FPD deterioro'].sum()):,}"
+                     if "FPD deterioro" in tendencias.columns else ""))
+            if len(en_deterioro):
+                print(en_deterioro[["Sucursal", "Región", "Zona", "ICV Actual", col_pendiente, "ICV meses al alza"]]
+                      .to_string(index=False))
+
+    # ---------- Escenarios de tasas (producto cartesiano, todos los niveles) ----------
+    escenarios = None
+    if args.escenarios_interes is not None or args.escenarios_fondeo is not None:
+        with perf.stage("escenarios"):
+            escenarios = perf.track(scenario_sweep(
+                cubo,
+                args.escenarios_interes if args.escenarios_interes is not None else [args.tasa_interes],
+                args.escenarios_fondeo if args.escenarios_fondeo is not None else [args.tasa_fondeo],
+            ))
+        n_esc = escenarios["Escenario"].nunique()
+        print(f"🧮 Escenarios: {n_esc} combinaciones de tasas × {len(escenarios) // n_esc:,} grupos "
+              f"= {len(escenarios):,} filas")
+        print(escenarios[escenarios["Nivel"] == "Total"]
+              [["Tasa interés anual", "Tasa fondeo anual", "InteresGenerado", "ServiciodeDeuda"]]
+              .to_string(index=False))
+
+    with perf.stage("graficas"):
+        cols_top = ["Sucursal","Región","Zona","ServiciodeDeuda"]
+        tablas = {
+            "Suma total 'Saldo Insoluto Actual'": None if suma_insoluto is None else pd.DataFrame(
+                {"Saldo Insoluto Actual": [suma_insoluto]}),
+            f"TOP {args.top_n} por Servicio de Deuda": None if top15 is None else top15[cols_top],
+            f"TOP {args.top_n} sucursales (suma por sucursal)": None if top_sucursal is None else top_sucursal[cols_top],
+            f"Sucursales con ICV en deterioro (top {args.top_n} por pendiente)":
+                None if tendencias is None else en_deterioro,
+            "Escenarios de tasas (Total)": None if escenarios is None else escenarios.loc[
+                escenarios["Nivel"] == "Total", ["Tasa interés anual", "Tasa fondeo anual",
+                                                 "InteresGenerado", "ServiciodeDeuda"]],
+            f"df_sucursal (primeras 50 de {len(df_sucursal):,})": df_sucursal.head(50),
+        }
+        _run_plots(args, df_final, df_sucursal, top_sucursal if top_sucursal is not None else top15, tablas,
+                   tendencias)
+
+    # ---------- Exportar resultado final ----------
+    with perf.stage("export"):
+        hojas = {"Sheet1": df_sucursal if df_final is None else df_final}
+        if args.hojas_agregados:
+            if df_final is not None:
+                hojas["sucursal"] = df_sucursal
+            hojas["zona"] = cubo.frame("Zona", icv=True)
+            hojas["region"] = cubo.frame("Región", icv=True)
+            hojas["total"] = cubo.frame("Total", icv=True)
+            if top_sucursal is not None:
+                hojas["top_sucursal"] = top_sucursal
+                hojas["top_region"] = rank_sucursales(df_sucursal, args.top_n, by="Región", **tasas)
+                hojas["top_zona"] = rank_sucursales(df_sucursal, args.top_n, by="Zona", **tasas)
+            if tendencias is not None:
+                hojas["tendencias"] = tendencias
+        if escenarios is not None:
+            hojas["escenarios"] = escenarios
+
+        info = export(hojas, EXPORT_EXCEL, formato=args.formato, compresion=args.compresion)
+    nombres = ", ".join(str(a) for a in info["archivos"])
+    print(f"\n✅ Exportado: {nombres} (aparece en tu carpeta de trabajo)")
+    print(f"   {info['bytes'] / 1e6:,.2f} MB en {info['segundos']:.2f} s\n")
+
+    # ---------- Reporte de etapas ----------
+    ruta_perfil = perf.report(archivo=str(EXCEL_FILE), argumentos=vars(args), export_bytes=info["bytes"])
+    print(perf.summary())
+    print(f"⏱️  Perfil por etapa: {ruta_perfil}")
 
 
 # ===================== ENTRY POINT ==========================
@@ -577,5 +2978,5 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"[Aviso backend Matplotlib] {e}")
 
-    main()
-aas
\ No newline at end of file
+    sys.exit(main())  # --verificar-motores devuelve 1 si los motores difieren
+
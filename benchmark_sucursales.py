@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark del pipeline de analisis_sucurales.py con libros sintéticos.
+
+- Genera libros con el mismo layout que espera el script (Vendedor, Sucursal de
+  la JERARQUIA, Saldo Insoluto / Vencido, Capital Dispersado y % FPD de Actual a
+  T-12). Hasta ~1M filas en .xlsx; más allá, Excel no da: .parquet o .csv.
+- Corre `analyze` por tamaño y modo en un proceso nuevo por caso (así el pico de
+  memoria de un caso no contamina al siguiente) y toma el mínimo de N repeticiones.
+- Guarda una baseline JSON y compara contra ella: sale con código 1 si alguna etapa
+  o el pico de memoria empeoró más que el umbral.
+
+    python benchmark_sucursales.py --tamanos 10000 100000 --guardar-baseline
+    python benchmark_sucursales.py --tamanos 10000 100000            # compara
+    python benchmark_sucursales.py --tamanos 10000000 --modos streaming
+"""
+from __future__ import annotations
+
+# ========================== CONFIG ==========================
+BENCH_DIR      = ".bench_sucursales"          # libros sintéticos y resultados
+BASELINE_FILE  = "benchmark_baseline.json"
+TAMANOS        = [10_000, 100_000, 1_000_000]
+MAX_FILAS_XLSX = 1_048_575                    # límite de filas de Excel (sin encabezado)
+
+# ======================== IMPORTS ===========================
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import analisis_sucurales as an
+
+
+# ================== GENERADOR SINTÉTICO =====================
+def generate(n: int, seed: int = 0, inicio: int = 0, sin_mapeo: float = 0.01) -> pd.DataFrame:
+    """
+    `n` filas sintéticas con el layout del Excel de producción.
+    - Sucursal sale de la JERARQUIA (más una fracción `sin_mapeo` de sucursales desconocidas).
+    - Historia T-12..Actual con crecimiento aleatorio; créditos que empiezan a mitad
+      de la historia tienen saldo 0 antes; ~5% de filas con todos los saldos en 0.
+    - % FPD con NaN y ceros, para que las reglas Capital–FPD tengan qué cambiar.
+    `inicio` numera los vendedores (para generar por bloques sin repetir).
+    """
+    rng = np.random.default_rng(seed)
+    sucursales = np.array([s for _, _, s in an.JERARQUIA] + ["Sucursal Nueva 1", "Sucursal Nueva 2"])
+    pesos = np.r_[np.full(len(sucursales) - 2, (1 - sin_mapeo) / (len(sucursales) - 2)), [sin_mapeo / 2] * 2]
+
+    datos = {
+        "Vendedor": np.char.add("V", np.char.zfill(np.arange(inicio, inicio + n).astype(str), 8)),
+        "Sucursal": rng.choice(sucursales, n, p=pesos),
+    }
+
+    # Saldos: de T-12 a Actual, cada periodo crece/decrece un poco respecto al anterior
+    saldo = rng.gamma(2.0, 20_000.0, n)
+    arranque = rng.integers(0, len(an.PERIODOS), n)  # periodo (desde T-12) en que nace el crédito
+    vacios = rng.random(n) < 0.05
+    saldos, vencidos = {}, {}
+    for k, periodo in enumerate(reversed(an.PERIODOS)):
+        saldo = saldo * rng.lognormal(0.0, 0.08, n)
+        s = np.where((k >= arranque) & ~vacios, saldo, 0.0).round(2)
+        saldos[periodo] = s
+        vencidos[periodo] = (s * rng.beta(1.0, 8.0, n)).round(2)
+    for periodo in an.PERIODOS:
+        datos[f"Saldo Insoluto {periodo}"] = saldos[periodo]
+        datos[f"Saldo Insoluto Vencido {periodo}"] = vencidos[periodo]
+
+    for periodo in an.PERIODOS:
+        capital = rng.gamma(2.0, 10_000.0, n).round(2)
+        capital[rng.random(n) < 0.3] = 0.0
+        fpd = rng.beta(1.0, 10.0, n)
+        fpd[rng.random(n) < 0.2] = np.nan
+        fpd[rng.random(n) < 0.1] = 0.0
+        datos[f"Capital Dispersado {periodo}"] = capital
+        datos[f"% FPD {periodo}"] = fpd
+
+    return pd.DataFrame(datos)
+
+
+def write_workbook(path, n: int, seed: int = 0, chunk_rows: int = 250_000) -> Path:
+    """
+    Escribe `n` filas sintéticas en `path` según su extensión.
+    - .xlsx: hasta MAX_FILAS_XLSX (con el writer rápido de analisis_sucurales).
+    - .parquet / .csv: por bloques de `chunk_rows`, sin tener todo en memoria.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    formato = path.suffix.lower()
+    bloques = ((generate(min(chunk_rows, n - i), seed=seed + i, inicio=i)) for i in range(0, n, chunk_rows))
+
+    if formato == ".xlsx":
+        if n > MAX_FILAS_XLSX:
+            raise ValueError(f"Excel admite hasta {MAX_FILAS_XLSX:,} filas; usa .parquet o .csv para {n:,}.")
+        an.export({"Sheet1": pd.concat(bloques, ignore_index=True)}, path, formato="xlsx")
+    elif formato == ".parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        writer = None
+        try:
+            for bloque in bloques:
+                tabla = pa.Table.from_pandas(bloque, preserve_index=False)
+                writer = writer or pq.ParquetWriter(path, tabla.schema)
+                writer.write_table(tabla)
+        finally:
+            if writer is not None:
+                writer.close()
+    elif formato == ".csv":
+        for i, bloque in enumerate(bloques):
+            bloque.to_csv(path, mode="w" if i == 0 else "a", header=i == 0, index=False)
+    else:
+        raise ValueError(f"Formato no soportado para el sintético: '{formato}' (.xlsx, .parquet, .csv).")
+    return path
+
+
+def synthetic_path(n: int, seed: int = 0, formato: str = "auto", bench_dir=BENCH_DIR) -> Path:
+    """Ruta del sintético de `n` filas; se genera sólo si no existe (se reusa entre corridas)."""
+    if formato == "auto":
+        formato = "xlsx" if n <= MAX_FILAS_XLSX else "parquet"
+    path = Path(bench_dir) / f"sintetico_{n}_s{seed}.{formato}"
+    if not path.exists():
+        t0 = time.perf_counter()
+        print(f"🔧 Generando {path} ({n:,} filas)...")
+        write_workbook(path, n, seed=seed)
+        print(f"   listo en {time.perf_counter() - t0:.1f} s ({path.stat().st_size / 1e6:,.1f} MB)")
+    return path
+
+
+# ======================== HARNESS ===========================
+MODOS = ("memoria", "streaming", "polars")
+MODOS_DEFAULT = [m for m in MODOS if m != "polars" or an._HAS_POLARS]
+
+
+def _run_case(path: str, modo: str, memoria: bool) -> dict:
+    """Un caso en el proceso actual (se llama en un proceso nuevo): etapas, total y pico RSS."""
+    perf = an.StageProfiler(memoria=memoria)
+    t0 = time.perf_counter()
+    an.analyze(path, streaming=modo == "streaming", motor="polars" if modo == "polars" else "pandas",
+               perf=perf, verbose=False)
+    return {
+        "total_s": round(time.perf_counter() - t0, 4),
+        "rss_pico_mb": an._rss_peak_mb(),
+        "etapas": {e["etapa"]: e["wall_s"] for e in perf.etapas},
+        "tracemalloc_pico_mb": max((e.get("tracemalloc_pico_mb", 0) for e in perf.etapas), default=None)
+        if memoria else None,
+    }
+
+
+def _warm_cache(path: str) -> None:
+    """Crea la caché Parquet del Excel: streaming la lee si existe, pero no la escribe."""
+    if Path(path).suffix.lower() in (".xlsx", ".xlsm"):
+        an.load(path, verbose=False)
+
+
+def run_case(path, modo: str, repeticiones: int = 3, memoria: bool = False) -> dict:
+    """
+    Corre el caso `repeticiones` veces, cada una en un proceso nuevo (spawn), y se
+    queda con el mínimo por etapa, total y memoria: el mínimo es la medida menos ruidosa.
+    Antes se crea la caché del Excel con `an.load` y se hace una corrida de
+    calentamiento sin medir (no se mide la conversión xlsx → Parquet en ningún modo).
+    """
+    contexto = multiprocessing.get_context("spawn")
+    corridas = []
+    for i in range(repeticiones + 1):
+        with ProcessPoolExecutor(max_workers=1, mp_context=contexto) as pool:
+            if i == 0:
+                pool.submit(_warm_cache, str(path)).result()
+            r = pool.submit(_run_case, str(path), modo, memoria).result()
+        if i > 0:  # la primera sólo calienta
+            corridas.append(r)
+
+    etapas = {nombre: min(c["etapas"].get(nombre, np.inf) for c in corridas) for nombre in corridas[0]["etapas"]}
+    return {
+        "total_s": min(c["total_s"] for c in corridas),
+        "rss_pico_mb": min((c["rss_pico_mb"] for c in corridas if c["rss_pico_mb"] is not None), default=None),
+        "tracemalloc_pico_mb": corridas[0]["tracemalloc_pico_mb"],
+        "etapas": etapas,
+        "repeticiones": repeticiones,
+    }
+
+
+def environment() -> dict:
+    """Versiones y máquina: una baseline sólo es comparable en el mismo entorno."""
+    return {
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "plataforma": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+# ==================== BASELINE / REGRESIONES ================
+def compare(actual: dict, baseline: dict, umbral: float = 0.15, umbral_mem: float = 0.15,
+            piso_s: float = 0.05) -> list[str]:
+    """
+    Regresiones de `actual` contra `baseline` (mismos casos "tamaño/modo"):
+    una etapa o el total más lento que baseline·(1+umbral) y por más de `piso_s`
+    segundos (ruido), o un pico de RSS mayor que baseline·(1+umbral_mem).
+    """
+    regresiones = []
+    for caso, r in actual["casos"].items():
+        b = baseline.get("casos", {}).get(caso)
+        if b is None:
+            continue
+        tiempos = [("total", r["total_s"], b["total_s"])]
+        tiempos += [(e, s, b["etapas"][e]) for e, s in r["etapas"].items() if e in b["etapas"]]
+        for nombre, ahora, antes in tiempos:
+            if ahora > antes * (1 + umbral) and ahora - antes > piso_s:
+                regresiones.append(f"{caso} {nombre}: {antes:.3f} s → {ahora:.3f} s (+{ahora / antes - 1:.0%})")
+        if r["rss_pico_mb"] and b.get("rss_pico_mb") and r["rss_pico_mb"] > b["rss_pico_mb"] * (1 + umbral_mem):
+            regresiones.append(f"{caso} RSS: {b['rss_pico_mb']:,.0f} MB → {r['rss_pico_mb']:,.0f} MB")
+    return regresiones
+
+
+def summary(resultados: dict, baseline: dict | None = None) -> str:
+    """Tabla caso × etapa (segundos) con total y pico de RSS; entre paréntesis la baseline."""
+    def ref(x):
+        return f" ({x:.2f})" if x is not None else ""
+
+    lineas = []
+    for caso, r in resultados["casos"].items():
+        b = (baseline or {}).get("casos", {}).get(caso, {})
+        lineas.append(f"\n{caso}: total {r['total_s']:.2f} s{ref(b.get('total_s'))} | "
+                      f"RSS {r['rss_pico_mb'] or 0:,.0f} MB{ref(b.get('rss_pico_mb'))}")
+        for etapa, s in r["etapas"].items():
+            lineas.append(f"  {etapa:<10} {s:>8.3f}{ref(b.get('etapas', {}).get(etapa))}")
+    return "\n".join(lineas)
+
+
+# ========================= MAIN =============================
+def _parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de analisis_sucurales con libros sintéticos.")
+    parser.add_argument("--tamanos", type=int, nargs="+", default=TAMANOS,
+                        help=f"Filas por caso (default: {' '.join(map(str, TAMANOS))}).")
+    parser.add_argument("--modos", nargs="+", choices=MODOS, default=MODOS_DEFAULT,
+                        help="Caminos a medir: memoria (analyze completo), streaming y/o polars "
+                             "(default: todos los disponibles).")
+    parser.add_argument("--formato", choices=("auto", "xlsx", "parquet", "csv"), default="auto",
+                        help=f"Formato del sintético (auto: xlsx hasta {MAX_FILAS_XLSX:,} filas, luego parquet).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeticiones", type=int, default=3,
+                        help="Corridas medidas por caso; se reporta el mínimo (default: 3).")
+    parser.add_argument("--perfil-memoria", action="store_true",
+                        help="Medir también el pico de tracemalloc por etapa (más lento).")
+    parser.add_argument("--baseline", default=BASELINE_FILE,
+                        help=f"Archivo de baseline (default: {BASELINE_FILE}).")
+    parser.add_argument("--guardar-baseline", action="store_true",
+                        help="Guardar estos resultados como la nueva baseline (se combinan con los casos ya guardados).")
+    parser.add_argument("--umbral", type=float, default=0.15,
+                        help="Regresión de tiempo si una etapa es más lenta que baseline·(1+umbral) (default: 0.15).")
+    parser.add_argument("--umbral-memoria", type=float, default=0.15,
+                        help="Regresión de memoria si el pico RSS supera baseline·(1+umbral) (default: 0.15).")
+    parser.add_argument("--solo-generar", action="store_true",
+                        help="Sólo generar los libros sintéticos y salir.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = _parse_args(argv)
+    archivos = {n: synthetic_path(n, seed=args.seed, formato=args.formato) for n in args.tamanos}
+    if args.solo_generar:
+        return 0
+
+    resultados = {"fecha": datetime.now().isoformat(timespec="seconds"), "entorno": environment(), "casos": {}}
+    for n, path in archivos.items():
+        for modo in args.modos:
+            caso = f"{n}/{modo}"
+            print(f"⏱️  {caso} ({path.name}, {args.repeticiones} repeticiones)...")
+            resultados["casos"][caso] = run_case(path, modo, args.repeticiones, memoria=args.perfil_memoria)
+
+    ruta_baseline = Path(args.baseline)
+    baseline = json.loads(ruta_baseline.read_text(encoding="utf-8")) if ruta_baseline.exists() else None
+    print(summary(resultados, baseline))
+
+    salida = Path(BENCH_DIR) / f"resultados_{datetime.now():%Y%m%d_%H%M%S}.json"
+    salida.write_text(json.dumps(resultados, ensure_ascii=False, indent=2), encoding="utf-8")
+    print(f"\n✅ Resultados: {salida}")
+
+    codigo = 0
+    if baseline is not None and not args.guardar_baseline:
+        if baseline.get("entorno") != resultados["entorno"]:
+            print("[Aviso] La baseline es de otro entorno (versiones/máquina); la comparación es orientativa.")
+        regresiones = compare(resultados, baseline, args.umbral, args.umbral_memoria)
+        if regresiones:
+            print("\n⛔ Regresiones contra la baseline:")
+            for r in regresiones:
+                print(f"   {r}")
+            codigo = 1
+        else:
+            print("✅ Sin regresiones contra la baseline.")
+
+    if args.guardar_baseline:
+        casos = {**(baseline or {}).get("casos", {}), **resultados["casos"]}
+        ruta_baseline.write_text(json.dumps({**resultados, "casos": casos}, ensure_ascii=False, indent=2),
+                                 encoding="utf-8")
+        print(f"✅ Baseline guardada: {ruta_baseline}")
+    return codigo
+
+
+# ===================== ENTRY POINT ==========================
+if __name__ == "__main__":
+    sys.exit(main())